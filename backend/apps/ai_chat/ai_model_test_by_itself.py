@@ -1,6 +1,8 @@
 # ai_model_test_by_itself.py
 # A vanilla Python script to test the raw output of the Gemma 3 1B model
 # based on the settings in llm_handler_deployment.py.
+# For timings (TTFT, tokens/s, p50/p95, peak RSS) use `python manage.py benchmark_llm`,
+# which runs the same prompts through the real request path.
 
 import os
 import sys
@@ -17,41 +19,39 @@ except ImportError:
     print("Please activate your virtual environment and run 'pip install llama-cpp-python'.")
     sys.exit(1)
 
-# --- Configuration (Copied from llm_handler_deployment.py) ---
+# --- Configuration (imported from llm_handler_deployment.py so it cannot drift) ---
 
 # Calculate BASE_DIR relative to this file to find the model
 # This file: backend/apps/ai_chat/ai_model_test_by_itself.py
 # Model path: backend/ai_model/
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-MODEL_FILENAME = "gemma-3-1b-it-Q8_0.gguf"
-MODEL_PATH = os.path.join(BASE_DIR, "ai_model", MODEL_FILENAME)
+sys.path.insert(0, BASE_DIR)
+
+from apps.ai_chat.benchmark import BENCHMARK_PROMPTS
+from apps.ai_chat.llm_handler_deployment import (
+    ADAPTIVE_MEMORY_THRESHOLDS,
+    MODEL_FILENAME,
+    STOP_SEQUENCES,
+    SYSTEM_PROMPT,
+    OptimizedLlamaModel,
+    _sampling_parameters,
+    detect_cpu_budget,
+)
 
-# Model loading parameters modeled after llm_handler_deployment.py (Gemma 3 1B optimized)
-CONTEXT_WINDOW = 4096  # Matching 'high' tier in deployment handler
-N_THREADS = 8          # Reasonable for local testing on multi-core machine
+MODEL_PATH = os.path.join(BASE_DIR, "ai_model", MODEL_FILENAME)
 
-# System prompt for Gemma 3, per deployment handler
-SYSTEM_PROMPT = "You are a Grounded, Balanced, Creative, Helpful, and Insightful AI Assistant. You are also a direct and factual AI assistant. You must respond ONLY with the information requested for, without any conversational fillers, introductions, or extraneous text. Your output must be the direct answer to the user's query."
+# The deployment handler's 'high' tier, on this machine's CPU budget
+TIER = 'high'
+CONTEXT_WINDOW = ADAPTIVE_MEMORY_THRESHOLDS[TIER]['context_window']
+MAX_TOKENS = ADAPTIVE_MEMORY_THRESHOLDS[TIER]['max_response_tokens']
+N_THREADS = detect_cpu_budget()['budget']
 
 def run_inference_for_prompt(llm, user_prompt):
     """
-    Runs a single inference for a given user prompt against the loaded Gemma model.
-    Uses a few-shot prompt to guide the model to give direct, non-conversational answers.
+    Runs a single inference for a given user prompt against the loaded Gemma model,
+    formatted exactly like a first turn in the deployment handler.
     """
-    # By providing a more detailed example, we can guide the model to produce
-    # more nuanced and comprehensive answers.
-    full_prompt = f"""<start_of_turn>user
-{SYSTEM_PROMPT}
-
-Explain the benefits of regular exercise.<end_of_turn>
-<start_of_turn>model
-Regular exercise offers a wide range of physical and mental health benefits. Here are two key examples:
-
-*   **Improved Cardiovascular Health:** Consistent physical activity strengthens the heart muscle, improves blood circulation, and can help lower blood pressure and cholesterol levels.
-*   **Enhanced Mental Well-being:** Exercise is a proven mood booster that can reduce symptoms of depression and anxiety by releasing endorphins and promoting better sleep.<end_of_turn>
-<start_of_turn>user
-{user_prompt}<end_of_turn>
-<start_of_turn>model"""
+    full_prompt = f"<start_of_turn>user\n{SYSTEM_PROMPT}\n\n{user_prompt.strip()}<end_of_turn>\n<start_of_turn>model"
 
     print("\n--- PROMPT SENT TO MODEL ---")
     print(full_prompt)
@@ -60,16 +60,15 @@ Regular exercise offers a wide range of physical and mental health benefits. Her
     # Generate the response
     print("\nGenerating raw response (this may take a moment)...")
 
-    # Using generation parameters from generate_deployment_response in the handler (high tier)
+    # Using generation parameters from _prepare_generation in the handler
     try:
         response = llm.create_completion(
             prompt=full_prompt,
-            max_tokens=2048,     # Matching 'high' tier in deployment handler
-            stop=["<end_of_turn>", "<|eot_id|>", "</s>"], # Stop tokens for Gemma
-            temperature=0.75,    # Increased for more creative and detailed responses
-            top_p=0.92,          # High-performance tier from handler
-            top_k=60,            # High-performance tier from handler
-            repeat_penalty=1.15, # Matching deployment handler
+            max_tokens=MAX_TOKENS,
+            stop=STOP_SEQUENCES,
+            **_sampling_parameters(TIER),
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
             stream=False,
             echo=False,
         )
@@ -151,14 +150,18 @@ def main():
             model_path=MODEL_PATH,
             n_ctx=CONTEXT_WINDOW,
             n_threads=N_THREADS,
+            n_threads_batch=N_THREADS,
             n_gpu_layers=0,       # CPU only
             verbose=False,
             
             # --- Performance settings from deployment handler ---
             use_mmap=True,        # Memory-map file
-            use_mlock=True,       # Lock memory for performance (fine for testing)
-            n_batch=512,          # Batch size for throughput (original test value)
+            use_mlock=False,      # Matching deployment handler
+            n_batch=OptimizedLlamaModel._n_batch_for_tier(TIER),
             last_n_tokens_size=128, # Smaller token buffer for Gemma (from handler)
+            numa=False,
+            offload_kqv=False,
+            flash_attn=False,
             
             # --- Gemma-specific settings from deployment handler ---
             rope_scaling_type=0,  # No rope scaling
@@ -174,34 +177,7 @@ def main():
 
     # 3. Define test prompts focused on list formatting and markdown structure
     
-    markdown_focused_test_prompts = [
-        # Test numbered lists with titles
-        "Suggest ways to improve communication and conflict resolution skills in relationships.",
-        
-        # Test bullet points with titles  
-        "List pros and cons of drinking coffee.",
-        
-        # Test mixed content with lists
-        "Suggest ways nature can be used for healing and stress reduction.",
-        
-        # Test home organization (from your screenshot)
-        "Suggest routines for maintaining home organization (daily, weekly, seasonal).",
-        
-        # Test health-related lists
-        "Suggest ways to adopt an anti-inflammatory or longevity-focused lifestyle.",
-        
-        # Test activity suggestions
-        "Suggest resources for learning Aikido or Hapkido.",
-        
-        # Test adventure activities
-        "Can you please tell me about 🧗‍♀️ Adventure Activities in regard to 🌍 Travel, Nature, and Adventure? Please explain this to me in detail.",
-        
-        # Test simple lists to see basic formatting
-        "List three primary colors using numbered list format.",
-        
-        # Test code formatting
-        "Write hello world in Python with proper code formatting."
-    ]
+    markdown_focused_test_prompts = BENCHMARK_PROMPTS
 
     print(f"\nTesting Gemma 3 1B with {len(markdown_focused_test_prompts)} prompts focused on markdown formatting...")
     print("=" * 80)
@@ -21,6 +21,19 @@ class AiChatConfig(AppConfig):
         # The 'RENDER' environment variable is a reliable way to check if we are in the Render deployment environment.
         is_running_server = 'runserver' in sys.argv or 'gunicorn' in sys.argv[0]
         
+        # With an out-of-process inference worker the web processes never load the GGUF
+        from django.conf import settings
+        if getattr(settings, 'AI_INFERENCE_WORKER_ADDRESS', None):
+            logger.info("AI CHAT APP: Inference worker configured, skipping in-process model initialization.")
+            return
+
+        # Multi-worker mode: each gunicorn worker loads its own context (gunicorn.conf.py
+        # post_worker_init); here we only pull the shared weights into the page cache.
+        if getattr(settings, 'AI_MODEL_PER_WORKER', False) and 'gunicorn' in sys.argv[0]:
+            from . import llm_handler_deployment
+            llm_handler_deployment.prefetch_model_weights()
+            return
+
         if is_running_server or os.environ.get('RENDER'):
             logger.info("AI CHAT APP: Server starting, beginning AI model initialization...")
             try:
@@ -0,0 +1,357 @@
+# async_views.py - ASGI variants of the chat endpoints
+# Served under /api/ai/async/ when the app runs on an ASGI server (see gunicorn.conf.py).
+# The event loop never blocks on the model: generations are handed to a small dedicated
+# executor that waits on the InferenceScheduler (or the inference worker socket), and
+# the Chat rows are written through Django's async ORM methods. DRF has no async
+# views, so these are plain Django views returning JsonResponse. A client disconnect
+# cancels the view (backend.asgi.cancel_on_disconnect), which cancels its generation.
+
+import asyncio
+import json
+import logging
+import math
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection as db_connection
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .models import Chat
+from .serializers import ChatSerializer
+from .llm_handler_deployment import (
+    QUEUE_MAX_DEPTH,
+    generate_chat_response,
+    stream_chat_response,
+    continue_chat_response,
+    get_queue_status,
+    cancel_chat_generation,
+    owns_session,
+    GenerationCancelled,
+    ContinuationUnavailable,
+    InferenceOverloaded,
+    InferenceQueueFull,
+    truncation_fields,
+)
+
+logger = logging.getLogger(__name__)
+
+# Every queued or running generation parks one thread here; admission control caps
+# those at QUEUE_MAX_DEPTH + 1, and the rest is headroom for status/cancel calls.
+_llm_executor = ThreadPoolExecutor(max_workers=QUEUE_MAX_DEPTH + 5, thread_name_prefix='llm-offload')
+
+_jwt_auth = JWTAuthentication()
+
+
+def _offloaded(func, *args):
+    """Run a blocking llama/ORM call on the executor thread and drop its DB connection afterwards"""
+    try:
+        return func(*args)
+    finally:
+        db_connection.close()
+
+
+async def run_in_llm_executor(func, *args):
+    """Await a blocking handler call without tying up the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_llm_executor, _offloaded, func, *args)
+
+
+# --- Request helpers --- #
+
+async def _authenticate(request):
+    """Return (user or None, error_response). Bearer JWT only; no header means guest."""
+    try:
+        result = await sync_to_async(_jwt_auth.authenticate)(request)
+    except (InvalidToken, AuthenticationFailed) as e:
+        return None, JsonResponse(e.detail if isinstance(e.detail, dict) else {'detail': e.detail}, status=401)
+    return (result[0] if result else None), None
+
+
+def _session_token(request, data=None):
+    """Mirror of views._session_token: the X-Chat-Session-Token header, else the body's session_token"""
+    token = request.META.get('HTTP_X_CHAT_SESSION_TOKEN')
+    if not token and isinstance(data, dict):
+        token = data.get('session_token')
+    return token or None
+
+
+def _parse_message_body(request):
+    """Mirror of views._parse_message_request for a raw JSON body.
+
+    Returns (message_text, session_id, model_mode, error_response).
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return None, None, None, JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+
+    message_text = data.get('message', '')
+    session_id = data.get('chat_session', None)
+    model_mode = data.get('model_mode', 'default')
+
+    if not message_text:
+        return message_text, session_id, model_mode, JsonResponse({'error': 'Message is required.'}, status=400)
+    if not session_id:
+        return message_text, session_id, model_mode, JsonResponse({'error': 'Chat session ID is required.'}, status=400)
+    return message_text, session_id, model_mode, None
+
+
+async def _asave_chat_exchange(user, session_id, message_text, ai_response_text, model_mode):
+    """Async-ORM twin of views._save_chat_exchange; returns the serialized chat."""
+    if user and user.is_authenticated:
+        title = None
+        is_first_message = not await Chat.objects.filter(user=user, chat_session=session_id).aexists()
+        if is_first_message:
+            title = message_text[:50] + ('...' if len(message_text) > 50 else '')
+
+        chat_instance = await Chat.objects.acreate(
+            user=user,
+            chat_session=session_id,
+            message=message_text,
+            response=ai_response_text,
+            title=title if is_first_message else None,
+            model_mode=model_mode,
+        )
+        if is_first_message and title:
+            await Chat.objects.filter(user=user, chat_session=session_id, title__isnull=True).aupdate(title=title)
+        return ChatSerializer(chat_instance).data
+
+    # Guests get the same shape without a row
+    return {
+        'id': None,
+        'message': message_text,
+        'response': ai_response_text,
+        'created_at': datetime.now(),
+        'chat_session': session_id,
+        'timestamp': datetime.now().isoformat(),
+        'user': None,
+        'title': None,
+    }
+
+
+async def _aappend_chat_continuation(user, session_id, ai_response_text):
+    """Async-ORM twin of views._append_chat_continuation; returns the serialized chat."""
+    if user and user.is_authenticated:
+        chat_instance = await Chat.objects.filter(user=user, chat_session=session_id).order_by('-created_at').afirst()
+        if chat_instance is not None:
+            chat_instance.response = ai_response_text
+            await chat_instance.asave(update_fields=['response'])
+            return ChatSerializer(chat_instance).data
+
+    return {
+        'id': None,
+        'message': None,
+        'response': ai_response_text,
+        'created_at': datetime.now(),
+        'chat_session': session_id,
+        'timestamp': datetime.now().isoformat(),
+        'user': None,
+        'title': None,
+    }
+
+
+def _json(data, status=200, **kwargs):
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, **kwargs)
+
+
+def _retry_after(exc):
+    return max(int(math.ceil(exc.retry_after)), 1)
+
+
+def _overloaded_response(exc):
+    """Same contract as views._overloaded_response: 429 when full, 503 after waiting too long."""
+    retry_after = _retry_after(exc)
+    response = _json({'error': exc.message, 'retry_after': retry_after},
+                     status=429 if isinstance(exc, InferenceQueueFull) else 503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def async_endpoint(*methods):
+    """require_http_methods + csrf_exempt for coroutine views (Django 4.2's decorators are sync-only).
+
+    CSRF is skipped like DRF does for token auth: these views only accept Bearer JWTs.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+# --- Views --- #
+
+@async_endpoint('POST')
+async def async_send_message_view(request):
+    """Async SendMessageView: awaits the generation instead of holding a worker thread."""
+    user, error_response = await _authenticate(request)
+    if error_response is not None:
+        return error_response
+    message_text, session_id, model_mode, error_response = _parse_message_body(request)
+    if error_response is not None:
+        return error_response
+
+    try:
+        ai_response_text = await run_in_llm_executor(generate_chat_response, message_text, session_id, user, model_mode)
+        if ai_response_text.startswith("Error:") or ai_response_text.startswith("Sorry, I encountered an error"):
+            logger.error(f"LLM generation error for session {session_id}: {ai_response_text}")
+            return _json({'error': ai_response_text}, status=500)
+
+        chat = await _asave_chat_exchange(user, session_id, message_text, ai_response_text, model_mode)
+        return _json({**chat, **truncation_fields(ai_response_text)}, status=201)
+
+    except InferenceOverloaded as e:
+        logger.warning(f"Rejected chat message for session {session_id}: {e} (retry after {e.retry_after:.0f}s)")
+        return _overloaded_response(e)
+    except GenerationCancelled:
+        logger.info(f"Chat message for session {session_id} was cancelled before it finished")
+        return _json({'error': 'Generation cancelled.', 'cancelled': True}, status=409)
+    except asyncio.CancelledError:
+        # The client disconnected (see backend.asgi); stop decoding for nobody
+        await run_in_llm_executor(cancel_chat_generation, session_id)
+        raise
+    except Exception as e:
+        logger.error(f"Error processing chat message for session {session_id}: {e}", exc_info=True)
+        return _json({'error': 'An unexpected error occurred processing your message.'}, status=500)
+
+
+_STREAM_END = object()
+
+
+@async_endpoint('POST')
+async def async_stream_message_view(request):
+    """Async StreamMessageView: same SSE events, pulled off the executor one at a time."""
+    user, error_response = await _authenticate(request)
+    if error_response is not None:
+        return error_response
+    message_text, session_id, model_mode, error_response = _parse_message_body(request)
+    if error_response is not None:
+        return error_response
+
+    events = stream_chat_response(message_text, session_id, user, model_mode)
+
+    def next_event():
+        return next(events, _STREAM_END)
+
+    def close_events():
+        try:
+            events.close()  # Cancels the job if it is still running
+        except ValueError:
+            # A cancelled request can leave a next() running on another executor thread
+            cancel_chat_generation(session_id)
+
+    # Admission happens on the first event, so a full queue is still a plain 429/503
+    try:
+        first_event = await run_in_llm_executor(next_event)
+    except InferenceOverloaded as e:
+        logger.warning(f"Rejected streamed chat message for session {session_id}: {e}")
+        return _overloaded_response(e)
+
+    async def event_stream():
+        item = first_event
+        try:
+            while item is not _STREAM_END:
+                event, data = item
+                if event == 'queued':
+                    yield _sse_event('queued', data)
+                elif event == 'token':
+                    yield _sse_event('token', {'text': data})
+                elif event == 'error':
+                    logger.error(f"LLM streaming error for session {session_id}: {data}")
+                    yield _sse_event('error', {'error': data})
+                    return
+                elif event == 'cancelled':
+                    yield _sse_event('cancelled', {'cancelled': True})
+                    return
+                else:
+                    chat = await _asave_chat_exchange(user, session_id, message_text, data, model_mode)
+                    yield _sse_event('done', {**chat, **truncation_fields(data)})
+                item = await run_in_llm_executor(next_event)
+        except InferenceOverloaded as e:
+            yield _sse_event('error', {'error': e.message, 'retry_after': _retry_after(e)})
+        except Exception as e:
+            logger.error(f"Error streaming chat message for session {session_id}: {e}", exc_info=True)
+            yield _sse_event('error', {'error': 'An unexpected error occurred processing your message.'})
+        finally:
+            await run_in_llm_executor(close_events)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@async_endpoint('POST')
+async def async_continue_generation_view(request, session_id):
+    """Async continue_generation_view."""
+    user, error_response = await _authenticate(request)
+    if error_response is not None:
+        return error_response
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return _json({'error': 'Invalid JSON body.'}, status=400)
+    continuation_id = data.get('continuation') if isinstance(data, dict) else None
+    if isinstance(continuation_id, dict):
+        continuation_id = continuation_id.get('id')
+    if not continuation_id:
+        return _json({'error': 'Continuation ID is required.'}, status=400)
+
+    try:
+        ai_response_text = await run_in_llm_executor(continue_chat_response, session_id, continuation_id, user)
+        if ai_response_text.startswith("Error:") or ai_response_text.startswith("Sorry, I encountered an error"):
+            logger.error(f"LLM continuation error for session {session_id}: {ai_response_text}")
+            return _json({'error': ai_response_text}, status=500)
+
+        chat = await _aappend_chat_continuation(user, session_id, ai_response_text)
+        return _json({**chat, **truncation_fields(ai_response_text)})
+
+    except ContinuationUnavailable as e:
+        return _json({'error': str(e)}, status=404)
+    except InferenceOverloaded as e:
+        logger.warning(f"Rejected continuation for session {session_id}: {e} (retry after {e.retry_after:.0f}s)")
+        return _overloaded_response(e)
+    except GenerationCancelled:
+        logger.info(f"Continuation for session {session_id} was cancelled before it finished")
+        return _json({'error': 'Generation cancelled.', 'cancelled': True}, status=409)
+    except asyncio.CancelledError:
+        await run_in_llm_executor(cancel_chat_generation, session_id)
+        raise
+    except Exception as e:
+        logger.error(f"Error continuing chat message for session {session_id}: {e}", exc_info=True)
+        return _json({'error': 'An unexpected error occurred processing your message.'}, status=500)
+
+
+@async_endpoint('GET')
+async def async_queue_status_view(request, session_id):
+    """Async queue_status_view."""
+    return _json(await run_in_llm_executor(get_queue_status, session_id))
+
+
+@async_endpoint('POST')
+async def async_cancel_generation_view(request, session_id):
+    """Async cancel_generation_view."""
+    user, error_response = await _authenticate(request)
+    if error_response is not None:
+        return error_response
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        data = None
+    if not await sync_to_async(owns_session)(user, session_id, _session_token(request, data)):
+        return _json({'error': 'Chat session not found.'}, status=404)
+    cancelled = await run_in_llm_executor(cancel_chat_generation, session_id)
+    return _json({'cancelled': cancelled > 0, 'jobs': cancelled})
@@ -0,0 +1,247 @@
+# benchmark.py - Repeatable latency/throughput benchmark for the deployment handler
+# Drives the real request path (InferenceScheduler -> _prepare_generation -> llama.cpp)
+# over a fixed prompt corpus with the memory tier pinned, one tier at a time, and
+# returns a JSON-serializable report. Run it with `python manage.py benchmark_llm`.
+
+import math
+import os
+import platform
+import threading
+import time
+import uuid
+
+import psutil
+
+from .llm_handler_deployment import (
+    ADAPTIVE_MEMORY_THRESHOLDS,
+    InferenceJob,
+    InferenceScheduler,
+    OptimizedLlamaModel,
+    ResourceSampler,
+    clear_deployment_history,
+    stream_deployment_response,
+)
+
+# Fixed corpus: the markdown-heavy prompts from ai_model_test_by_itself.py
+BENCHMARK_PROMPTS = [
+    "Suggest ways to improve communication and conflict resolution skills in relationships.",
+    "List pros and cons of drinking coffee.",
+    "Suggest ways nature can be used for healing and stress reduction.",
+    "Suggest routines for maintaining home organization (daily, weekly, seasonal).",
+    "Suggest ways to adopt an anti-inflammatory or longevity-focused lifestyle.",
+    "Suggest resources for learning Aikido or Hapkido.",
+    "Can you please tell me about 🧗‍♀️ Adventure Activities in regard to 🌍 Travel, Nature, and Adventure? Please explain this to me in detail.",
+    "List three primary colors using numbered list format.",
+    "Write hello world in Python with proper code formatting.",
+]
+
+RSS_SAMPLE_INTERVAL_SECONDS = 0.05
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; None for an empty list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+class PeakRSSMonitor:
+    """Samples this process's RSS on a thread; `peak_mb` is the high-water mark since start()"""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.peak_mb = max(self.peak_mb, self._process.memory_info().rss / (1024**2))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name='benchmark-rss', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return self.peak_mb
+
+
+# === LLAMA.CPP PERF COUNTERS ===
+def _reset_perf_counters(llm):
+    import llama_cpp
+    ctx = llm._ctx.ctx
+    if hasattr(llama_cpp, 'llama_perf_context_reset'):
+        llama_cpp.llama_perf_context_reset(ctx)
+    elif hasattr(llama_cpp, 'llama_reset_timings'):  # llama-cpp-python < 0.3
+        llama_cpp.llama_reset_timings(ctx)
+
+
+def _read_perf_counters(llm):
+    """(prompt tokens, prompt ms, decoded tokens, decode ms) from llama.cpp, or None"""
+    import llama_cpp
+    ctx = llm._ctx.ctx
+    if hasattr(llama_cpp, 'llama_perf_context'):
+        data = llama_cpp.llama_perf_context(ctx)
+    elif hasattr(llama_cpp, 'llama_get_timings'):
+        data = llama_cpp.llama_get_timings(ctx)
+    else:
+        return None
+    return data.n_p_eval, data.t_p_eval_ms, data.n_eval, data.t_eval_ms
+
+
+def _perf(model, action):
+    try:
+        return action(model.llm)
+    except Exception:
+        return None  # Counters are best effort; wall-clock numbers are always reported
+
+
+# === RUNS ===
+def run_prompt(model, prompt):
+    """One uncached first-turn generation through the streaming path, with timings.
+
+    Runs without the generation deadline so every prompt decodes its whole answer.
+    """
+    _perf(model, _reset_perf_counters)
+    session = f"benchmark-{uuid.uuid4().hex}"
+    start_time = time.perf_counter()
+    first_token_at = None
+    chunks = 0
+    outcome = None
+    try:
+        for event, data in stream_deployment_response(prompt, session, use_cache=False, timed=False):
+            if event == 'token':
+                chunks += 1
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+            elif event in ('done', 'error', 'cancelled'):
+                outcome = event
+    finally:
+        clear_deployment_history(session)  # Every run is a cold first turn
+    end_time = time.perf_counter()
+
+    result = {
+        'prompt': prompt,
+        'outcome': outcome,
+        'ttft_seconds': (first_token_at - start_time) if first_token_at else None,
+        'latency_seconds': end_time - start_time,
+        'completion_tokens': chunks,  # llama.cpp streams one chunk per token
+        'prompt_tokens': None,
+        'prompt_eval_tokens_per_second': None,
+        'decode_tokens_per_second': None,
+    }
+
+    counters = _perf(model, _read_perf_counters)
+    if counters and counters[0]:
+        n_prompt, prompt_ms, n_decode, decode_ms = counters
+        result['prompt_tokens'] = n_prompt  # Tokens actually evaluated (prefix-state reuse excluded)
+        result['prompt_eval_tokens_per_second'] = n_prompt / (prompt_ms / 1000) if prompt_ms else None
+        result['decode_tokens_per_second'] = n_decode / (decode_ms / 1000) if decode_ms else None
+    elif first_token_at and chunks > 1:
+        # No counters: decode rate from the gaps after the first token
+        result['decode_tokens_per_second'] = (chunks - 1) / (end_time - first_token_at)
+    return result
+
+
+def _summarize(runs, peak_rss_mb):
+    ok = [run for run in runs if run['outcome'] == 'done']
+    ttft = [run['ttft_seconds'] for run in ok if run['ttft_seconds'] is not None]
+    latency = [run['latency_seconds'] for run in ok]
+    prompt_tps = [run['prompt_eval_tokens_per_second'] for run in ok if run['prompt_eval_tokens_per_second']]
+    decode_tps = [run['decode_tokens_per_second'] for run in ok if run['decode_tokens_per_second']]
+    return {
+        'runs': len(runs),
+        'failed': len(runs) - len(ok),
+        'prompt_eval_tokens_per_second': _mean(prompt_tps),
+        'decode_tokens_per_second': _mean(decode_tps),
+        'ttft_p50_seconds': percentile(ttft, 50),
+        'ttft_p95_seconds': percentile(ttft, 95),
+        'latency_p50_seconds': percentile(latency, 50),
+        'latency_p95_seconds': percentile(latency, 95),
+        'completion_tokens_mean': _mean([run['completion_tokens'] for run in ok]),
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def _apply_tier(job, model):
+    model._check_and_adjust_parameters(force=True)
+
+
+def run_tier(model, tier, prompts, repeat=1, warmup=1):
+    """Pin `tier`, apply it (rebuilding the context if needed) and time every prompt"""
+    ResourceSampler.force_tier(tier)
+    # A context rebuild must run on the decode thread, between generations
+    InferenceScheduler().submit(InferenceJob(_apply_tier, (model,))).finished.wait()
+
+    for prompt in prompts[:warmup]:
+        run_prompt(model, prompt)  # First run pays for page faults and allocator growth
+
+    monitor = PeakRSSMonitor().start()
+    runs = []
+    try:
+        for _ in range(repeat):
+            for prompt in prompts:
+                runs.append(run_prompt(model, prompt))
+    finally:
+        peak_rss_mb = monitor.stop()
+
+    return {
+        'model': model.model_filename,  # The router may load a smaller quantization on low tiers
+        'n_ctx': model.n_ctx() if model.llm is not None else model.context_window,
+        'n_batch': model.n_batch,
+        'max_response_tokens': model.max_response_tokens,
+        'summary': _summarize(runs, peak_rss_mb),
+        'runs': runs,
+    }
+
+
+def run_benchmark(tiers=None, prompts=None, repeat=1, warmup=1):
+    """Benchmark each tier in turn; returns the full JSON-serializable report"""
+    tiers = list(tiers or ADAPTIVE_MEMORY_THRESHOLDS)
+    prompts = list(prompts or BENCHMARK_PROMPTS)
+    model = OptimizedLlamaModel()
+    # Always in-process, even when AI_INFERENCE_WORKER_ADDRESS points elsewhere
+    if not model.is_initialized() and not model.initialize_model():
+        raise RuntimeError("Model failed to load; nothing to benchmark")
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'model': model.model_filename,
+        'cpu_budget': model.cpu_budget,
+        'prompts': len(prompts),
+        'repeat': repeat,
+        'warmup': warmup,
+        'tiers': {},
+    }
+    try:
+        for tier in tiers:
+            report['tiers'][tier] = run_tier(model, tier, prompts, repeat, warmup)
+    finally:
+        ResourceSampler.force_tier(None)
+
+    # Thread counts are only final once the first load has autotuned them
+    report['n_threads'] = model.n_threads
+    report['n_threads_batch'] = model.n_threads_batch
+    report['speculative_decoding'] = model.speculation.stats()
+    report['peak_rss_mb'] = max((t['summary']['peak_rss_mb'] for t in report['tiers'].values()), default=None)
+    return report
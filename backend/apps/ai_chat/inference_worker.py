@@ -0,0 +1,208 @@
+# inference_worker.py - Out-of-process owner of the OptimizedLlamaModel
+# The web workers stay small: they forward chat jobs over a local socket to a single
+# inference process, which loads the GGUF once and runs the jobs through the usual
+# llm_handler_deployment code path. Enabled by setting AI_INFERENCE_WORKER_ADDRESS.
+
+import logging
+import os
+import threading
+from multiprocessing.connection import Client, Listener
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection as db_connection
+
+logger = logging.getLogger(__name__)
+
+# Set inside the worker process so the compatibility wrappers run jobs locally
+_IS_WORKER_PROCESS = False
+
+# Placeholder secrets from settings.py / .env.example; never accepted as the authkey
+_INSECURE_AUTHKEYS = {'', 'your-default-secret-key-for-dev', 'your-django-secret-key-here', 'generate-a-long-random-secret'}
+
+
+
+class InferenceWorkerUnavailable(Exception):
+    """Raised when the inference worker cannot be reached."""
+
+
+def _worker_address():
+    return getattr(settings, 'AI_INFERENCE_WORKER_ADDRESS', None)
+
+
+def _worker_authkey():
+    """Shared secret for the worker socket.
+
+    Both ends unpickle what they receive, so anyone holding the key can run code
+    in the other process. It is deliberately separate from SECRET_KEY, and a
+    missing or placeholder key stops both the worker and its clients.
+    """
+    authkey = getattr(settings, 'AI_INFERENCE_WORKER_AUTHKEY', None) or ''
+    if authkey in _INSECURE_AUTHKEYS or authkey == settings.SECRET_KEY:
+        raise ImproperlyConfigured(
+            "AI_INFERENCE_WORKER_AUTHKEY must be set to a long random secret (not SECRET_KEY) "
+            "when AI_INFERENCE_WORKER_ADDRESS is used.")
+    return authkey.encode('utf-8')
+
+
+def _address_family(address):
+    return 'AF_INET' if isinstance(address, tuple) else 'AF_UNIX'
+
+
+def get_worker_client():
+    """Return a client for the inference worker, or None when jobs should run in-process"""
+    address = _worker_address()
+    if not address or _IS_WORKER_PROCESS:
+        return None
+    return InferenceWorkerClient(address, _worker_authkey())
+
+
+# === CLIENT (used by the Django web workers) ===
+class InferenceWorkerClient:
+    """Sends jobs to the inference worker and waits for their results."""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    def _connect(self):
+        try:
+            return Client(self.address, family=_address_family(self.address), authkey=self.authkey)
+        except (OSError, EOFError) as e:
+            raise InferenceWorkerUnavailable(f"Inference worker at {self.address} is unreachable: {e}")
+
+    def call(self, op, *args, **kwargs):
+        """Run a job to completion and return its result"""
+        conn = self._connect()
+        try:
+            conn.send((op, args, kwargs))
+            kind, payload = conn.recv()
+        except (OSError, EOFError) as e:
+            raise InferenceWorkerUnavailable(f"Inference worker connection lost: {e}")
+        finally:
+            conn.close()
+
+        if kind == 'error':
+            raise payload
+        return payload
+
+    def stream(self, op, *args, **kwargs):
+        """Run a streaming job, yielding its events as the worker produces them"""
+        conn = self._connect()
+        try:
+            conn.send((op, args, kwargs))
+            while True:
+                kind, payload = conn.recv()
+                if kind == 'event':
+                    yield payload
+                elif kind == 'error':
+                    raise payload
+                else:
+                    return
+        except (OSError, EOFError) as e:
+            raise InferenceWorkerUnavailable(f"Inference worker connection lost: {e}")
+        finally:
+            # Closing early (client went away) tells the worker to stop sending
+            conn.close()
+
+
+# === SERVER (the dedicated inference process) ===
+class InferenceWorker:
+    """Accepts jobs from web workers and hands them to the model's InferenceScheduler.
+
+    Each connection gets its own thread; generation jobs are queued and run
+    one at a time by the scheduler, so cheap status calls never wait behind them.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    def _operations(self):
+        from . import llm_handler_deployment as handler
+        return {
+            'generate': handler.generate_deployment_response,
+            'stream': handler.stream_deployment_response,
+            'continue': handler.continue_deployment_response,
+            'clear_history': handler.clear_deployment_history,
+            'status': handler.get_deployment_status,
+            'metrics': handler.get_deployment_metrics,
+            'queue_status': handler.get_queue_status,
+            'cancel': handler.cancel_deployment_generation,
+            'initialize': handler.initialize_model,
+            'is_initialized': handler.is_model_initialized,
+            'initialization_status': lambda: dict(handler.initialization_status),
+        }
+
+    def serve_forever(self):
+        global _IS_WORKER_PROCESS
+        _IS_WORKER_PROCESS = True
+
+        from . import llm_handler_deployment as handler
+        operations = self._operations()
+
+        if _address_family(self.address) == 'AF_UNIX' and os.path.exists(self.address):
+            os.unlink(self.address)  # Stale socket from a previous run
+
+        logger.info("INFERENCE WORKER: Loading model before accepting jobs...")
+        handler.initialize_model()
+
+
+        with Listener(self.address, family=_address_family(self.address), authkey=self.authkey) as listener:
+            if _address_family(self.address) == 'AF_UNIX':
+                os.chmod(self.address, 0o600)  # Only this user's processes may even attempt the handshake
+            logger.info(f"INFERENCE WORKER: Listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # Bad authkey or a client that hung up during the handshake
+                    logger.warning(f"INFERENCE WORKER: Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn, operations), daemon=True).start()
+
+    def _serve_connection(self, conn, operations):
+        """Read one request off a connection and answer it"""
+        try:
+            op, args, kwargs = conn.recv()
+        except (OSError, EOFError):
+            conn.close()
+            return
+        try:
+            self._run_job(conn, operations, op, args, kwargs)
+        finally:
+            conn.close()
+            # Jobs may touch the ORM (history rehydration); don't leave the thread's DB connection open
+            db_connection.close()
+
+    def _run_job(self, conn, operations, op, args, kwargs):
+        func = operations.get(op)
+        try:
+            if func is None:
+                raise ValueError(f"Unknown inference worker operation: {op}")
+            if op == 'stream':
+                events = func(*args, **kwargs)
+                try:
+                    for event in events:
+                        conn.send(('event', event))
+                    conn.send(('end', None))
+                finally:
+                    events.close()  # A client that hung up cancels its generation
+            else:
+                conn.send(('result', func(*args, **kwargs)))
+        except (OSError, EOFError):
+            logger.info(f"INFERENCE WORKER: Client disconnected during '{op}' job")
+        except Exception as e:
+            logger.error(f"INFERENCE WORKER: '{op}' job failed: {e}", exc_info=True)
+            try:
+                conn.send(('error', e))
+            except (OSError, EOFError):
+                pass
+            except Exception:
+                # Exception types that don't pickle cleanly are sent as plain RuntimeErrors
+                conn.send(('error', RuntimeError(str(e))))
+
+
+def run_worker(address=None):
+    """Entry point used by the run_inference_worker management command"""
+    InferenceWorker(address or _worker_address(), _worker_authkey()).serve_forever()
@@ -1,14 +1,18 @@
 # llm_handler_deployment.py - OPTIMIZED for LOW-RESOURCE (1 CPU + 2GB RAM) deployment
 # Production-ready version optimized for low-spec hardware
 # Key optimizations:
-# 1. Single-threaded operation (1 core)
+# 1. Thread counts sized to the container's real CPU budget (affinity + cgroup quota)
 # 2. Reduced context window and response capabilities for low memory
 # 3. Intelligent memory management for 2GB system
-# 4. Disabled caching to conserve memory
+# 4. Per-session KV cache bounded by the memory tier
+#    (plus a system-prompt prefix state persisted across restarts)
 # 5. Adaptive scaling based on actual limited resources
+#    (multi-worker mode shares the mmapped weights through the page cache)
 # 6. UPGRADED TO GEMMA 3 1B MODEL
+# 7. Concurrent chat sessions decoded together in one multi-sequence llama batch
 
 import os
+import codecs
 import threading
 import logging
 import traceback
@@ -17,6 +21,14 @@ import gc
 import time
 from contextlib import contextmanager
 import re
+import queue
+import hashlib
+import pickle
+import uuid
+from array import array
+from collections import OrderedDict, deque, namedtuple
+
+from . import metrics
 
 try:
     from llama_cpp import LlamaRAMCache
@@ -25,6 +37,22 @@ except ImportError:
     LlamaRAMCache = None
     LLAMA_CACHE_AVAILABLE = False
 
+try:
+    from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+    SPECULATIVE_AVAILABLE = True
+except ImportError:
+    LlamaDraftModel = LlamaPromptLookupDecoding = object
+    SPECULATIVE_AVAILABLE = False
+
+try:
+    from llama_cpp import llama_cpp as llama_lowlevel
+    from llama_cpp._internals import LlamaBatch, LlamaContext, LlamaSampler
+    # The llama_memory_* API (0.3.10+) is what frees one sequence's cells mid-batch
+    BATCHED_DECODING_AVAILABLE = hasattr(llama_lowlevel, 'llama_memory_seq_rm')
+except ImportError:
+    llama_lowlevel = LlamaBatch = LlamaContext = LlamaSampler = None
+    BATCHED_DECODING_AVAILABLE = False
+
 # === OPTIMIZED DEPLOYMENT CONSTRAINTS FOR 1 CPU / 2GB RAM ===
 CPU_THRESHOLD = 90          # Higher threshold for single core
 MEMORY_THRESHOLD = 85       # Higher threshold for 2GB system
@@ -35,6 +63,8 @@ SIMULATED_TOTAL_RAM_GB = 2.0 # Hard cap for memory calculations to simulate a 2G
 # Base parameters re-balanced for response completeness.
 BASE_CONTEXT_WINDOW = 4096  # Reduced base context
 BASE_MAX_RESPONSE_TOKENS = 1536 # Increased base response tokens to prioritize complete answers
+MIN_RESPONSE_TOKENS = 256   # Oversized prompts are trimmed before the response budget drops below this
+TURN_WRAPPER_TOKENS = 8     # Upper bound on the template tokens around one message
 
 # Adaptive parameters based on available memory for Gemma 3 1B on a 2GB system.
 # These have been re-balanced to prioritize response completeness over long-term context.
@@ -43,30 +73,104 @@ ADAPTIVE_MEMORY_THRESHOLDS = {
         'context_window': 1536,
         'max_response_tokens': 768, # Increased
         'max_history': 2,
-        'n_threads': 1
+        'kv_cache_mb': 0,  # No room to keep KV snapshots around
+        'generation_deadline_seconds': 60,  # Free the core sooner in emergency mode
+        'speculative_tokens': 0,  # Drafting off on every tier, see SPECULATIVE_DECODING
+        'speculative_draft_model': False,
+        'batch_sequences': 1  # Sessions decoded together per llama_decode (1: one at a time)
     },
     'low': {     # 250-500MB available
         'context_window': 2560,
         'max_response_tokens': 1280, # Increased
         'max_history': 4,
-        'n_threads': 1
+        'kv_cache_mb': 32,
+        'generation_deadline_seconds': None,  # None: AI_GENERATION_DEADLINE_SECONDS
+        'speculative_tokens': 0,
+        'speculative_draft_model': False,
+        'batch_sequences': 1
     },
     'medium': {  # 500-750MB available
         'context_window': 3072,
         'max_response_tokens': 1536, # Increased
         'max_history': 6,
-        'n_threads': 1
+        'kv_cache_mb': 96,
+        'generation_deadline_seconds': None,
+        'speculative_tokens': 0,
+        'speculative_draft_model': False,
+        'batch_sequences': 2
     },
     'high': {    # > 750MB available
         'context_window': 4096,
         'max_response_tokens': 2048, # Increased
         'max_history': 8,
-        'n_threads': 1
+        'kv_cache_mb': 192,
+        'generation_deadline_seconds': None,
+        'speculative_tokens': 0,
+        'speculative_draft_model': False,  # True: draft with AI_DRAFT_MODEL_PATH instead of prompt lookup
+        'batch_sequences': 4
     }
 }
 
+# Rebuilding the llama context for a new tier is rate-limited to avoid thrashing;
+# only a shrink under critical memory pressure may bypass the interval
+CONTEXT_REBUILD_MIN_INTERVAL_SECONDS = 300
+
+# Admission control for the inference queue (overridable via AI_QUEUE_* settings)
+DEFAULT_QUEUE_MAX_DEPTH = 4            # Jobs allowed to wait behind the running one
+DEFAULT_QUEUE_MAX_WAIT_SECONDS = 120   # A job not started within this is withdrawn
+DEFAULT_JOB_SECONDS_ESTIMATE = 30      # Retry-After basis until real job durations are known
+
+# Wall-clock budget per generation, counted from submission so queue wait is included
+# (AI_GENERATION_DEADLINE_SECONDS, overridable per tier; 0 disables it). A job that
+# starts late still gets a little decoding time. Cut-off answers keep a continuation.
+DEFAULT_GENERATION_DEADLINE_SECONDS = 90
+GENERATION_MIN_DECODE_SECONDS = 10
+CONTINUATION_MAX_SESSIONS = 64
+CONTINUATION_TTL_SECONDS = 900
+
+# Continuous batching (AI_BATCH_MAX_SEQUENCES, capped by the tier's batch_sequences):
+# queued chat jobs share each llama_decode in a second context over the same mapped
+# weights, with one KV sequence of context_window tokens per session. Gemma 3 keeps
+# full-length KV only on its global-attention layers, so 4 x 4096 tokens costs
+# ~90MB on top of the single-sequence context.
+DEFAULT_BATCH_MAX_SEQUENCES = 4
+BATCH_PENALTY_LAST_N = 128  # Repeat-penalty window, as the Llama's last_n_tokens_size
+
+# Startup thread microbenchmark (skipped on a single-CPU budget)
+THREAD_BENCHMARK_PROMPT_TOKENS = 64
+THREAD_BENCHMARK_DECODE_TOKENS = 8
+
 SWAP_THRESHOLD_GB = 0.0     # No swap configured
-GC_FREQUENCY = 5           # More frequent GC for low memory
+GC_FREQUENCY = 5           # Young-generation collection at least every N generations
+GC_YOUNG_ALLOCATION_THRESHOLD = 20000  # ...or once this many gen-0 allocations are pending
+GC_YOUNG_INTERVAL_SECONDS = 60         # ...or when this long has passed since the last one
+GC_FULL_MIN_INTERVAL_SECONDS = 10      # Full collections (high/critical pressure only) are rate-limited
+
+# Bounds for the in-memory conversation history store
+HISTORY_MAX_SESSIONS = 200          # Sessions kept before LRU eviction
+HISTORY_IDLE_TTL_SECONDS = 3600     # Sessions idle longer than this are dropped
+HISTORY_MAX_BYTES = 8 * 1024 * 1024 # Total budget for stored message text and cached token IDs
+HISTORY_MESSAGE_OVERHEAD_BYTES = 200 # Rough per-message cost of the dict itself
+
+# Rolling summaries: once a session's stored turns cost more than the trigger (a fraction
+# of the tier's prompt budget unless AI_HISTORY_SUMMARY_TRIGGER_TOKENS is set), or exceed
+# the tier's max_history, the older turns are folded into one "memory" note in the background
+HISTORY_SUMMARY_TRIGGER_FRACTION = 0.6
+HISTORY_SUMMARY_KEEP_MESSAGES = 4       # Newest messages always kept verbatim (capped at max_history)
+HISTORY_SUMMARY_MAX_TOKENS = 192        # Length cap of the memory note itself
+HISTORY_UNSUMMARIZED_LIMIT_FACTOR = 4   # Hard trim at max_history * this if summaries fall behind
+HISTORY_SUMMARY_INSTRUCTION = (
+    "Summarize our conversation so far in one short paragraph, written as notes for yourself. "
+    "Keep names, facts, preferences, decisions and open questions; leave out greetings and filler."
+)
+
+# Fraction of the history budgets (bytes and idle TTL) allowed at each memory pressure level
+HISTORY_PRESSURE_SCALE = {
+    'low': 1.0,
+    'medium': 0.5,
+    'high': 0.25,
+    'critical': 0.1
+}
 
 # Optimized memory pressure levels for 2GB system
 MEMORY_PRESSURE_LEVELS = {
@@ -76,39 +180,101 @@ MEMORY_PRESSURE_LEVELS = {
     'critical': 95  # 1.9GB used
 }
 
+# === MODEL FILES ===
+MODEL_FILENAME = "gemma-3-1b-it-Q8_0.gguf"
+
+# Quantizations of the same Gemma 3 1B checkpoint that may sit in ai_model/, best quality
+# first. They share one tokenizer and chat template, so history token IDs stay valid across
+# a switch. weights_mb is the approximate GGUF size (the real size is read from disk);
+# relative_speed is rough single-core decode speed against Q8_0; min_tier is the lowest
+# memory tier the router will run a variant on.
+MODEL_VARIANTS = {
+    'Q8_0': {'filename': MODEL_FILENAME, 'weights_mb': 1070, 'relative_speed': 1.0, 'min_tier': 'medium'},
+    'Q4_K_M': {'filename': "gemma-3-1b-it-Q4_K_M.gguf", 'weights_mb': 806, 'relative_speed': 1.3, 'min_tier': 'low'},
+    'Q4_0': {'filename': "gemma-3-1b-it-Q4_0.gguf", 'weights_mb': 720, 'relative_speed': 1.5, 'min_tier': 'minimal'},
+}
+MEMORY_TIER_ORDER = ['minimal', 'low', 'medium', 'high']
+MODEL_PREFETCH_CHUNK_BYTES = 8 * 1024 * 1024
+
+# === PROMPT FORMAT (GEMMA 3) ===
+# Per official Google guidance, system prompts are included in the first user turn.
+SYSTEM_PROMPT = "You are a balanced, grounded, helpful, creative, and insightful AI assistant. Your purpose is to provide friendly, conversational, and genuinely helpful responses. Strive to understand the user's intent, even if the query is ambiguous. Your goal is to be a thoughtful and engaging conversation partner."
+STOP_SEQUENCES = ["<end_of_turn>", "<|eot_id|>", "\x07"]
+
 # === PATH CONFIGURATION ===
 try:
     from django.conf import settings
     BASE_DIR = settings.BASE_DIR
+    DRAFT_MODEL_PATH = getattr(settings, 'AI_DRAFT_MODEL_PATH', None)
+    THREADS_OVERRIDE = getattr(settings, 'AI_LLM_N_THREADS', None)
+    THREADS_BATCH_OVERRIDE = getattr(settings, 'AI_LLM_N_THREADS_BATCH', None)
+    THREAD_BENCHMARK_ENABLED = getattr(settings, 'AI_LLM_THREAD_BENCHMARK', True)
+    QUEUE_MAX_DEPTH = getattr(settings, 'AI_QUEUE_MAX_DEPTH', DEFAULT_QUEUE_MAX_DEPTH)
+    QUEUE_MAX_WAIT_SECONDS = getattr(settings, 'AI_QUEUE_MAX_WAIT_SECONDS', DEFAULT_QUEUE_MAX_WAIT_SECONDS)
+    HISTORY_SUMMARY_ENABLED = getattr(settings, 'AI_HISTORY_SUMMARIES', True)
+    HISTORY_SUMMARY_TRIGGER_TOKENS = getattr(settings, 'AI_HISTORY_SUMMARY_TRIGGER_TOKENS', None)
+    MODEL_VARIANT_PIN = getattr(settings, 'AI_MODEL_VARIANT', None)
+    GENERATION_DEADLINE_SECONDS = getattr(settings, 'AI_GENERATION_DEADLINE_SECONDS', DEFAULT_GENERATION_DEADLINE_SECONDS)
+    BATCH_MAX_SEQUENCES = getattr(settings, 'AI_BATCH_MAX_SEQUENCES', DEFAULT_BATCH_MAX_SEQUENCES)
 except (ImportError, Exception):
     # Fallback: Calculate BASE_DIR relative to this file
     # This file is in backend/apps/ai_chat/llm_handler_deployment.py
     # So BASE_DIR should be backend/
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    DRAFT_MODEL_PATH = os.environ.get('AI_DRAFT_MODEL_PATH')
+    THREADS_OVERRIDE = THREADS_BATCH_OVERRIDE = None
+    THREAD_BENCHMARK_ENABLED = True
+    QUEUE_MAX_DEPTH = DEFAULT_QUEUE_MAX_DEPTH
+    QUEUE_MAX_WAIT_SECONDS = DEFAULT_QUEUE_MAX_WAIT_SECONDS
+    HISTORY_SUMMARY_ENABLED = True
+    HISTORY_SUMMARY_TRIGGER_TOKENS = None
+    MODEL_VARIANT_PIN = os.environ.get('AI_MODEL_VARIANT') or None
+    GENERATION_DEADLINE_SECONDS = DEFAULT_GENERATION_DEADLINE_SECONDS
+    BATCH_MAX_SEQUENCES = DEFAULT_BATCH_MAX_SEQUENCES
+
+# Evaluated system-prompt prefix states, reused across worker restarts
+PREFIX_STATE_DIR = os.path.join(BASE_DIR, "ai_model", "prefix_state")
+MODEL_FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
 
 logger = logging.getLogger(__name__)
 if not logger.hasHandlers():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# === OPTIMIZED MEMORY MANAGER ===
-class OptimizedMemoryManager:
-    """Intelligent memory management optimized for 2GB system"""
-    
-    @staticmethod
-    def get_memory_pressure():
-        """Get memory pressure, simulating a 2GB system if on a larger machine."""
-        mem = psutil.virtual_memory()
-        total_physical_gb = mem.total / (1024**3)
+# === BACKGROUND RESOURCE SAMPLER ===
+RESOURCE_SAMPLE_INTERVAL_SECONDS = 2.0  # Cadence of the background psutil sampler
 
-        # If running on a machine with more RAM, calculate pressure against the simulated total
-        if total_physical_gb > SIMULATED_TOTAL_RAM_GB:
-            used_physical_gb = mem.used / (1024**3)
-            # Cap "used" memory at simulated total for a realistic percentage
-            used_for_calc = min(used_physical_gb, SIMULATED_TOTAL_RAM_GB)
-            percent = (used_for_calc / SIMULATED_TOTAL_RAM_GB) * 100 if SIMULATED_TOTAL_RAM_GB > 0 else 100
-        else:
-            percent = mem.percent
-        
+# Immutable view of system resources; callers read the latest one instead of probing psutil
+ResourceSnapshot = namedtuple('ResourceSnapshot', [
+    'timestamp',
+    'total_gb',
+    'used_gb',
+    'physical_available_gb',  # What the OS reports
+    'available_gb',           # Within the simulated 2GB cap
+    'memory_percent',         # Within the simulated 2GB cap
+    'pressure',
+    'tier',
+    'swap_used_gb',
+    'cpu_count',
+    'cpu_percent',
+    'load_avg',
+    'process_rss_mb'
+])
+
+class ResourceSampler:
+    """Daemon thread that samples psutil at a fixed cadence and publishes a ResourceSnapshot.
+
+    The hot path only reads `ResourceSampler.snapshot()`, an attribute lookup
+    with no syscalls. The thread is (re)started lazily, including after fork.
+    """
+    _snapshot = None
+    _thread = None
+    _pid = None
+    _lock = threading.Lock()
+    _process = None
+    forced_tier = None  # Pinned by the benchmark harness; None follows available memory
+
+    @staticmethod
+    def _classify_pressure(percent):
         if percent >= MEMORY_PRESSURE_LEVELS['critical']:
             return 'critical'
         elif percent >= MEMORY_PRESSURE_LEVELS['high']:
@@ -117,6 +283,143 @@ class OptimizedMemoryManager:
             return 'medium'
         else:
             return 'low'
+
+    @staticmethod
+    def _classify_tier(available_mb):
+        # Thresholds for 2GB system
+        if available_mb < 250:
+            return 'minimal'
+        elif available_mb < 500:
+            return 'low'
+        elif available_mb < 750:
+            return 'medium'
+        else:
+            return 'high'
+
+    @classmethod
+    def _sample(cls):
+        mem = psutil.virtual_memory()
+        total_gb = mem.total / (1024**3)
+        used_gb = mem.used / (1024**3)
+
+        # If running on a machine with more RAM, calculate against the simulated 2GB total
+        if total_gb > SIMULATED_TOTAL_RAM_GB:
+            available_gb = max(0, SIMULATED_TOTAL_RAM_GB - used_gb)
+            # Cap "used" memory at simulated total for a realistic percentage
+            used_for_calc = min(used_gb, SIMULATED_TOTAL_RAM_GB)
+            percent = (used_for_calc / SIMULATED_TOTAL_RAM_GB) * 100 if SIMULATED_TOTAL_RAM_GB > 0 else 100
+        else:
+            available_gb = mem.available / (1024**3)
+            percent = mem.percent
+
+        try:
+            swap_used_gb = psutil.swap_memory().used / (1024**3)
+        except Exception:
+            swap_used_gb = 0
+
+        if cls._process is None or cls._process.pid != os.getpid():
+            cls._process = psutil.Process()
+
+        return ResourceSnapshot(
+            timestamp=time.time(),
+            total_gb=total_gb,
+            used_gb=used_gb,
+            physical_available_gb=mem.available / (1024**3),
+            available_gb=available_gb,
+            memory_percent=percent,
+            pressure=cls._classify_pressure(percent),
+            tier=cls.forced_tier or cls._classify_tier(available_gb * 1024),
+            swap_used_gb=swap_used_gb,
+            cpu_count=psutil.cpu_count(),
+            cpu_percent=psutil.cpu_percent(interval=None),  # Since the previous sample, never blocks
+            load_avg=os.getloadavg() if hasattr(os, 'getloadavg') else None,
+            process_rss_mb=cls._process.memory_info().rss / (1024**2)
+        )
+
+    @classmethod
+    def _run(cls):
+        while True:
+            time.sleep(RESOURCE_SAMPLE_INTERVAL_SECONDS)
+            try:
+                cls._publish(cls._sample())
+            except Exception as e:
+                logger.warning(f"Resource sampling failed: {str(e)}")
+
+    @classmethod
+    def _publish(cls, snapshot):
+        previous = cls._snapshot
+        if previous is not None and previous.tier != snapshot.tier:
+            metrics.TIER_TRANSITIONS.inc(from_tier=previous.tier, to_tier=snapshot.tier)
+        cls._snapshot = snapshot
+        return snapshot
+
+    @classmethod
+    def force_tier(cls, tier):
+        """Pin the reported memory tier (None to go back to measuring it)"""
+        if tier is not None and tier not in ADAPTIVE_MEMORY_THRESHOLDS:
+            raise ValueError(f"Unknown memory tier: {tier}")
+        cls.forced_tier = tier
+        return cls.refresh()
+
+    @classmethod
+    def refresh(cls):
+        """Take a sample immediately (used at startup and after memory recovery)"""
+        return cls._publish(cls._sample())
+
+    @classmethod
+    def snapshot(cls):
+        """Latest published snapshot"""
+        if cls._snapshot is None or cls._pid != os.getpid():
+            with cls._lock:
+                if cls._snapshot is None or cls._pid != os.getpid():
+                    cls._pid = os.getpid()
+                    cls.refresh()
+                    cls._thread = threading.Thread(target=cls._run, name='resource-sampler', daemon=True)
+                    cls._thread.start()
+        return cls._snapshot
+
+# === CPU BUDGET ===
+def _cgroup_cpu_limit():
+    """CPUs allowed by the cgroup quota (v2 cpu.max, then v1 cfs), or None when unlimited"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def detect_cpu_budget():
+    """Usable CPUs for llama.cpp: the affinity mask capped by the cgroup quota.
+
+    psutil.cpu_count() reports the host's cores, which overstates what a
+    container may use and makes llama.cpp oversubscribe a throttled quota.
+    """
+    try:
+        affinity = len(os.sched_getaffinity(0))
+    except AttributeError:
+        affinity = os.cpu_count() or 1
+    quota = _cgroup_cpu_limit()
+    budget = affinity if quota is None else min(affinity, max(int(quota), 1))
+    return {'affinity_cpus': affinity, 'cgroup_quota_cpus': quota, 'budget': max(budget, 1)}
+
+# === OPTIMIZED MEMORY MANAGER ===
+class OptimizedMemoryManager:
+    """Intelligent memory management optimized for 2GB system (reads the sampler's snapshot)"""
+    
+    @staticmethod
+    def get_memory_pressure():
+        """Get memory pressure, simulating a 2GB system if on a larger machine."""
+        return ResourceSampler.snapshot().pressure
     
     @staticmethod
     def emergency_memory_recovery():
@@ -127,92 +430,56 @@ class OptimizedMemoryManager:
         collected = gc.collect()
         logger.debug(f"GC freed {collected} objects")
         
+        # Re-sample so the next check sees the effect of the cleanup
+        ResourceSampler.refresh()
         return True
     
     @staticmethod
     def get_available_memory_gb():
         """Get available memory in GB, simulating a 2GB system if on a larger machine."""
-        mem = psutil.virtual_memory()
-        total_physical_gb = mem.total / (1024**3)
-
-        # If running on a machine with more RAM, calculate available within the simulated cap
-        if total_physical_gb > SIMULATED_TOTAL_RAM_GB:
-            used_physical_gb = mem.used / (1024**3)
-            simulated_available_gb = max(0, SIMULATED_TOTAL_RAM_GB - used_physical_gb)
-            return simulated_available_gb
-        else:
-            return mem.available / (1024**3)
+        return ResourceSampler.snapshot().available_gb
     
     @staticmethod
     def monitor_swap_usage():
         """Monitor swap usage (should be 0 for this system)"""
-        try:
-            swap = psutil.swap_memory()
-            return swap.used / (1024**3)
-        except:
-            return 0
+        return ResourceSampler.snapshot().swap_used_gb
     
     @staticmethod
     def check_memory_emergency():
         """Check if we're in memory emergency (more likely with 2GB)"""
-        pressure = OptimizedMemoryManager.get_memory_pressure()
-        available = OptimizedMemoryManager.get_available_memory_gb()
+        snapshot = ResourceSampler.snapshot()
         
         # Emergency if less than 150MB available or critical pressure
-        if pressure == 'critical' or available < 0.15:
+        if snapshot.pressure == 'critical' or snapshot.available_gb < 0.15:
             return True
         return False
 
     @staticmethod
     def get_adaptive_memory_tier():
         """Get memory tier for adaptive parameter selection (for low-resource environment)"""
-        # Force minimal mode if physical CPU count is 1 or less
-        physical_cores = psutil.cpu_count(logical=False)
-        if physical_cores is not None and physical_cores <= 1:
-            # On single-core, base tier on memory not just force minimal
-            pass
-
-        # Force minimal mode if total system memory is below 4GB
-        total_gb = psutil.virtual_memory().total / (1024 ** 3)
-        if total_gb < 4:
-             # On low-mem system, base tier on memory not just force minimal
-            pass
-        
-        available_mb = OptimizedMemoryManager.get_available_memory_gb() * 1024
-        
-        # Thresholds for 2GB system
-        if available_mb < 250:
-            return 'minimal'
-        elif available_mb < 500:
-            return 'low'
-        elif available_mb < 750:
-            return 'medium'
-        else:
-            return 'high'
+        return ResourceSampler.snapshot().tier
     
     @staticmethod
     def get_adaptive_parameters():
         """Get adaptive parameters based on current memory situation"""
-        tier = OptimizedMemoryManager.get_adaptive_memory_tier()
-        params = ADAPTIVE_MEMORY_THRESHOLDS[tier].copy()
+        snapshot = ResourceSampler.snapshot()
+        params = ADAPTIVE_MEMORY_THRESHOLDS[snapshot.tier].copy()
         
         # Add tier info for logging
-        params['tier'] = tier
-        params['available_gb'] = OptimizedMemoryManager.get_available_memory_gb()
+        params['tier'] = snapshot.tier
+        params['available_gb'] = snapshot.available_gb
         
         return params
     
     @staticmethod
     def log_memory_status():
         """Log current memory status for monitoring"""
-        mem = psutil.virtual_memory()
-        available_gb = mem.available / (1024**3)
-        used_gb = mem.used / (1024**3)
-        pressure = OptimizedMemoryManager.get_memory_pressure()
-        tier = OptimizedMemoryManager.get_adaptive_memory_tier()
+        snapshot = ResourceSampler.snapshot()
+        available_gb = snapshot.physical_available_gb
+        used_gb = snapshot.used_gb
         
         logger.info(f"MEMORY: {used_gb:.2f}GB used, {available_gb:.2f}GB available, "
-                   f"pressure={pressure}, tier={tier}")
+                   f"pressure={snapshot.pressure}, tier={snapshot.tier}")
         
         # Warn if memory is low
         if available_gb < 0.5:
@@ -221,10 +488,73 @@ class OptimizedMemoryManager:
         return {
             'used_gb': used_gb,
             'available_gb': available_gb,
-            'pressure': pressure,
-            'tier': tier
+            'pressure': snapshot.pressure,
+            'tier': snapshot.tier
+        }
+
+# === GARBAGE COLLECTION POLICY ===
+class GCPolicy:
+    """Scheduled collections for the request path.
+
+    Cheap generation-0/1 collections run by allocation count, time or
+    generation count; full collections only happen under high/critical
+    memory pressure, since they cost latency and rarely free much here.
+    """
+
+    def __init__(self):
+        self._generations_since_young = 0
+        self._last_young = time.time()
+        self._last_full = 0
+        self.young_collections = 0
+        self.full_collections = 0
+        self.collect_seconds = 0.0
+
+    def after_generation(self, pressure):
+        self._generations_since_young += 1
+        now = time.time()
+        
+        if pressure in ('high', 'critical') and now - self._last_full >= GC_FULL_MIN_INTERVAL_SECONDS:
+            self._collect(2)
+            self._last_full = now
+            self.full_collections += 1
+        elif (self._generations_since_young >= GC_FREQUENCY or
+              gc.get_count()[0] >= GC_YOUNG_ALLOCATION_THRESHOLD or
+              now - self._last_young >= GC_YOUNG_INTERVAL_SECONDS):
+            self._collect(1)
+            self.young_collections += 1
+        else:
+            return
+        self._generations_since_young = 0
+        self._last_young = now
+
+    def _collect(self, generation):
+        start = time.perf_counter()
+        collected = gc.collect(generation)
+        self.collect_seconds += time.perf_counter() - start
+        if collected > 0:
+            logger.debug(f"Garbage collected {collected} objects (generation {generation})")
+
+    def stats(self):
+        return {
+            'young_collections': self.young_collections,
+            'full_collections': self.full_collections,
+            'collect_seconds': self.collect_seconds,
+            'frozen_objects': gc.get_freeze_count()
         }
 
+def freeze_heap_for_fork():
+    """Move everything allocated so far (model load, imports) into the permanent generation.
+
+    Called once in the gunicorn master after the --preload model load, so the
+    collector never touches those objects in forked workers and their pages
+    stay shared copy-on-write. gunicorn.conf.py disables the collector in the
+    master before the preload and re-enables it in each worker after the fork;
+    the one collection here only clears the garbage left by the load.
+    """
+    gc.collect()
+    gc.freeze()
+    logger.info(f"GC: froze {gc.get_freeze_count()} objects before fork")
+
 @contextmanager
 def optimized_memory_operation():
     """Optimized memory operation context for low-memory system"""
@@ -238,6 +568,855 @@ def optimized_memory_operation():
         # Minimal post-operation cleanup
         pass
 
+# === SESSION KV CACHE ===
+def _common_prefix_length(a, b):
+    """Number of leading tokens shared by two token sequences"""
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+def _compact_state(state):
+    """Drop all but the last logits row from a saved state, in place.
+
+    save_state() copies up to n_batch x n_vocab float32 logits (over 100MB with
+    Gemma 3's 262k vocab). Without logits_all they are never read back, and
+    load_state() broadcasts the single row we keep over the rows it restores.
+    """
+    scores = getattr(state, 'scores', None)
+    if scores is not None and len(scores) > 1:
+        state.scores = scores[-1:].copy()
+    return state
+
+def _state_size_bytes(state):
+    """Everything a saved state holds: the KV blob plus its logits and input id arrays"""
+    size = state.llama_state_size
+    for name in ('scores', 'input_ids'):
+        size += getattr(getattr(state, name, None), 'nbytes', 0)
+    return size
+
+class SessionKVCache:
+    """LRU of saved llama states keyed by chat session, under a strict byte budget.
+
+    Each entry is the KV state left behind by the session's previous turn, so
+    the next turn only evaluates the tokens after the shared prefix instead of
+    the whole system prompt plus history. The budget covers the whole state,
+    not just the KV blob (see _state_size_bytes).
+    """
+
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self._states = OrderedDict()  # session_id -> (state, size_bytes)
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, chat_session_id, prompt_tokens):
+        """Return (state, shared_prefix_tokens) for the session, or (None, 0)"""
+        with self._lock:
+            entry = self._states.get(chat_session_id)
+            if entry is None:
+                return None, 0
+            self._states.move_to_end(chat_session_id)
+            return entry[0], _common_prefix_length(entry[0].input_ids, prompt_tokens)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def store(self, chat_session_id, state):
+        """Save a session's state, evicting least recently used sessions to fit"""
+        size = _state_size_bytes(_compact_state(state))
+        with self._lock:
+            self._discard_locked(chat_session_id)
+            if size > self.capacity_bytes:
+                return False
+            self._states[chat_session_id] = (state, size)
+            self.size_bytes += size
+            self._evict_locked()
+            return True
+
+    def discard(self, chat_session_id):
+        with self._lock:
+            return self._discard_locked(chat_session_id)
+
+    def resize(self, capacity_bytes):
+        """Apply a new byte budget (e.g. after a memory tier change)"""
+        with self._lock:
+            self.capacity_bytes = capacity_bytes
+            self._evict_locked()
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self.size_bytes = 0
+
+    def _discard_locked(self, chat_session_id):
+        entry = self._states.pop(chat_session_id, None)
+        if entry is None:
+            return False
+        self.size_bytes -= entry[1]
+        return True
+
+    def _evict_locked(self):
+        while self._states and self.size_bytes > self.capacity_bytes:
+            _, (_, size) = self._states.popitem(last=False)
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'sessions': len(self._states),
+                'size_mb': self.size_bytes / (1024**2),
+                'capacity_mb': self.capacity_bytes / (1024**2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+# === SYSTEM PROMPT PREFIX STATE ===
+def _model_fingerprint(model_path):
+    """Cheap identity for a GGUF file: its size plus hashes of the head and tail (no full read)"""
+    digest = hashlib.sha256()
+    size = os.path.getsize(model_path)
+    digest.update(str(size).encode("utf-8"))
+    with open(model_path, "rb") as f:
+        digest.update(f.read(MODEL_FINGERPRINT_SAMPLE_BYTES))
+        if size > MODEL_FINGERPRINT_SAMPLE_BYTES:
+            f.seek(-MODEL_FINGERPRINT_SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(MODEL_FINGERPRINT_SAMPLE_BYTES))
+    return digest.hexdigest()
+
+def _prefix_state_path(model_path, n_ctx, prefix_text):
+    """On-disk location of the prefix state for this model file, context size and prompt"""
+    try:
+        import llama_cpp
+        llama_version = getattr(llama_cpp, "__version__", "")
+    except ImportError:
+        llama_version = ""
+    key = hashlib.sha256("\0".join([
+        _model_fingerprint(model_path), str(n_ctx), llama_version, prefix_text
+    ]).encode("utf-8")).hexdigest()
+    return os.path.join(PREFIX_STATE_DIR, f"{key[:32]}.state")
+
+def _load_prefix_state(path, prefix_tokens):
+    """Read a persisted prefix state, or None if missing, unreadable or for other tokens"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if list(state.input_ids)[:len(prefix_tokens)] != list(prefix_tokens):
+            logger.warning(f"Prefix state {path} does not match the current prompt; ignoring it")
+            return None
+        return state
+    except Exception as e:
+        logger.warning(f"Could not read prefix state {path}: {str(e)}")
+        return None
+
+def _save_prefix_state(path, state):
+    """Write atomically so concurrently starting workers never read a partial file"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"Could not persist prefix state to {path}: {str(e)}")
+
+# === MODEL ROUTER ===
+def _model_variant_path(name):
+    return os.path.join(BASE_DIR, "ai_model", MODEL_VARIANTS[name]['filename'])
+
+def _variant_weights_mb(name):
+    path = _model_variant_path(name)
+    return os.path.getsize(path) / (1024**2) if os.path.exists(path) else MODEL_VARIANTS[name]['weights_mb']
+
+def _tier_allows(tier, name):
+    return MEMORY_TIER_ORDER.index(tier) >= MEMORY_TIER_ORDER.index(MODEL_VARIANTS[name]['min_tier'])
+
+def available_model_variants():
+    """Registry variants whose GGUF is in ai_model/, best quality first (only the pinned one with AI_MODEL_VARIANT)"""
+    names = [MODEL_VARIANT_PIN] if MODEL_VARIANT_PIN in MODEL_VARIANTS else list(MODEL_VARIANTS)
+    return [name for name in names if os.path.exists(_model_variant_path(name))]
+
+def select_model_variant(tier, current=None, available_mb=None):
+    """Best variant on disk allowed on `tier`, else the smallest on disk; None when there is none.
+
+    Moving up from `current` also requires the extra weights to leave
+    `available_mb` inside a tier that still allows the bigger variant, so a
+    recovery doesn't bounce straight back down.
+    """
+    names = available_model_variants()
+    if not names:
+        return None
+    for name in names:
+        if not _tier_allows(tier, name):
+            continue
+        if current in names and available_mb is not None and names.index(name) < names.index(current):
+            extra_mb = _variant_weights_mb(name) - _variant_weights_mb(current)
+            if not _tier_allows(ResourceSampler._classify_tier(available_mb - extra_mb), name):
+                continue
+        return name
+    return names[-1]
+
+# === SHARED MODEL MEMORY (multi-worker) ===
+def default_model_path():
+    """The GGUF the router would load on the current memory tier"""
+    name = select_model_variant(OptimizedMemoryManager.get_adaptive_memory_tier())
+    return _model_variant_path(name) if name else os.path.join(BASE_DIR, "ai_model", MODEL_FILENAME)
+
+def prefetch_model_weights(model_path=None):
+    """Read the GGUF once so its pages sit in the page cache before workers mmap it.
+
+    Runs in the gunicorn master in multi-worker mode. The master never creates a
+    llama context; each worker loads its own with use_mmap=True, and because
+    file-backed mmap pages come from the shared page cache, the weights are
+    resident once no matter how many workers map them.
+    """
+    model_path = model_path or default_model_path()
+    if not os.path.exists(model_path):
+        logger.warning(f"Model prefetch skipped, file not found: {model_path}")
+        return 0
+    start_time = time.time()
+    total = 0
+    with open(model_path, "rb", buffering=0) as f:
+        while True:
+            chunk = f.read(MODEL_PREFETCH_CHUNK_BYTES)
+            if not chunk:
+                break
+            total += len(chunk)
+    logger.info(f"Prefetched {total / (1024**2):.0f}MB of model weights into the page cache in {time.time() - start_time:.2f}s")
+    return total
+
+_SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+def _read_smaps(path, mapping_suffix=None):
+    """Sum smaps fields (kB) over all mappings, or only those of a file ending in mapping_suffix"""
+    totals = dict.fromkeys(_SMAPS_FIELDS, 0)
+    counting = mapping_suffix is None
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if not parts[0].endswith(':'):
+                # Mapping header: "start-end perms offset dev inode [path]"
+                counting = mapping_suffix is None or (len(parts) >= 6 and parts[-1].endswith(mapping_suffix))
+                continue
+            key = parts[0][:-1]
+            if counting and key in totals:
+                totals[key] += int(parts[1])
+    return totals
+
+def _processes_mapping(model_path):
+    """PIDs that currently have the GGUF mapped (e.g. the gunicorn workers)"""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/maps') as f:
+                if any(line.rstrip().endswith(model_path) for line in f):
+                    pids.append(int(entry))
+        except OSError:
+            continue
+    return sorted(pids)
+
+def shared_memory_report(pids=None, model_path=None):
+    """RSS vs PSS of the mmapped weights per process, from /proc/<pid>/smaps (Linux only).
+
+    When the weights are shared, each process's model RSS is roughly the whole
+    file while its PSS is the file divided by the number of mappers, so the
+    summed PSS stays near the file size instead of growing with the workers.
+    """
+    model_path = os.path.realpath(model_path or default_model_path())
+    if pids is None:
+        pids = _processes_mapping(model_path)
+    
+    processes = []
+    for pid in pids:
+        try:
+            model = _read_smaps(f'/proc/{pid}/smaps', mapping_suffix=model_path)
+            process = _read_smaps(f'/proc/{pid}/smaps_rollup')
+        except OSError as e:
+            logger.debug(f"smaps unavailable for pid {pid}: {str(e)}")
+            continue
+        processes.append({
+            'pid': pid,
+            'model_rss_mb': model['Rss'] / 1024,
+            'model_pss_mb': model['Pss'] / 1024,
+            'model_shared_mb': (model['Shared_Clean'] + model['Shared_Dirty']) / 1024,
+            'model_private_mb': (model['Private_Clean'] + model['Private_Dirty']) / 1024,
+            'process_rss_mb': process['Rss'] / 1024,
+            'process_pss_mb': process['Pss'] / 1024,
+            'process_private_mb': (process['Private_Clean'] + process['Private_Dirty']) / 1024,
+        })
+    
+    model_rss = sum(p['model_rss_mb'] for p in processes)
+    model_pss = sum(p['model_pss_mb'] for p in processes)
+    return {
+        'model_path': model_path,
+        'model_file_mb': os.path.getsize(model_path) / (1024**2) if os.path.exists(model_path) else None,
+        'processes': processes,
+        'total_model_rss_mb': model_rss,
+        'total_model_pss_mb': model_pss,
+        'total_process_pss_mb': sum(p['process_pss_mb'] for p in processes),
+        # ~N with N workers sharing the pages; ~1 means each process has its own copy
+        'model_sharing_ratio': model_rss / model_pss if model_pss else None,
+    }
+
+# === SPECULATIVE DECODING ===
+# Off on every tier (speculative_tokens 0). llama-cpp-python verifies drafts
+# against logits for every position, which only exist when the Llama is built
+# with draft_model (it then forces logits_all): n_ctx x vocab floats, ~4GB for
+# Gemma 3's 262k vocabulary at 4096 tokens, far beyond the 2GB target.
+# Attaching a drafter to a context built without them decodes garbage, so
+# _configure_speculative refuses to.
+class SpeculativeDecodingStats:
+    """Draft acceptance and end-to-end decode throughput.
+
+    llama-cpp-python doesn't report how many drafted tokens were accepted, so
+    each draft is checked against the tokens that actually follow it when the
+    draft model is called again for the next step.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = None  # (position, drafted tokens) awaiting verification
+        self.drafts = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generations = 0
+        self.completion_tokens = 0
+        self.generation_seconds = 0.0
+
+    def begin(self):
+        """Start of a generation: an unverified draft from the previous one can't be scored"""
+        with self._lock:
+            self._pending = None
+
+    def observe(self, input_ids, draft):
+        with self._lock:
+            if self._pending is not None:
+                start, previous = self._pending
+                if len(input_ids) > start:
+                    self.proposed += len(previous)
+                    self.accepted += _common_prefix_length(previous, [int(t) for t in input_ids[start:start + len(previous)]])
+            self.drafts += 1
+            self._pending = (len(input_ids), [int(t) for t in draft]) if len(draft) else None
+
+    def record_generation(self, completion_tokens, seconds):
+        with self._lock:
+            self.generations += 1
+            self.completion_tokens += completion_tokens
+            self.generation_seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                'drafts': self.drafts,
+                'proposed_tokens': self.proposed,
+                'accepted_tokens': self.accepted,
+                'acceptance_rate': self.accepted / self.proposed if self.proposed else 0.0,
+                'generations': self.generations,
+                'tokens_per_second': self.completion_tokens / self.generation_seconds if self.generation_seconds else 0.0
+            }
+
+class CountingPromptLookupDecoding(LlamaPromptLookupDecoding):
+    """Prompt-lookup (n-gram) drafting that reports its drafts to SpeculativeDecodingStats"""
+
+    def __init__(self, tracker, **kwargs):
+        super().__init__(**kwargs)
+        self.tracker = tracker
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = super().__call__(input_ids, **kwargs)
+        self.tracker.observe(input_ids, draft)
+        return draft
+
+class SmallModelDraft(LlamaDraftModel):
+    """Greedy drafts from a tiny GGUF that shares Gemma 3's tokenizer (e.g. gemma-3-270m-it)"""
+
+    def __init__(self, draft_llm, tracker, num_pred_tokens):
+        self.llm = draft_llm
+        self.tracker = tracker
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        import numpy as np
+        draft = []
+        # generate() reuses the draft context's matching prefix, so each step only evaluates new tokens
+        for token in self.llm.generate([int(t) for t in input_ids], top_k=1, temp=0.0, reset=True):
+            if token == self.llm.token_eos() or len(draft) >= self.num_pred_tokens:
+                break
+            draft.append(token)
+        self.tracker.observe(input_ids, draft)
+        return np.array(draft, dtype=np.intc)
+
+# === MULTI-SEQUENCE BATCHED DECODING ===
+class LlamaSequenceContext:
+    """A llama context with one KV sequence per batched session, over the Llama's loaded model.
+
+    Only the KV cache and compute buffers are new: the weights are the
+    Llama's own mmapped tensors. The Llama keeps serving lone jobs with its
+    per-session KV snapshots. Used from the decode thread only.
+    """
+
+    def __init__(self, llm, n_seq, n_ctx_per_seq, n_batch):
+        params = type(llm.context_params).from_buffer_copy(llm.context_params)
+        params.n_ctx = n_seq * n_ctx_per_seq
+        params.n_seq_max = n_seq
+        params.n_batch = params.n_ubatch = n_batch
+        self.llm = llm
+        self.n_seq = n_seq
+        self.n_ctx_per_seq = n_ctx_per_seq
+        self.n_batch = n_batch
+        self.shape = (id(llm), n_seq, n_ctx_per_seq, n_batch)
+        self._ctx = LlamaContext(model=llm._model, params=params, verbose=False)
+        self._batch = LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=1, verbose=False)
+        self.n_tokens = 0
+
+    def clear(self):
+        self.n_tokens = 0
+        self._batch.reset()
+
+    def add(self, token, pos, seq_id, logits):
+        """Append one token of one sequence to the batch; returns its row for sampling"""
+        batch = self._batch.batch
+        row = self.n_tokens
+        batch.token[row] = token
+        batch.pos[row] = pos
+        batch.seq_id[row][0] = seq_id
+        batch.n_seq_id[row] = 1
+        batch.logits[row] = logits
+        self.n_tokens = batch.n_tokens = row + 1
+        return row
+
+    def decode(self):
+        self._ctx.decode(self._batch)  # RuntimeError when llama_decode fails
+
+    def new_sampler(self, temperature, top_k, top_p, repeat_penalty):
+        """The create_completion sampler chain for one sequence"""
+        sampler = LlamaSampler()
+        sampler.add_penalties(BATCH_PENALTY_LAST_N, repeat_penalty, 0.0, 0.0)
+        sampler.add_top_k(top_k)
+        sampler.add_top_p(top_p, 1)
+        sampler.add_temp(temperature)
+        sampler.add_dist(llama_lowlevel.LLAMA_DEFAULT_SEED)
+        return sampler
+
+    def sample(self, sampler, row):
+        return sampler.sample(self._ctx, row)  # Also accepts the token into the penalty window
+
+    def is_eog(self, token):
+        return llama_lowlevel.llama_vocab_is_eog(self.llm._model.vocab, token)
+
+    def piece(self, token):
+        return self.llm.detokenize([token])
+
+    def release(self, seq_id, sampler=None):
+        """Free a finished sequence's KV cells (and its sampler) for the next session"""
+        self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        if sampler is not None:
+            sampler.close()
+
+    def close(self):
+        self._batch.close()
+        self._ctx.close()
+
+def _stop_prefix_length(text):
+    """Length of the longest tail of `text` that could still grow into a stop sequence"""
+    longest = 0
+    for stop in STOP_SEQUENCES:
+        for n in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:n]):
+                longest = n
+                break
+    return longest
+
+class BatchedSequence:
+    """One chat job inside a BatchedDecoder: its prompt, sampler and decoded text.
+
+    Streaming jobs get ('token', text) events as text is decoded, holding back
+    anything that may still turn into a stop sequence. `finish_reason` is set
+    ('stop' or 'length', as create_completion reports) once it is done.
+    """
+
+    def __init__(self, job, prompt_tokens, max_tokens, sampling, stream=False):
+        self.job = job
+        self.prompt_tokens = prompt_tokens
+        self.pending = list(prompt_tokens)  # Prompt tokens not evaluated yet
+        self.max_tokens = max_tokens
+        self.sampling = sampling
+        self.stream = stream
+        self.seq_id = None
+        self.sampler = None
+        self.n_past = 0
+        self.last_token = None
+        self.completion_tokens = 0
+        self.text = ''
+        self.emitted = 0
+        self.finish_reason = None
+        self.started_at = time.time()
+        self.first_token_seconds = None
+        self._utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def accept(self, token, context):
+        """Take the token sampled for this sequence"""
+        if context.is_eog(token):
+            self.finish_reason = 'stop'
+            return
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.time() - self.started_at
+        self.completion_tokens += 1
+        self.last_token = token
+        searched = max(len(self.text) - max(len(stop) for stop in STOP_SEQUENCES), 0)
+        self.text += self._utf8.decode(context.piece(token))
+        for stop in STOP_SEQUENCES:
+            index = self.text.find(stop, searched)
+            if index >= 0:
+                self.text = self.text[:index]
+                self.finish_reason = 'stop'
+                return
+        if self.completion_tokens >= self.max_tokens:
+            self.finish_reason = 'length'
+        elif self.stream:
+            self._emit(len(self.text) - _stop_prefix_length(self.text))
+
+    def flush(self):
+        if self.stream:
+            self._emit(len(self.text))
+
+    def _emit(self, end):
+        if end > self.emitted:
+            self.job.emit('token', self.text[self.emitted:end])
+            self.emitted = end
+
+class BatchedDecoder:
+    """Continuous batching over a LlamaSequenceContext.
+
+    Every step is one llama_decode holding the next token of each generating
+    sequence plus as much pending prompt as fits in n_batch, each under its
+    own seq_id. Sequences join and leave between steps: a short answer doesn't
+    wait for a long one, and a newcomer's prompt is evaluated while the others
+    keep generating.
+    """
+
+    def __init__(self, context, stats=None):
+        self.context = context
+        self.sequences = []
+        self.stats = stats if stats is not None else {'batches': 0, 'steps': 0, 'tokens': 0, 'max_sequences': 0}
+        self.stats['batches'] += 1
+
+    def free_slots(self):
+        return self.context.n_seq - len(self.sequences)
+
+    def admit(self, sequence):
+        used = {other.seq_id for other in self.sequences}
+        sequence.seq_id = min(set(range(self.context.n_seq)) - used)
+        sequence.sampler = self.context.new_sampler(**sequence.sampling)
+        self.sequences.append(sequence)
+        self.stats['max_sequences'] = max(self.stats['max_sequences'], len(self.sequences))
+
+    def step(self):
+        """Decode one batch; returns the sequences that finished, already released"""
+        for sequence in self.sequences:
+            if sequence.job._should_stop():  # Cancelled or past its deadline
+                sequence.finish_reason = 'stop'
+        running = [sequence for sequence in self.sequences if sequence.finish_reason is None]
+        
+        context = self.context
+        context.clear()
+        rows = []
+        budget = context.n_batch
+        for sequence in running:
+            if not sequence.pending:
+                rows.append((sequence, context.add(sequence.last_token, sequence.n_past, sequence.seq_id, True)))
+                sequence.n_past += 1
+                budget -= 1
+        for sequence in running:
+            if not sequence.pending or budget <= 0:
+                continue
+            chunk = sequence.pending[:budget]
+            del sequence.pending[:len(chunk)]
+            for i, token in enumerate(chunk):
+                last = not sequence.pending and i == len(chunk) - 1  # Logits only for the final prompt token
+                row = context.add(token, sequence.n_past, sequence.seq_id, last)
+                sequence.n_past += 1
+            if not sequence.pending:
+                rows.append((sequence, row))
+            budget -= len(chunk)
+        
+        if context.n_tokens:
+            context.decode()
+            self.stats['steps'] += 1
+            self.stats['tokens'] += context.n_tokens
+        for sequence, row in rows:
+            sequence.accept(context.sample(sequence.sampler, row), context)
+            if sequence.finish_reason is None and sequence.n_past >= context.n_ctx_per_seq:
+                sequence.finish_reason = 'length'
+        
+        finished = [sequence for sequence in self.sequences if sequence.finish_reason is not None]
+        for sequence in finished:
+            self._release(sequence)
+        return finished
+
+    def abort(self):
+        """Release every sequence after a failed decode; returns them"""
+        aborted = list(self.sequences)
+        for sequence in aborted:
+            self._release(sequence)
+        return aborted
+
+    def _release(self, sequence):
+        self.sequences.remove(sequence)
+        self.context.release(sequence.seq_id, sequence.sampler)
+        sequence.sampler = None
+
+# === CONVERSATION HISTORY STORE ===
+class ConversationStore:
+    """Bounded per-session message history: LRU order, idle TTL and a byte budget.
+
+    Supports the dict operations the handler already used (`in`, `del`, `get`).
+    Budgets shrink as memory pressure rises, so eviction gets more aggressive
+    exactly when the box needs the memory back. Each session may also carry a
+    memory note summarizing the turns that were compacted out of its history.
+    """
+
+    def __init__(self, max_sessions=HISTORY_MAX_SESSIONS, idle_ttl=HISTORY_IDLE_TTL_SECONDS,
+                 max_bytes=HISTORY_MAX_BYTES, on_evict=None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()  # session_id -> [messages, last_access, size_bytes, memory]
+        self._lock = threading.RLock()
+        self.size_bytes = 0
+        self.evictions = {'lru': 0, 'idle': 0, 'bytes': 0}
+        self.compactions = 0
+
+    @staticmethod
+    def _message_size(message):
+        """Content plus the token ID arrays the handler caches on the message once it has been prompted"""
+        size = len(message['content'].encode('utf-8')) + HISTORY_MESSAGE_OVERHEAD_BYTES
+        for key in ('token_ids', 'first_token_ids'):
+            ids = message.get(key)
+            if ids is not None:
+                size += len(ids) * ids.itemsize
+        return size
+
+    def _entry_size(self, entry):
+        size = sum(self._message_size(m) for m in entry[0])
+        if entry[3] is not None:
+            size += self._message_size(entry[3])
+        return size
+
+    def _remeasure_locked(self):
+        """Re-account every session: token arrays are cached on messages after they were stored"""
+        total = 0
+        for entry in self._sessions.values():
+            entry[2] = self._entry_size(entry)
+            total += entry[2]
+        self.size_bytes = total
+
+    def __contains__(self, chat_session_id):
+        with self._lock:
+            return chat_session_id in self._sessions
+
+    def __delitem__(self, chat_session_id):
+        with self._lock:
+            entry = self._sessions.pop(chat_session_id)
+            self.size_bytes -= entry[2]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_session_id, default=None):
+        with self._lock:
+            entry = self._sessions.get(chat_session_id)
+            if entry is None:
+                return default
+            entry[1] = time.time()
+            self._sessions.move_to_end(chat_session_id)
+            return entry[0]
+
+    def append(self, chat_session_id, message):
+        with self._lock:
+            entry = self._sessions.get(chat_session_id)
+            if entry is None:
+                entry = self._sessions[chat_session_id] = [[], time.time(), 0, None]
+            entry[0].append(message)
+            entry[1] = time.time()
+            size = self._message_size(message)
+            entry[2] += size
+            self.size_bytes += size
+            self._sessions.move_to_end(chat_session_id)
+
+    def replace(self, chat_session_id, messages):
+        """Set a session's whole history (e.g. after trimming or loading from the database); its memory note is kept"""
+        with self._lock:
+            memory = None
+            if chat_session_id in self._sessions:
+                memory = self._sessions[chat_session_id][3]
+                del self[chat_session_id]
+            self._set_locked(chat_session_id, list(messages), memory)
+
+    def _set_locked(self, chat_session_id, messages, memory):
+        entry = self._sessions[chat_session_id] = [messages, time.time(), 0, memory]
+        entry[2] = self._entry_size(entry)
+        self.size_bytes += entry[2]
+
+    def get_memory(self, chat_session_id):
+        """The session's memory note ({'content', 'messages' covered}), or None"""
+        with self._lock:
+            entry = self._sessions.get(chat_session_id)
+            return entry[3] if entry is not None else None
+
+    def compact(self, chat_session_id, older, memory_text):
+        """Swap the leading `older` messages for a memory note that covers them.
+
+        Returns False, changing nothing, when the history no longer starts with
+        those exact messages (cleared, trimmed or reloaded in the meantime).
+        """
+        with self._lock:
+            entry = self._sessions.get(chat_session_id)
+            if entry is None or len(entry[0]) < len(older):
+                return False
+            if any(a is not b for a, b in zip(entry[0], older)):
+                return False
+            covered = len(older) + (entry[3]['messages'] if entry[3] else 0)
+            del self[chat_session_id]
+            self._set_locked(chat_session_id, entry[0][len(older):],
+                             {'role': 'memory', 'content': memory_text, 'messages': covered})
+            self.compactions += 1
+            return True
+
+    def _evict(self, chat_session_id, reason):
+        del self[chat_session_id]
+        self.evictions[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(chat_session_id)
+
+    def sweep(self, pressure='low'):
+        """Drop idle sessions, then least recently used ones until within budget"""
+        scale = HISTORY_PRESSURE_SCALE.get(pressure, 1.0)
+        max_bytes = self.max_bytes * scale
+        idle_cutoff = time.time() - self.idle_ttl * scale
+        with self._lock:
+            self._remeasure_locked()
+            # Oldest entries come first, so stop at the first one still in use
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if oldest[1] >= idle_cutoff:
+                    break
+                self._evict(oldest_id, 'idle')
+            while len(self._sessions) > self.max_sessions:
+                self._evict(next(iter(self._sessions)), 'lru')
+            # Never evict the most recent session to meet the byte budget
+            while len(self._sessions) > 1 and self.size_bytes > max_bytes:
+                self._evict(next(iter(self._sessions)), 'bytes')
+
+    def stats(self):
+        with self._lock:
+            self._remeasure_locked()
+            return {
+                'sessions': len(self._sessions),
+                'size_kb': self.size_bytes / 1024,
+                'max_sessions': self.max_sessions,
+                'max_kb': self.max_bytes / 1024,
+                'idle_ttl_seconds': self.idle_ttl,
+                'evictions': dict(self.evictions),
+                'sessions_with_memory': sum(1 for entry in self._sessions.values() if entry[3] is not None),
+                'compactions': self.compactions
+            }
+
+# === TRUNCATED GENERATIONS ===
+class TruncatedResponse(str):
+    """A partial answer: decoding hit the generation deadline or the token budget.
+
+    Behaves like the plain response string everywhere; `continuation` is the
+    handle a client passes back to resume it (None for sessionless prompts).
+    """
+
+    def __new__(cls, text, reason, continuation=None):
+        response = super().__new__(cls, text)
+        response.reason = reason
+        response.continuation = continuation
+        return response
+
+    def __reduce__(self):
+        return (TruncatedResponse, (str(self), self.reason, self.continuation))  # Crosses the worker socket
+
+def truncation_fields(response):
+    """Extra fields for a chat payload when the answer was cut off, else {}"""
+    if not isinstance(response, TruncatedResponse):
+        return {}
+    return {'truncated': True, 'truncated_reason': response.reason, 'continuation': response.continuation}
+
+class ContinuationStore:
+    """The latest cut-off answer per session: enough to resume decoding where it stopped.
+
+    Records hold the exact prompt token IDs and the raw partial text; the KV
+    state itself stays in SessionKVCache. Bounded by session count and TTL.
+    Each record is bound to its owner (a user id, None for guests).
+    """
+
+    def __init__(self, max_sessions=CONTINUATION_MAX_SESSIONS, ttl=CONTINUATION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.expired = 0
+
+    def put(self, chat_session_id, record):
+        with self._lock:
+            self._records.pop(chat_session_id, None)
+            self._records[chat_session_id] = record
+            self.recorded += 1
+            while len(self._records) > self.max_sessions:
+                self._records.popitem(last=False)
+                self.expired += 1
+
+    def get(self, chat_session_id, continuation_id, owner=None):
+        """The session's record, or None when missing, expired, superseded or someone else's"""
+        with self._lock:
+            record = self._records.get(chat_session_id)
+            if record is None:
+                return None
+            if time.time() - record['created_at'] > self.ttl:
+                del self._records[chat_session_id]
+                self.expired += 1
+                return None
+            if record['id'] != continuation_id or record['owner'] != owner:
+                return None
+            return record
+
+    def discard(self, chat_session_id):
+        with self._lock:
+            return self._records.pop(chat_session_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._records),
+                'max_sessions': self.max_sessions,
+                'ttl_seconds': self.ttl,
+                'recorded': self.recorded,
+                'expired': self.expired
+            }
+
 # === OPTIMIZED LLAMA MODEL ===
 class OptimizedLlamaModel:
     """Low-resource LLM optimized for 1-core, 2GB system with Gemma 3 1B"""
@@ -257,52 +1436,87 @@ class OptimizedLlamaModel:
         """Initialize with optimized memory-aware settings"""
         self.llm = None
         self.cache = None
-        self.conversation_history = {}
+        self.model_filename = MODEL_FILENAME
+        self.model_variant = None
+        self.model_switch_stats = {'switches': 0, 'deferred': 0, 'failures': 0, 'last_seconds': None}
+        self.conversation_history = ConversationStore(on_evict=self._on_history_evicted)
+        self.continuations = ContinuationStore()
         
         # Use adaptive parameters based on available memory
         adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
         self.context_window = adaptive_params['context_window']
         self.max_response_tokens = adaptive_params['max_response_tokens']
         self.max_prompt_tokens = self.context_window - self.max_response_tokens
-        self.n_threads = adaptive_params['n_threads']
+        self.cpu_budget = detect_cpu_budget()
+        self.n_threads = int(THREADS_OVERRIDE or self.cpu_budget['budget'])
+        self.n_threads_batch = int(THREADS_BATCH_OVERRIDE or self.cpu_budget['budget'])
+        self.thread_benchmark = None
+        self.model_path = None
+        self.n_batch = self._n_batch_for_tier(adaptive_params['tier'])
+        self._last_context_rebuild = 0
+        self.context_rebuild_stats = {'rebuilds': 0, 'deferred': 0, 'failures': 0, 'last_seconds': None}
+        self.kv_cache = SessionKVCache(adaptive_params['kv_cache_mb'] * 1024 * 1024)
+        self._template_token_ids = {}  # Template pieces shared by every prompt, see _memo_ids
+        self.last_prompt_tokens = 0
+        self.prefix_state = None
+        self.prefix_state_stats = {'tokens': 0, 'source': None, 'restores': 0}
+        self.speculation = SpeculativeDecodingStats()
+        self.draft_llm = None
+        self._speculative_config = None
+        self.sequence_context = None
+        self._sequence_context_failed = None
+        self.batch_stats = {'batches': 0, 'steps': 0, 'tokens': 0, 'max_sequences': 0, 'failures': 0}
         
         self._initialized = False
-        self._last_gc = time.time()
+        self.gc_policy = GCPolicy()
         self._last_memory_check = 0
         
-        # === SYSTEM PROMPT FOR GEMMA 3 ===
-        # Per official Google guidance, system prompts are included in the first user turn.
-        self.system_prompt = "You are a balanced, grounded, helpful, creative, and insightful AI assistant. Your purpose is to provide friendly, conversational, and genuinely helpful responses. Strive to understand the user's intent, even if the query is ambiguous. Your goal is to be a thoughtful and engaging conversation partner."
+        self.system_prompt = SYSTEM_PROMPT
         
         logger.info(f"OptimizedLlamaModel initialized: context={self.context_window}, "
-                   f"max_tokens={self.max_response_tokens}, threads={self.n_threads}, tier={adaptive_params['tier']}")
+                   f"max_tokens={self.max_response_tokens}, threads={self.n_threads}/{self.n_threads_batch}, "
+                   f"cpu_budget={self.cpu_budget['budget']}, tier={adaptive_params['tier']}")
 
-    def _check_and_adjust_parameters(self):
-        """Dynamically adjust parameters based on current memory"""
+    def _check_and_adjust_parameters(self, force=False):
+        """Dynamically adjust parameters based on current memory (force: apply the tier now, skipping rate limits)"""
         current_time = time.time()
         
         # Check memory every 15 seconds (more frequent for volatile system)
-        if (current_time - self._last_memory_check > 15 or 
+        if (force or current_time - self._last_memory_check > 15 or 
             OptimizedMemoryManager.get_memory_pressure() in ['high', 'critical']):
             
             adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
             
+            # The KV cache budget follows the tier immediately (cheap, and shrinks under pressure)
+            self.kv_cache.resize(adaptive_params['kv_cache_mb'] * 1024 * 1024)
+            if self.llm is not None:
+                self._configure_speculative(adaptive_params['tier'])
+                # A 4-bit model beats a starved context: change quantization before shrinking anything
+                self._maybe_switch_model(adaptive_params, force)
+            
             # Only adjust if parameters need to change significantly
             new_context = adaptive_params['context_window']
             new_max_tokens = adaptive_params['max_response_tokens']
-            new_threads = adaptive_params['n_threads']
             
+            # Thread counts come from the CPU budget, not the memory tier
             if (abs(new_context - self.context_window) > 256 or 
-                abs(new_max_tokens - self.max_response_tokens) > 128 or
-                new_threads != self.n_threads):
+                abs(new_max_tokens - self.max_response_tokens) > 128):
                 
-                self.context_window = new_context
-                self.max_response_tokens = new_max_tokens
+                # context_window always matches the live context: it only moves when the context is rebuilt
+                before = (self.context_window, self.max_response_tokens)
+                if self.llm is None:
+                    self.context_window = new_context
+                    self.n_batch = self._n_batch_for_tier(adaptive_params['tier'])
+                elif abs(new_context - self.context_window) > 256:
+                    self._maybe_rebuild_context(new_context, adaptive_params['tier'], force)
+                # A deferred or failed rebuild keeps the old context: size the response
+                # as the tier's share of the live context, not the tier's absolute budget
+                self.max_response_tokens = min(new_max_tokens, self.context_window * new_max_tokens // new_context)
                 self.max_prompt_tokens = self.context_window - self.max_response_tokens
-                self.n_threads = new_threads
                 
-                logger.info(f"ADAPTIVE: Adjusted to context={self.context_window}, "
-                           f"max_tokens={self.max_response_tokens}, threads={self.n_threads}, tier={adaptive_params['tier']}")
+                if (self.context_window, self.max_response_tokens) != before:
+                    logger.info(f"ADAPTIVE: Adjusted to context={self.context_window}, "
+                               f"max_tokens={self.max_response_tokens}, tier={adaptive_params['tier']}")
             
             self._last_memory_check = current_time
 
@@ -317,11 +1531,9 @@ class OptimizedLlamaModel:
         return response
 
     def _optimized_garbage_collect(self):
-        """Perform memory-conscious garbage collection for high-performance system"""
+        """Let the GC policy decide whether this generation warrants a collection"""
         try:
-            collected = gc.collect()
-            if collected > 0:
-                logger.debug(f"Garbage collected {collected} objects")
+            self.gc_policy.after_generation(OptimizedMemoryManager.get_memory_pressure())
         except Exception as e:
             logger.warning(f"Garbage collection failed: {str(e)}")
 
@@ -334,62 +1546,41 @@ class OptimizedLlamaModel:
             if self._initialized:
                 return self.llm is not None
 
-            logger.info("Initializing gemma-3-1b-it-Q8_0 for LOW-RESOURCE DEPLOYMENT (1 CPU, 2GB RAM)")
+            logger.info("Initializing Gemma 3 1B for LOW-RESOURCE DEPLOYMENT (1 CPU, 2GB RAM)")
             self._initialized = True
 
             # Log memory status before loading
             memory_status = OptimizedMemoryManager.log_memory_status()
             adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
             
-            logger.info(f"Loading gemma-3-1b-it-Q8_0 model with tier='{adaptive_params['tier']}', "
+            # The router picks the quantization for the current tier from what is on disk
+            variant = select_model_variant(adaptive_params['tier'])
+            if variant is None:
+                filenames = ", ".join(v['filename'] for v in MODEL_VARIANTS.values())
+                logger.error(f"Gemma model file not found in {os.path.join(BASE_DIR, 'ai_model')} (looked for {filenames})")
+                logger.info("Please download the model from: https://huggingface.co/ggml-org/gemma-3-1b-it-GGUF?show_file_info=gemma-3-1b-it-Q8_0.gguf")
+                return False
+            self.model_variant = variant
+            self.model_filename = MODEL_VARIANTS[variant]['filename']
+            model_path = _model_variant_path(variant)  # mmapped, shared across workers
+            
+            logger.info(f"Loading {self.model_filename} with tier='{adaptive_params['tier']}', "
                        f"context={self.context_window}, max_tokens={self.max_response_tokens}, threads={self.n_threads}")
             
             # Check memory availability for 1B model
             if memory_status['available_gb'] < 1.2:
                 logger.warning(f"Very low memory for 1B model: {memory_status['available_gb']:.2f}GB available")
 
-            model_filename = "gemma-3-1b-it-Q8_0.gguf"
-            model_path = os.path.join(BASE_DIR, "ai_model", model_filename)
-            
-            if not os.path.exists(model_path):
-                logger.error(f"Gemma model file not found: {model_path}")
-                logger.info("Please download the model from: https://huggingface.co/ggml-org/gemma-3-1b-it-GGUF?show_file_info=gemma-3-1b-it-Q8_0.gguf")
-                return False
-
             with optimized_memory_operation():
                 try:
-                    # Cache is disabled for low-resource environment
+                    # llama.cpp's own prompt cache stays off; per-session states live in self.kv_cache
                     self.cache = None
+                    self.model_path = model_path
+                    self.n_batch = self._n_batch_for_tier(adaptive_params['tier'])
+                    self.llm = self._create_llama(model_path, self.context_window, self.n_batch)
+                    self._last_context_rebuild = time.time()
                     
-                    from llama_cpp import Llama
-                    
-                    # Set reduced batch size for low-resource minimal tier
-                    n_batch_value = 32 if adaptive_params['tier'] != 'minimal' else 1 # Lowered for stability
-                    self.llm = Llama(
-                        model_path=model_path,
-                        n_ctx=self.context_window,        # Context window adjusted for low memory
-                        n_threads=self.n_threads,         # Reduced threads for 1 CPU
-                        n_gpu_layers=0,                   # CPU only
-                        verbose=False,
-                        cache=self.cache,
-                        
-                        # === PERFORMANCE OPTIMIZATION FOR 1B MODEL on LOW-RESOURCE ===
-                        use_mmap=True,                    # Memory-map file
-                        use_mlock=False,                  # DO NOT Lock memory for low-ram systems
-                        n_batch=n_batch_value,            # Adjusted batch size for minimal tier
-                        last_n_tokens_size=128,           # Smaller token buffer size
-                        
-                        # === LOW-RESOURCE SPECIFIC ===
-                        numa=False,                       # Disable NUMA awareness
-                        offload_kqv=False,                 # Offload key/query vectors to save RAM
-                        flash_attn=False,                 # Disable for compatibility
-                        
-                        # === OPTIMIZED SETTINGS FOR GEMMA ===
-                        rope_scaling_type=0,             # No rope scaling
-                        rope_freq_base=10000.0,          # Default rope freq
-                    )
-                    
-                    logger.info(f"Gemma 3 1B loaded! Tier: {adaptive_params['tier']}, Threads: {self.n_threads}")
+                    logger.info(f"Gemma 3 1B ({variant}) loaded! Tier: {adaptive_params['tier']}, Threads: {self.n_threads}/{self.n_threads_batch}")
                     
                     # Performance test with new prompt format
                     start_time = time.time()
@@ -401,6 +1592,12 @@ class OptimizedLlamaModel:
                     test_time = time.time() - start_time
                     logger.info(f"Gemma performance test: {test_time:.2f}s for 10 tokens")
                     
+                    self._autotune_threads()
+                    
+                    # Leave the system prompt evaluated so the first chat turn starts warm
+                    self._warm_system_prefix(model_path)
+                    self._configure_speculative(adaptive_params['tier'])
+                    
                     # Final memory check
                     final_memory = OptimizedMemoryManager.log_memory_status()
                     logger.info(f"Post-load memory: {final_memory['available_gb']:.2f}GB available")
@@ -412,27 +1609,384 @@ class OptimizedLlamaModel:
                     self.llm = None
                     return False
 
+    @staticmethod
+    def _n_batch_for_tier(tier):
+        """Set reduced batch size for low-resource minimal tier"""
+        return 32 if tier != 'minimal' else 1 # Lowered for stability
+
+    def _create_llama(self, model_path, n_ctx, n_batch):
+        """Build a Llama over the mmapped GGUF with the low-resource settings"""
+        from llama_cpp import Llama
+        
+        return Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,                      # Context window adjusted for low memory
+            n_threads=self.n_threads,         # Decode threads (CPU budget, tuned below)
+            n_threads_batch=self.n_threads_batch, # Prompt-eval threads
+            n_gpu_layers=0,                   # CPU only
+            verbose=False,
+            cache=self.cache,
+            
+            # === PERFORMANCE OPTIMIZATION FOR 1B MODEL on LOW-RESOURCE ===
+            use_mmap=True,                    # Memory-map file
+            use_mlock=False,                  # DO NOT Lock memory for low-ram systems
+            n_batch=n_batch,                  # Adjusted batch size for minimal tier
+            last_n_tokens_size=128,           # Smaller token buffer size
+            
+            # === LOW-RESOURCE SPECIFIC ===
+            numa=False,                       # Disable NUMA awareness
+            offload_kqv=False,                 # Offload key/query vectors to save RAM
+            flash_attn=False,                 # Disable for compatibility
+            
+            # === OPTIMIZED SETTINGS FOR GEMMA ===
+            rope_scaling_type=0,             # No rope scaling
+            rope_freq_base=10000.0,          # Default rope freq
+        )
+
+    def _maybe_rebuild_context(self, n_ctx, tier, force=False):
+        """Apply a tier's context size unless a rebuild happened too recently"""
+        shrinking = n_ctx < self.context_window
+        urgent = force or (shrinking and OptimizedMemoryManager.get_memory_pressure() == 'critical')
+        if not urgent and time.time() - self._last_context_rebuild < CONTEXT_REBUILD_MIN_INTERVAL_SECONDS:
+            self.context_rebuild_stats['deferred'] += 1
+            return False
+        return self._rebuild_context(n_ctx, tier)
+
+    def _maybe_switch_model(self, adaptive_params, force=False):
+        """Load the quantization the router picks for this tier, rate-limited like context rebuilds.
+
+        Dropping to a smaller variant under high or critical pressure skips the
+        interval. The tier's context size is applied in the same rebuild.
+        """
+        tier = adaptive_params['tier']
+        available_mb = None if force else adaptive_params['available_gb'] * 1024
+        variant = select_model_variant(tier, self.model_variant, available_mb)
+        if variant is None or variant == self.model_variant:
+            return False
+        smaller = self.model_variant is None or _variant_weights_mb(variant) < _variant_weights_mb(self.model_variant)
+        urgent = force or (smaller and OptimizedMemoryManager.get_memory_pressure() in ('high', 'critical'))
+        if not urgent and time.time() - self._last_context_rebuild < CONTEXT_REBUILD_MIN_INTERVAL_SECONDS:
+            self.model_switch_stats['deferred'] += 1
+            return False
+        
+        previous = self.model_variant
+        logger.info(f"MODEL: Switching {previous} -> {variant} (tier={tier})")
+        start_time = time.time()
+        if not self._rebuild_context(adaptive_params['context_window'], tier, _model_variant_path(variant)):
+            self.model_switch_stats['failures'] += 1
+            return False
+        self.model_variant = variant
+        self.model_filename = MODEL_VARIANTS[variant]['filename']
+        self.model_switch_stats['switches'] += 1
+        self.model_switch_stats['last_seconds'] = time.time() - start_time
+        metrics.MODEL_SWITCHES.inc(from_variant=previous, to_variant=variant)
+        return True
+
+    def _release_llama(self):
+        self._release_sequence_context()
+        llm, self.llm = self.llm, None
+        if llm is not None and hasattr(llm, 'close'):
+            llm.close()
+        del llm
+        gc.collect()
+
+    def _release_sequence_context(self):
+        context, self.sequence_context = self.sequence_context, None
+        if context is not None:
+            context.close()
+
+    def batch_context(self):
+        """The multi-sequence context for the current tier, or None when sessions decode one at a time.
+
+        Built lazily on the decode thread next to the single-sequence Llama and
+        rebuilt when the tier changes the sequence count or the Llama is
+        replaced; dropped under high or critical memory pressure.
+        """
+        if not BATCHED_DECODING_AVAILABLE or self.llm is None:
+            return None
+        tier = OptimizedMemoryManager.get_adaptive_memory_tier()
+        n_seq = min(ADAPTIVE_MEMORY_THRESHOLDS[tier]['batch_sequences'], int(BATCH_MAX_SEQUENCES or 1))
+        if n_seq < 2 or OptimizedMemoryManager.get_memory_pressure() in ('high', 'critical'):
+            self._release_sequence_context()
+            return None
+        
+        shape = (id(self.llm), n_seq, self.n_ctx(), self.n_batch)
+        context = self.sequence_context
+        if context is not None and context.shape == shape:
+            return context
+        if self._sequence_context_failed == shape:
+            return None  # Already failed for this shape; don't retry on every batch
+        self._release_sequence_context()
+        try:
+            self.sequence_context = LlamaSequenceContext(self.llm, n_seq, self.n_ctx(), self.n_batch)
+        except Exception as e:
+            self._sequence_context_failed = shape
+            self.batch_stats['failures'] += 1
+            logger.warning(f"BATCH: Multi-sequence context unavailable, decoding sessions one at a time: {e}")
+            return None
+        logger.info(f"BATCH: {n_seq} sequences x {self.n_ctx()} tokens (tier={tier})")
+        return self.sequence_context
+
+    def _rebuild_context(self, n_ctx, tier, model_path=None):
+        """Recreate the llama context with a new n_ctx / n_batch, keeping the weights mapped.
+
+        Only called at the start of a job on the scheduler's decode thread, so no
+        generation is in flight. The old context is released first: the weights
+        are file-backed mmap pages that stay in the page cache, so the new Llama
+        maps them again without re-reading the file, and two KV caches never
+        coexist. A different model_path (router switch) loads that GGUF instead.
+        """
+        old_n_ctx, old_n_batch, old_model_path = self.context_window, self.n_batch, self.model_path
+        model_path = model_path or old_model_path
+        n_batch = self._n_batch_for_tier(tier)
+        start_time = time.time()
+        self._last_context_rebuild = start_time
+        logger.info(f"CONTEXT: Rebuilding llama context n_ctx {old_n_ctx} -> {n_ctx}, n_batch {old_n_batch} -> {n_batch} (tier={tier})")
+        
+        # Saved states and the draft context are tied to the old context
+        self.kv_cache.clear()
+        self.prefix_state = None
+        self.draft_llm = None
+        self._speculative_config = None
+        self._release_llama()
+        
+        rebuilt = True
+        try:
+            self.llm = self._create_llama(model_path, n_ctx, n_batch)
+            self.context_window, self.n_batch, self.model_path = n_ctx, n_batch, model_path
+        except Exception as e:
+            logger.error(f"CONTEXT: Rebuild with n_ctx={n_ctx} failed, restoring n_ctx={old_n_ctx}: {str(e)}")
+            self.context_rebuild_stats['failures'] += 1
+            rebuilt = False
+            try:
+                self.llm = self._create_llama(old_model_path, old_n_ctx, old_n_batch)
+            except Exception as e:
+                logger.error(f"CONTEXT: Could not restore the previous context: {str(e)}")
+                self._initialized = False  # Let the next request run a full initialize_model()
+                return False
+        
+        if self.model_path != old_model_path:
+            self._reset_token_caches()
+        self._warm_system_prefix(self.model_path)
+        self._configure_speculative(tier)
+        
+        elapsed = time.time() - start_time
+        if rebuilt:
+            self.context_rebuild_stats['rebuilds'] += 1
+            self.context_rebuild_stats['last_seconds'] = elapsed
+            logger.info(f"CONTEXT: Rebuilt in {elapsed:.2f}s")
+        return rebuilt
+
+    def _apply_threads(self, n_threads, n_threads_batch):
+        """Change the live context's decode / prompt-eval thread counts"""
+        import llama_cpp
+        llama_cpp.llama_set_n_threads(self.llm._ctx.ctx, n_threads, n_threads_batch)
+        self.llm.n_threads = n_threads
+        self.llm.n_threads_batch = n_threads_batch
+
+    def _autotune_threads(self):
+        """Time each candidate thread count on the loaded model and keep the fastest.
+
+        Prompt eval is batched and usually scales with cores; single-token decode
+        is memory-bound and often peaks below the full budget, so the two are
+        chosen separately. Explicit AI_LLM_N_THREADS* settings win.
+        """
+        budget = self.cpu_budget['budget']
+        if budget <= 1 or not THREAD_BENCHMARK_ENABLED or (THREADS_OVERRIDE and THREADS_BATCH_OVERRIDE):
+            return
+        
+        probe = self.llm.tokenize(("The quick brown fox jumps over the lazy dog. " * 16).encode("utf-8"))
+        probe = probe[:THREAD_BENCHMARK_PROMPT_TOKENS]
+        decode_tokens = probe[1:1 + THREAD_BENCHMARK_DECODE_TOKENS]
+        results = {}
+        try:
+            for threads in sorted({1, max(budget // 2, 1), budget - 1, budget}):
+                self._apply_threads(threads, threads)
+                self.llm.reset()
+                start_time = time.perf_counter()
+                self.llm.eval(probe)
+                prompt_seconds = time.perf_counter() - start_time
+                
+                start_time = time.perf_counter()
+                for token in decode_tokens:
+                    self.llm.eval([token])
+                decode_seconds = time.perf_counter() - start_time
+                
+                results[threads] = {
+                    'prompt_tokens_per_second': len(probe) / prompt_seconds,
+                    'decode_tokens_per_second': len(decode_tokens) / decode_seconds
+                }
+            
+            if not THREADS_OVERRIDE:
+                self.n_threads = max(results, key=lambda t: results[t]['decode_tokens_per_second'])
+            if not THREADS_BATCH_OVERRIDE:
+                self.n_threads_batch = max(results, key=lambda t: results[t]['prompt_tokens_per_second'])
+            self.thread_benchmark = results
+            logger.info(f"Thread autotune (budget={budget}): decode={self.n_threads}, prompt={self.n_threads_batch}")
+        except Exception as e:
+            logger.warning(f"Thread autotune failed, keeping {self.n_threads}/{self.n_threads_batch}: {str(e)}")
+        finally:
+            try:
+                self._apply_threads(self.n_threads, self.n_threads_batch)
+                self.llm.reset()
+            except Exception as e:
+                logger.warning(f"Could not restore thread settings: {str(e)}")
+
+    def _system_prefix_text(self):
+        """Leading text shared by every prompt: the first user turn opens with the system prompt"""
+        return f"<start_of_turn>user\n{self.system_prompt}"
+
+    def _warm_system_prefix(self, model_path):
+        """Load the evaluated system-prompt prefix from disk, or evaluate and persist it"""
+        try:
+            prefix_text = self._system_prefix_text()
+            prefix_tokens = list(self._system_prefix_ids())
+            path = _prefix_state_path(model_path, self.n_ctx(), prefix_text)
+            start_time = time.time()
+            
+            state = _load_prefix_state(path, prefix_tokens)
+            if state is not None:
+                self.llm.load_state(state)
+                source = 'disk'
+            else:
+                self.llm.reset()
+                self.llm.eval(prefix_tokens)
+                state = self.llm.save_state()
+                _save_prefix_state(path, state)
+                source = 'evaluated'
+            
+            self.prefix_state = state
+            self.prefix_state_stats.update(tokens=len(prefix_tokens), source=source)
+            logger.info(f"System prompt prefix ({len(prefix_tokens)} tokens) {source} in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            self.prefix_state = None
+            logger.warning(f"System prompt prefix warm-up failed: {str(e)}")
+
+    def _configure_speculative(self, tier):
+        """Attach the tier's draft model to the loaded Llama (llama.cpp reads llm.draft_model per call)"""
+        tier_params = ADAPTIVE_MEMORY_THRESHOLDS[tier]
+        num_pred_tokens = tier_params.get('speculative_tokens', 0) if SPECULATIVE_AVAILABLE else 0
+        if num_pred_tokens and not getattr(self.llm, '_logits_all', False):
+            if self._speculative_config != (0, False):
+                logger.warning("Speculative decoding needs a context built with logits for every token; keeping it off")
+            num_pred_tokens = 0
+        use_draft_model = bool(num_pred_tokens and tier_params.get('speculative_draft_model') and DRAFT_MODEL_PATH)
+        config = (num_pred_tokens, use_draft_model)
+        if config == self._speculative_config:
+            return
+        self._speculative_config = config
+        
+        if not use_draft_model and self.draft_llm is not None:
+            self.draft_llm = None  # Give the draft model's memory back on lower tiers
+        
+        try:
+            if not num_pred_tokens:
+                self.llm.draft_model = None
+            elif use_draft_model and self._load_draft_llm():
+                self.llm.draft_model = SmallModelDraft(self.draft_llm, self.speculation, num_pred_tokens)
+            else:
+                self.llm.draft_model = CountingPromptLookupDecoding(
+                    self.speculation, max_ngram_size=2, num_pred_tokens=num_pred_tokens)
+            logger.info(f"Speculative decoding: {type(self.llm.draft_model).__name__ if num_pred_tokens else 'off'}, "
+                       f"{num_pred_tokens} draft tokens, tier={tier}")
+        except Exception as e:
+            self.llm.draft_model = None
+            logger.warning(f"Speculative decoding disabled: {str(e)}")
+
+    def _load_draft_llm(self):
+        """Load the optional draft GGUF with the same context size as the main model"""
+        if self.draft_llm is not None:
+            return True
+        if not os.path.exists(DRAFT_MODEL_PATH):
+            logger.warning(f"Draft model not found: {DRAFT_MODEL_PATH}; falling back to prompt lookup")
+            return False
+        try:
+            from llama_cpp import Llama
+            self.draft_llm = Llama(
+                model_path=DRAFT_MODEL_PATH,
+                n_ctx=self.n_ctx(),
+                n_threads=self.n_threads,
+                n_threads_batch=self.n_threads_batch,
+                n_gpu_layers=0,
+                use_mmap=True,
+                use_mlock=False,
+                verbose=False,
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"Draft model loading failed: {str(e)}; falling back to prompt lookup")
+            return False
+
     def is_initialized(self):
         """Check initialization status"""
         return self.llm is not None
 
     def count_tokens(self, text):
-        """Optimized token counting"""
+        """Count tokens with the loaded model's tokenizer (estimate until the model is loaded)"""
         if not text:
             return 0
         
-        # Use simple estimation for speed
-        return len(text.split()) * 1.2  # Conservative estimate
+        if self.llm is None:
+            return int(len(text.split()) * 1.2) + 1  # Conservative estimate
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def n_ctx(self):
+        """Context size of the loaded model (the configured window until it is loaded)"""
+        return self.llm.n_ctx() if self.llm is not None else self.context_window
+
+    def _format_turn(self, role, content):
+        return f"<start_of_turn>{role}\n{content}<end_of_turn>"
+
+    def _memo_ids(self, holder, key, text_func, add_bos=False):
+        """Token IDs of one template piece, tokenized on first use and kept in `holder` as int32"""
+        ids = holder.get(key)
+        if ids is None:
+            text = text_func()
+            ids = holder[key] = array('i', self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True))
+        return ids
+
+    def _reset_token_caches(self):
+        """Forget the model-level template pieces (another GGUF may tokenize differently)"""
+        self._template_token_ids = {}
+
+    def _system_prefix_ids(self):
+        """BOS + the opening of the first user turn up to the end of the system prompt"""
+        return self._memo_ids(self._template_token_ids, 'system_prefix', self._system_prefix_text, add_bos=True)
+
+    def _generation_prompt_ids(self):
+        return self._memo_ids(self._template_token_ids, 'generation_prompt', lambda: "<start_of_turn>model")
+
+    def _turn_ids(self, message):
+        """A whole history turn plus its trailing newline, tokenized once per message"""
+        role = "model" if message["role"] == "assistant" else message["role"]
+        return self._memo_ids(message, 'token_ids',
+                              lambda: self._format_turn(role, message['content'].strip()) + "\n")
+
+    def _first_turn_ids(self, message):
+        """The rest of the first user turn, after the system prompt (and memory note)"""
+        return self._memo_ids(message, 'first_token_ids',
+                              lambda: f"\n\n{message['content'].strip()}<end_of_turn>\n")
+
+    def _message_tokens(self, message):
+        """Token cost of one formatted history turn (estimated until the model is loaded)"""
+        if self.llm is None:
+            role = "model" if message["role"] == "assistant" else message["role"]
+            return self.count_tokens(self._format_turn(role, message['content'].strip()) + "\n")
+        return len(self._turn_ids(message))
+
+    def _truncate_to_tokens(self, text, max_tokens):
+        """Keep the first max_tokens tokens of text"""
+        tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=False)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.llm.detokenize(tokens[:max_tokens]).decode("utf-8", errors="ignore")
 
     def add_to_history(self, chat_session_id, role, content):
         """Optimized history management for high-memory system"""
         if not chat_session_id:
             return
             
-        if chat_session_id not in self.conversation_history:
-            self.conversation_history[chat_session_id] = []
-        
-        self.conversation_history[chat_session_id].append({
+        self.conversation_history.append(chat_session_id, {
             "role": role,
             "content": content
         })
@@ -441,53 +1995,168 @@ class OptimizedLlamaModel:
         adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
         max_history = adaptive_params['max_history']
         
-        # Only trim if we have excessive history
-        if len(self.conversation_history[chat_session_id]) > max_history * 2:
-            self.conversation_history[chat_session_id] = \
-                self.conversation_history[chat_session_id][-max_history:]
+        # Older turns are normally compacted into the memory note; this trim is the backstop
+        history = self.conversation_history.get(chat_session_id)
+        limit = max_history * (HISTORY_UNSUMMARIZED_LIMIT_FACTOR if HISTORY_SUMMARY_ENABLED else 2)
+        if len(history) > limit:
+            if HISTORY_SUMMARY_ENABLED:
+                logger.warning(f"History summaries are behind for session {chat_session_id}; "
+                               f"dropping {len(history) - max_history} older messages")
+            self.conversation_history.replace(chat_session_id, history[-max_history:])
         
-        # Less frequent garbage collection
-        self._optimized_garbage_collect()
+        # Evict idle / over-budget sessions, harder as memory pressure rises
+        self.conversation_history.sweep(OptimizedMemoryManager.get_memory_pressure())
+
+    def _on_history_evicted(self, chat_session_id):
+        """A session whose history is gone has no use for its KV snapshot or continuation either"""
+        self.kv_cache.discard(chat_session_id)
+        self.continuations.discard(chat_session_id)
 
     def get_conversation_history(self, chat_session_id):
         """Get history with optimized memory management"""
         history = self.conversation_history.get(chat_session_id, [])
-        
+        if HISTORY_SUMMARY_ENABLED:
+            # Turns beyond max_history are compacted into the memory note, not dropped;
+            # the prompt is bounded in tokens by _select_history_within_budget
+            return history
+
         # Get adaptive parameters for history management
         adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
         max_history = adaptive_params['max_history']
-        
+
         # Return more history for better context
         return history[-max_history:] if len(history) > max_history else history
 
-    def build_prompt_with_history(self, chat_session_id):
-        """Build prompt using the official Gemma 3 chat template."""
-        try:
-            history = self.get_conversation_history(chat_session_id)
-            prompt_parts = []
+    def _memory_text(self, memory):
+        return f"Notes from earlier in this conversation: {memory['content'].strip()}"
 
-            for i, message in enumerate(history):
-                role = "model" if message["role"] == "assistant" else message["role"]
-                content = message['content'].strip()
+    def _memory_ids(self, memory):
+        return self._memo_ids(memory, 'token_ids', lambda: f"\n\n{self._memory_text(memory)}")
 
-                # Prepend system prompt to the first user message
-                if i == 0 and role == 'user':
-                    content = f"{self.system_prompt}\n\n{content}"
-                
-                prompt_parts.append(f"<start_of_turn>{role}\n{content}<end_of_turn>")
+    def _memory_tokens(self, memory):
+        """Token cost of the memory note in the first user turn"""
+        if memory is None:
+            return 0
+        if self.llm is None:
+            return self.count_tokens(f"{self._memory_text(memory)}\n\n")
+        return len(self._memory_ids(memory))
+
+    def history_tokens(self, chat_session_id):
+        """Real token cost of a session's stored turns plus its memory note"""
+        history = self.conversation_history.get(chat_session_id, [])
+        memory = self.conversation_history.get_memory(chat_session_id)
+        return sum(self._message_tokens(m) for m in history) + self._memory_tokens(memory)
+
+    def _select_history_within_budget(self, history, memory=None):
+        """Newest-first selection of turns whose real token cost fits max_prompt_tokens.
 
-            # Add the generation prompt for the model's turn
-            prompt_parts.append("<start_of_turn>model")
+        The newest message is always kept, and the selection never starts on a
+        model turn, because the system prompt (and memory note) ride on the first user turn.
+        """
+        max_prompt_tokens = min(self.max_prompt_tokens, self.n_ctx() - self.max_response_tokens)
+        # BOS + the system prompt + the "<start_of_turn>model" generation prompt + the memory note
+        if self.llm is None:
+            overhead = 1 + self.count_tokens(f"{self.system_prompt}\n\n") + self.count_tokens("<start_of_turn>model")
+        else:
+            overhead = len(self._system_prefix_ids()) + len(self._generation_prompt_ids())
+        overhead += self._memory_tokens(memory)
+        budget = max_prompt_tokens - overhead
+        selected = []
+        used = 0
+        for message in reversed(history):
+            cost = self._message_tokens(message)
+            if selected and used + cost > budget:
+                break
+            selected.append(message)
+            used += cost
+        selected.reverse()
+        
+        while len(selected) > 1 and selected[0]["role"] == "assistant":
+            selected.pop(0)
+        return selected
+
+    def _history_token_ids(self, history, memory=None):
+        """Token IDs of the history turns, concatenated from per-message pieces.
+
+        Same Gemma 3 template as before (system prompt and memory note open the
+        first user turn), but no template string is rebuilt or re-tokenized:
+        each piece starts right after a special token, so only new turns are
+        ever tokenized and every turn's IDs are identical from one prompt to
+        the next.
+        """
+        ids = []
+        for i, message in enumerate(history):
+            if i == 0 and message['role'] == 'user':
+                ids.extend(self._system_prefix_ids())
+                if memory is not None:
+                    ids.extend(self._memory_ids(memory))
+                ids.extend(self._first_turn_ids(message))
+            else:
+                if i == 0:
+                    ids.append(self.llm.token_bos())
+                ids.extend(self._turn_ids(message))
+        return ids
+
+    def standalone_prompt_tokens(self, prompt):
+        """Token IDs of a single-turn prompt with the system prompt"""
+        ids = self._history_token_ids([{"role": "user", "content": prompt}])
+        ids.extend(self._generation_prompt_ids())
+        return ids
 
-            final_prompt = "\n".join(prompt_parts)
-            logger.debug(f"Built prompt length: {len(final_prompt)} chars")
-            return final_prompt
+    def build_prompt_tokens(self, chat_session_id):
+        """Token IDs of the session's prompt in the official Gemma 3 chat template, ready for create_completion"""
+        history = []
+        try:
+            memory = self.conversation_history.get_memory(chat_session_id)
+            history = self._select_history_within_budget(self.get_conversation_history(chat_session_id), memory)
+            prompt_tokens = self._history_token_ids(history, memory)
+            prompt_tokens.extend(self._generation_prompt_ids())
+            logger.debug(f"Built prompt: {len(prompt_tokens)} tokens, {len(history)} turns")
+            return prompt_tokens
             
         except Exception as e:
             logger.error(f"Error building prompt: {traceback.format_exc()}")
             # Fallback prompt that also follows the template
             user_input = history[-1]['content'] if history else ""
-            return f"<start_of_turn>user\n{self.system_prompt}\n\n{user_input.strip()}<end_of_turn>\n<start_of_turn>model"
+            return self.standalone_prompt_tokens(user_input)
+
+    def _restore_session_state(self, chat_session_id, prompt_tokens):
+        """Load whichever saved KV state shares more of the prompt than the live context.
+
+        The session's own state is preferred; the persisted system-prompt prefix
+        is the fallback for new sessions, evicted sessions and standalone prompts.
+        """
+        try:
+            live_prefix = _common_prefix_length(self.llm.input_ids, prompt_tokens)
+            
+            if chat_session_id and self.kv_cache.capacity_bytes > 0:
+                state, cached_prefix = self.kv_cache.lookup(chat_session_id, prompt_tokens)
+                if state is not None and cached_prefix > live_prefix:
+                    self.llm.load_state(state)
+                    self.kv_cache.record(hit=True)
+                    logger.debug(f"KV cache hit for {chat_session_id}: reusing {cached_prefix}/{len(prompt_tokens)} prompt tokens")
+                    return
+                if live_prefix < len(prompt_tokens) // 2:
+                    # Neither the cache nor the live context covers this session's history
+                    self.kv_cache.record(hit=False)
+            
+            if self.prefix_state is not None:
+                prefix = _common_prefix_length(self.prefix_state.input_ids, prompt_tokens)
+                if prefix > live_prefix:
+                    self.llm.load_state(self.prefix_state)
+                    self.prefix_state_stats['restores'] += 1
+                    logger.debug(f"Restored system prompt prefix: reusing {prefix}/{len(prompt_tokens)} prompt tokens")
+        except Exception as e:
+            logger.warning(f"KV cache restore failed for {chat_session_id}: {str(e)}")
+
+    def _save_session_state(self, chat_session_id):
+        """Snapshot the context after a turn so the next turn can resume from it"""
+        if not chat_session_id or self.kv_cache.capacity_bytes <= 0:
+            return
+        try:
+            self.kv_cache.store(chat_session_id, self.llm.save_state())
+        except Exception as e:
+            logger.warning(f"KV cache save failed for {chat_session_id}: {str(e)}")
 
     def _enhanced_post_process_response(self, response):
         """Post-process response for Gemma - remove turn markers."""
@@ -496,113 +2165,990 @@ class OptimizedLlamaModel:
         response = response.replace("<start_of_turn>", "").replace("<end_of_turn>", "")
         return response.strip()
 
-# === OPTIMIZED GENERATION FUNCTION ===
-def generate_deployment_response(prompt, chat_session=None, user=None):
-    """High-performance response generation optimized for 1-core, 2GB system with Gemma 3 1B"""
-    try:
-        model = OptimizedLlamaModel()
-        
-        # Log memory status for monitoring
-        memory_status = OptimizedMemoryManager.log_memory_status()
-        
-        # Light memory check (emergency likely with 2GB)
-        if OptimizedMemoryManager.check_memory_emergency():
-            OptimizedMemoryManager.emergency_memory_recovery()
-            logger.warning("Memory recovery performed")
-        
-        # Check and adjust parameters dynamically
-        model._check_and_adjust_parameters()
-        
-        # Initialize if needed
-        if not model.is_initialized():
-            logger.info("Initializing low-resource model...")
+# === INFERENCE SCHEDULER ===
+class InferenceOverloaded(Exception):
+    """The queue can't take or start a job in time; retry_after is a hint in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, retry_after)  # Both args, so it pickles across the worker socket
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
+
+class InferenceQueueFull(InferenceOverloaded):
+    """Rejected on submission: the queue is already at its maximum depth."""
+
+class InferenceQueueTimeout(InferenceOverloaded):
+    """Withdrawn from the queue after waiting longer than the maximum queue wait."""
+
+class GenerationCancelled(Exception):
+    """The generation was cancelled (explicitly or because its client went away)."""
+
+class ContinuationUnavailable(Exception):
+    """The session has no cut-off answer to continue (never truncated, expired or superseded)."""
+
+class InferenceJob:
+    """One generation waiting for, or running on, the shared model.
+
+    Streaming jobs push (event, data) tuples onto `events`; a None sentinel
+    marks the end. `result` holds the return value once `finished` is set.
+    Setting `cancelled` stops decoding at the next token. Background jobs also
+    stop when `preempted` is set because a chat generation is waiting, and
+    generations stop once `deadline` passes (`deadline_exceeded` is then set).
+    Untimed jobs (cache warm-up, benchmarks) never get a deadline. `owner` is the user id
+    the generation runs for (None for guests); continuations are bound to it.
+    Chat generations carry their `mode` ('generate' or 'stream'), which lets
+    the scheduler decode them in a shared batch; args are then
+    (prompt, chat_session, cache_key).
+    """
+
+    def __init__(self, func, args, chat_session=None, background=False, timed=True, owner=None, mode=None):
+        self.func = func
+        self.args = args
+        self.chat_session = chat_session
+        self.background = background
+        self.timed = timed
+        self.owner = owner
+        self.mode = mode
+        self.preempted = threading.Event()
+        self.events = queue.Queue()
+        self.finished = threading.Event()
+        self.result = None
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.deadline = None
+        self.deadline_exceeded = False
+
+    def emit(self, event, data):
+        self.events.put((event, data))
+
+    def stopping_criteria(self):
+        """llama.cpp stopping criteria checked after every token, so a cancel frees the core at once"""
+        from llama_cpp import StoppingCriteriaList
+        return StoppingCriteriaList([lambda input_ids, logits: self._should_stop()])
+
+    def _should_stop(self):
+        if self.cancelled.is_set() or self.preempted.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.deadline_exceeded = True
+            return True
+        return False
+
+class InferenceScheduler:
+    """Single owner of `model.llm`: one decode thread runs queued jobs in order.
+
+    llama-cpp-python's Llama wraps a single-sequence context, so concurrent
+    create_completion calls would race on the same KV cache. Every generation
+    is funnelled through this queue instead; per-session KV reuse keeps
+    switching between sessions cheap. When chat jobs are waiting behind the
+    one being started and the tier allows it, they are decoded together in a
+    BatchedDecoder instead, joining as sequences free up. Background jobs
+    (history summaries) sit in a separate lane that only runs while no chat
+    generation is queued.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = super(InferenceScheduler, cls).__new__(cls)
+                    cls._instance._reset()
+        return cls._instance
+
+    def _reset(self):
+        self._queue = deque()
+        self._background = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = os.getpid()
+        self.active_job = None
+        self.batch_jobs = []  # Chat jobs decoding together in the current batch
+        self.completed_jobs = 0
+        self.rejected_jobs = 0
+        self.expired_jobs = 0
+        self.background_jobs = 0
+        self.avg_job_seconds = None  # Moving average of job run time
+
+    def _ensure_thread(self):
+        # Threads don't survive fork (gunicorn --preload), so restart in each worker
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='llm-decode', daemon=True)
+            self._thread.start()
+
+    def _estimated_wait_locked(self, jobs_ahead):
+        per_job = self.avg_job_seconds or DEFAULT_JOB_SECONDS_ESTIMATE
+        # A running background job yields at its next token, so it doesn't count
+        running = bool(self._running_locked())
+        return per_job * (jobs_ahead + (1 if running else 0))
+
+    def submit(self, job):
+        """Queue a job, or raise InferenceQueueFull when the queue is at max depth"""
+        with self._cond:
+            self._ensure_thread()
+            if len(self._queue) >= QUEUE_MAX_DEPTH:
+                self.rejected_jobs += 1
+                raise InferenceQueueFull(
+                    "The assistant is busy with other requests. Please try again shortly.",
+                    retry_after=self._estimated_wait_locked(len(self._queue)))
+            self._queue.append(job)
+            if self.active_job is not None and self.active_job.background:
+                self.active_job.preempted.set()
+            self._cond.notify()
+        return job
+
+    def submit_background(self, job):
+        """Queue low-priority work behind all chat jobs; None if the session already has some pending"""
+        with self._cond:
+            self._ensure_thread()
+            pending = list(self._background) + [self.active_job]
+            if any(other is not None and other.background and other.chat_session == job.chat_session
+                   for other in pending):
+                return None
+            job.background = True
+            self._background.append(job)
+            self._cond.notify()
+        return job
+
+    def withdraw(self, job):
+        """Remove a job that hasn't started yet; False if it is already running or done"""
+        with self._cond:
+            try:
+                self._queue.remove(job)
+            except ValueError:
+                return False
+        job.started.set()  # Wake anyone waiting for it to start; they find it finished
+        job.finished.set()
+        job.events.put(None)
+        return True
+
+    def cancel_job(self, job):
+        """Cancel one job: withdrawn if still queued, stopped at the next token if running"""
+        job.cancelled.set()
+        self.withdraw(job)
+
+    def cancel(self, chat_session):
+        """Cancel a session's queued and running jobs; returns how many were cancelled"""
+        with self._cond:
+            jobs = [job for job in self._queue if job.chat_session == chat_session]
+            jobs += [job for job in self._running_locked() if job.chat_session == chat_session]
+        for job in jobs:
+            self.cancel_job(job)
+        if jobs:
+            logger.info(f"Cancelled {len(jobs)} generation(s) for session {chat_session}")
+        return len(jobs)
+
+    def _running_locked(self):
+        """Chat jobs (not background ones) on the decode thread, alone or batched"""
+        job = self.active_job
+        return ([job] if job is not None and not job.background else []) + self.batch_jobs
+
+    def _is_running_locked(self, chat_session):
+        """Whether the session's chat generation is on the decode thread"""
+        return any(job.chat_session == chat_session for job in self._running_locked())
+
+    def wait_until_started(self, job):
+        """Block until the job starts; withdraw it and raise InferenceQueueTimeout after the max wait"""
+        if job.started.wait(QUEUE_MAX_WAIT_SECONDS):
+            return
+        if self.withdraw(job):
+            with self._cond:
+                self.expired_jobs += 1
+                retry_after = self._estimated_wait_locked(len(self._queue))
+            raise InferenceQueueTimeout(
+                "The assistant is busy with other requests. Please try again shortly.",
+                retry_after=retry_after)
+        # Otherwise it was picked up just as the wait ran out; callers wait on finished/events
+
+    def position(self, chat_session):
+        """Where a session's job stands: running, queued (with jobs ahead of it) or idle"""
+        with self._cond:
+            depth = len(self._queue)
+            if self._is_running_locked(chat_session):
+                return {'state': 'running', 'position': 0, 'queue_depth': depth, 'estimated_wait_seconds': 0}
+            for index, job in enumerate(self._queue):
+                if job.chat_session == chat_session:
+                    return {
+                        'state': 'queued',
+                        'position': index + 1,
+                        'queue_depth': depth,
+                        'estimated_wait_seconds': self._estimated_wait_locked(index)
+                    }
+            return {'state': 'idle', 'position': None, 'queue_depth': depth,
+                    'estimated_wait_seconds': self._estimated_wait_locked(depth)}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._background:
+                    self._cond.wait()
+                job = self._queue.popleft() if self._queue else self._background.popleft()
+                self.active_job = job
+                # A lone job keeps the single-sequence path and its per-session KV reuse
+                batching = job.mode is not None and bool(self._queue) and self._joins_batch_locked(self._queue[0], [job])
             
-            with optimized_memory_operation():
-                success = model.initialize_model()
+            context = _batch_context() if batching else None
+            if context is not None:
+                self._run_batch(BatchedDecoder(context, OptimizedLlamaModel().batch_stats), job)
+                continue
             
-            if not success:
-                logger.error("LOW-RESOURCE: Model initialization failed")
-                return "I'm currently unavailable due to system constraints. Please try again shortly."
+            job.started_at = time.time()
+            job.started.set()
+            try:
+                if not job.cancelled.is_set():
+                    job.result = job.func(job, *job.args)
+            except Exception as e:
+                logger.error(f"Inference job failed: {traceback.format_exc()}")
+                job.emit('error', "I'm currently experiencing technical difficulties. Please try again shortly.")
+            finally:
+                self._finish_job(job)
+
+    def _finish_job(self, job):
+        duration = time.time() - job.started_at
+        with self._cond:
+            if job is self.active_job:
+                self.active_job = None
+            else:
+                self.batch_jobs.remove(job)
+            if job.background:
+                self.background_jobs += 1  # Kept out of the Retry-After estimate
+            else:
+                self.completed_jobs += 1
+                self.avg_job_seconds = duration if self.avg_job_seconds is None else 0.8 * self.avg_job_seconds + 0.2 * duration
+        job.finished.set()
+        job.events.put(None)
+
+    @staticmethod
+    def _joins_batch_locked(job, batch):
+        """Chat jobs batch together, but never two turns of one session (the second needs the first's answer)"""
+        return job.mode is not None and (job.chat_session is None
+                                         or all(other.chat_session != job.chat_session for other in batch))
+
+    def _take_batch_jobs_locked(self, slots):
+        """Move queue-head chat jobs into the batch, in order, up to `slots` of them"""
+        taken = []
+        while len(taken) < slots and self._queue and self._joins_batch_locked(self._queue[0], self.batch_jobs):
+            job = self._queue.popleft()
+            self.batch_jobs.append(job)
+            taken.append(job)
+        return taken
+
+    def _run_batch(self, decoder, job):
+        """Continuous batching: decode until the batch drains, admitting queued chat jobs as sequences free up"""
+        with self._cond:
+            self.active_job = None
+            self.batch_jobs.append(job)
+            newcomers = [job] + self._take_batch_jobs_locked(decoder.free_slots() - 1)
+        while True:
+            for job in newcomers:
+                self._admit(decoder, job)
+            if not decoder.sequences:
+                break
+            try:
+                finished = decoder.step()
+            except Exception as e:
+                logger.error(f"Batched decode failed: {traceback.format_exc()}")
+                for sequence in decoder.abort():
+                    _record_generation(sequence.job.mode, 'error')
+                    sequence.job.emit('error', "I apologize, but I encountered an error while processing your request. Please try again.")
+                    self._finish_job(sequence.job)
+                break
+            for sequence in finished:
+                try:
+                    _finish_batched(sequence)
+                except Exception as e:
+                    logger.error(f"Batched job failed: {traceback.format_exc()}")
+                    sequence.job.emit('error', "I'm currently experiencing technical difficulties. Please try again shortly.")
+                finally:
+                    self._finish_job(sequence.job)
+            with self._cond:
+                newcomers = self._take_batch_jobs_locked(decoder.free_slots())
+
+    def _admit(self, decoder, job):
+        job.started_at = time.time()
+        job.started.set()
+        sequence = None
+        try:
+            if not job.cancelled.is_set():
+                sequence = _start_batched(job)
+        except Exception as e:
+            logger.error(f"Batched job failed: {traceback.format_exc()}")
+            _record_generation(job.mode, 'error')
+            job.emit('error', "I'm currently experiencing technical difficulties. Please try again shortly.")
+        if sequence is None:
+            self._finish_job(job)
+        else:
+            decoder.admit(sequence)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'active': bool(self._running_locked()),
+                'batched': len(self.batch_jobs),
+                'background_queued': len(self._background),
+                'background_completed': self.background_jobs,
+                'completed': self.completed_jobs,
+                'rejected': self.rejected_jobs,
+                'expired': self.expired_jobs,
+                'max_depth': QUEUE_MAX_DEPTH,
+                'max_wait_seconds': QUEUE_MAX_WAIT_SECONDS,
+                'avg_job_seconds': self.avg_job_seconds
+            }
+
+# === OPTIMIZED GENERATION FUNCTION ===
+def _prepare_generation(prompt, chat_session=None):
+    """Shared setup for blocking and streaming generation.
+
+    Returns (model, generation_params), or (None, fallback_message) when the
+    model could not be initialized.
+    """
+    model = OptimizedLlamaModel()
+    
+    # Log memory status for monitoring
+    memory_status = OptimizedMemoryManager.log_memory_status()
+    
+    # Light memory check (emergency likely with 2GB)
+    if OptimizedMemoryManager.check_memory_emergency():
+        OptimizedMemoryManager.emergency_memory_recovery()
+        logger.warning("Memory recovery performed")
+    
+    # Check and adjust parameters dynamically
+    model._check_and_adjust_parameters()
+    
+    # Initialize if needed
+    if not model.is_initialized():
+        logger.info("Initializing low-resource model...")
         
-        # Generate response with optimized parameters
         with optimized_memory_operation():
-            if chat_session:
-                model.add_to_history(chat_session, "user", prompt)
-                prompt_with_history = model.build_prompt_with_history(chat_session)
-            else:
-                # Use the official Gemma 3 template for standalone queries
-                prompt_with_history = f"<start_of_turn>user\n{model.system_prompt}\n\n{prompt.strip()}<end_of_turn>\n<start_of_turn>model"
+            success = model.initialize_model()
+        
+        if not success:
+            logger.error("LOW-RESOURCE: Model initialization failed")
+            return None, "I'm currently unavailable due to system constraints. Please try again shortly."
+    
+    prompt_tokens = _prompt_tokens(model, prompt, chat_session)
+    model._restore_session_state(chat_session, prompt_tokens)
+    return model, _generation_parameters(model, prompt_tokens)
+
+def _prompt_tokens(model, prompt, chat_session=None):
+    """Record the user's message in the session history and assemble the prompt token IDs"""
+    # A message that can't fit on its own is cut before it is stored, so later turns don't hit it again
+    memory = model.conversation_history.get_memory(chat_session) if chat_session else None
+    prompt = _fit_message_to_context(model, prompt, memory)
+    
+    # Prompts are assembled as token IDs; only the new message is tokenized
+    if chat_session:
+        model.add_to_history(chat_session, "user", prompt)
+        # Keeps as many recent turns as fit next to the new message
+        return model.build_prompt_tokens(chat_session)
+    # Use the official Gemma 3 template for standalone queries
+    return model.standalone_prompt_tokens(prompt)
+
+def _fit_message_to_context(model, prompt, memory=None):
+    """Keep the head of a message too long to fit in n_ctx with room for a reply"""
+    room = model.n_ctx() - MIN_RESPONSE_TOKENS
+    overhead = (len(model._system_prefix_ids()) + len(model._generation_prompt_ids())
+                + model._memory_tokens(memory) + TURN_WRAPPER_TOKENS)
+    if len(prompt.encode("utf-8")) + overhead <= room:
+        return prompt  # Never more tokens than bytes: fits without tokenizing
+    
+    overflow = len(model.standalone_prompt_tokens(prompt)) + model._memory_tokens(memory) - room
+    if overflow <= 0:
+        return prompt
+    keep = max(model.count_tokens(prompt) - overflow, 1)
+    logger.warning(f"Message exceeds n_ctx={model.n_ctx()} by {overflow} tokens; truncating it to {keep} tokens")
+    return model._truncate_to_tokens(prompt.strip(), keep)
+
+def _generation_parameters(model, prompt_tokens):
+    """create_completion arguments for a prompt whose KV state has been restored"""
+    model.speculation.begin()
+    model.last_prompt_tokens = len(prompt_tokens)
+    
+    # Get current adaptive parameters for generation
+    adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
+    
+    # Full tier budget, clamped to what is left of the context after the prompt
+    effective_max_tokens = max(min(model.max_response_tokens, model.n_ctx() - len(prompt_tokens)), 1)
+
+    # Low-resource generation parameters
+    return {
+        'prompt': prompt_tokens,  # Token IDs: llama.cpp evaluates them without re-tokenizing
+        'max_tokens': effective_max_tokens,
+        'stop': STOP_SEQUENCES,
+        **_sampling_parameters(adaptive_params['tier']),
+        'frequency_penalty': 0.0,
+        'presence_penalty': 0.0,
+        'stream': False,
+        'echo': False,
+    }
+
+def _sampling_parameters(tier):
+    """Tier-based sampling settings optimized for Gemma 3 1B on low-resource"""
+    if tier == 'minimal':
+        top_p = 0.80
+        top_k = 30
+    elif tier == 'low':
+        top_p = 0.85
+        top_k = 40
+    elif tier == 'medium':
+        top_p = 0.90
+        top_k = 50
+    else:  # high tier
+        top_p = 0.92
+        top_k = 60
+    
+    return {
+        'temperature': 0.75,  # Increased for more creative and natural responses
+        'top_p': top_p,
+        'top_k': top_k,
+        'repeat_penalty': 1.1,  # Standard penalty to discourage repetition
+    }
+
+# === FIRST-TURN RESPONSE CACHE ===
+def _response_cache_key(model, prompt, chat_session=None):
+    """Cache key for a first-turn message, or None when the cache doesn't apply"""
+    from .response_cache import ResponseCache, get_response_cache
+    
+    if get_response_cache() is None:
+        return None
+    # Only first turns are context-free; later turns depend on the session history
+    if chat_session and model.conversation_history.get(chat_session):
+        return None
+    
+    tier = OptimizedMemoryManager.get_adaptive_memory_tier()
+    sampling = dict(_sampling_parameters(tier), max_tokens=model.max_response_tokens)
+    return ResponseCache.make_key(prompt, model.model_filename, model.system_prompt, sampling)
+
+def _cached_response(model, cache_key, prompt, chat_session=None):
+    """Serve a cached first-turn answer (recording it in the session history), or None"""
+    from .response_cache import get_response_cache
+    
+    if cache_key is None:
+        return None
+    response = get_response_cache().get(cache_key)
+    if response is not None and chat_session:
+        model.add_to_history(chat_session, "user", prompt)
+        model.add_to_history(chat_session, "assistant", response)
+    return response
+
+def _store_cached_response(cache_key, response, finish_reason):
+    """Only complete answers are worth replaying"""
+    from .response_cache import get_response_cache
+    
+    if cache_key is not None and finish_reason == 'stop' and response:
+        get_response_cache().set(cache_key, response)
+
+def _finish_generation(model, chat_session, raw_text, finish_reason=None, cache_key=None,
+                       truncated=None, prompt_tokens=None, owner=None, save_state=True):
+    """Post-process the generated text and record it in the session history.
+
+    A `truncated` answer ('deadline' or 'max_tokens') is kept in the history as
+    is, never cached, and returned as a TruncatedResponse with its continuation.
+    save_state=False (batched sequences) leaves model.llm's KV snapshot alone:
+    the llm didn't decode this answer.
+    """
+    ai_response = model._post_process_response(raw_text.strip())
+    if not truncated:
+        _store_cached_response(cache_key, ai_response, finish_reason)
+    
+    # Log final response stats
+    logger.debug(f"Final response length: {len(ai_response)} chars")
+    
+    if chat_session:
+        model.add_to_history(chat_session, "assistant", ai_response)
+        if save_state:
+            model._save_session_state(chat_session)
+        _schedule_history_summary(model, chat_session)
+    
+    # Scheduled garbage collection (full collections only under memory pressure)
+    model._optimized_garbage_collect()
+    
+    if truncated:
+        continuation = _record_continuation(model, chat_session, prompt_tokens, raw_text, truncated, owner)
+        return TruncatedResponse(ai_response, truncated, continuation)
+    if chat_session:
+        model.continuations.discard(chat_session)  # Only the latest answer can be continued
+    return ai_response
+
+def _generation_budget_seconds(tier):
+    """The tier's latency budget per generation, or None when deadlines are off"""
+    if not GENERATION_DEADLINE_SECONDS:
+        return None
+    return ADAPTIVE_MEMORY_THRESHOLDS[tier].get('generation_deadline_seconds') or GENERATION_DEADLINE_SECONDS
+
+def _generation_deadline(job):
+    """Wall-clock time the job must stop decoding by, or None when deadlines are off"""
+    if not job.timed:
+        return None
+    budget = _generation_budget_seconds(OptimizedMemoryManager.get_adaptive_memory_tier())
+    if budget is None:
+        return None
+    # Queue wait counts against the budget, but a late start still gets to say something
+    return max(job.submitted_at + budget, time.time() + GENERATION_MIN_DECODE_SECONDS)
+
+def _truncation_reason(job, finish_reason):
+    """'deadline' or 'max_tokens' when the answer was cut off, else None"""
+    if job.deadline_exceeded:
+        return 'deadline'
+    if finish_reason == 'length':
+        return 'max_tokens'
+    return None
+
+def _record_continuation(model, chat_session, prompt_tokens, raw_text, reason, owner=None):
+    """Remember where a cut-off answer stopped; returns the handle for the client, or None"""
+    if not chat_session:
+        return None
+    record = {
+        'id': uuid.uuid4().hex,
+        'owner': owner,
+        'created_at': time.time(),
+        'reason': reason,
+        'prompt_tokens': array('i', prompt_tokens),
+        'text': raw_text,
+    }
+    model.continuations.put(chat_session, record)
+    logger.info(f"Generation for session {chat_session} truncated ({reason}); continuation {record['id']} saved")
+    return {'id': record['id'], 'chat_session': chat_session, 'expires_in_seconds': model.continuations.ttl}
+
+def _record_generation(mode, outcome, model=None, completion_tokens=0, seconds=None,
+                       first_token_seconds=None):
+    """Per-request counters and histograms for /api/ai/metrics"""
+    metrics.GENERATION_REQUESTS.inc(mode=mode, outcome=outcome)
+    if model is None or seconds is None:
+        return
+    metrics.PROMPT_TOKENS.inc(model.last_prompt_tokens)
+    metrics.COMPLETION_TOKENS.inc(completion_tokens)
+    metrics.GENERATION_SECONDS.observe(seconds, mode=mode)
+    if seconds > 0 and completion_tokens:
+        metrics.GENERATION_TOKENS_PER_SECOND.observe(completion_tokens / seconds, mode=mode)
+    if first_token_seconds is not None:
+        metrics.TIME_TO_FIRST_TOKEN.observe(first_token_seconds)
+        if first_token_seconds > 0:
+            metrics.PROMPT_EVAL_TOKENS_PER_SECOND.observe(model.last_prompt_tokens / first_token_seconds)
+        if completion_tokens > 1 and seconds > first_token_seconds:
+            metrics.DECODE_TOKENS_PER_SECOND.observe((completion_tokens - 1) / (seconds - first_token_seconds))
+
+def _discard_cancelled_turn(model, chat_session):
+    """Drop the user turn of a cancelled generation; nothing gets saved for it"""
+    if not chat_session:
+        return
+    history = model.conversation_history.get(chat_session)
+    if history and history[-1]['role'] == 'user':
+        model.conversation_history.replace(chat_session, history[:-1])
+
+def _generate_response(job, prompt, chat_session=None, cache_key=None):
+    """Blocking generation; runs on the scheduler's decode thread"""
+    try:
+        with optimized_memory_operation():
+            model, generation_params = _prepare_generation(prompt, chat_session)
+            if model is None:
+                _record_generation('generate', 'error')
+                return generation_params
             
             try:
-                # Get current adaptive parameters for generation
-                adaptive_params = OptimizedMemoryManager.get_adaptive_parameters()
-                
-                # Use full token budget for high-performance system
-                effective_max_tokens = model.max_response_tokens
-
-                # Optimized temperature for Gemma 3 1B on low-resource
-                temperature = 0.75  # Increased for more creative and natural responses
-
-                # Tier-based generation parameters optimized for Gemma
-                if adaptive_params['tier'] == 'minimal':
-                    top_p = 0.80
-                    top_k = 30
-                elif adaptive_params['tier'] == 'low':
-                    top_p = 0.85
-                    top_k = 40
-                elif adaptive_params['tier'] == 'medium':
-                    top_p = 0.90
-                    top_k = 50
-                else:  # high tier
-                    top_p = 0.92
-                    top_k = 60
-                
-                # Low-resource generation parameters
-                generation_params = {
-                    'prompt': prompt_with_history,
-                    'max_tokens': effective_max_tokens,
-                    'stop': ["<end_of_turn>", "<|eot_id|>", ""], # Added more stop tokens
-                    'temperature': temperature,
-                    'top_p': top_p,
-                    'top_k': top_k,
-                    'repeat_penalty': 1.1,  # Standard penalty to discourage repetition
-                    'frequency_penalty': 0.0,
-                    'presence_penalty': 0.0,
-                    'stream': False,
-                    'echo': False,
-                }
-                
+                generation_params['stopping_criteria'] = job.stopping_criteria()
+                job.deadline = _generation_deadline(job)
+                start_time = time.time()
                 response = model.llm.create_completion(**generation_params)
-                
-                ai_response = response['choices'][0]['text'].strip()
-                
-                # Enhanced post-processing with new format
-                ai_response = model._post_process_response(ai_response)
-                
-                # Log final response stats
-                logger.debug(f"Final response length: {len(ai_response)} chars")
-                
-                if chat_session:
-                    model.add_to_history(chat_session, "assistant", ai_response)
-                
-                # Perform optimized garbage collection
-                model._optimized_garbage_collect()
-                
-                return ai_response
+                elapsed = time.time() - start_time
+                completion_tokens = response['usage']['completion_tokens']
+                model.speculation.record_generation(completion_tokens, elapsed)
+                if job.cancelled.is_set():
+                    _record_generation('generate', 'cancelled', model, completion_tokens, elapsed)
+                    _discard_cancelled_turn(model, chat_session)
+                    return None
+                choice = response['choices'][0]
+                truncated = _truncation_reason(job, choice.get('finish_reason'))
+                _record_generation('generate', 'truncated' if truncated else 'completed',
+                                   model, completion_tokens, elapsed)
+                return _finish_generation(model, chat_session, choice['text'], choice.get('finish_reason'),
+                                          cache_key, truncated, generation_params['prompt'], job.owner)
                 
             except Exception as e:
                 logger.error(f"Generation error: {str(e)}")
+                _record_generation('generate', 'error')
                 return f"I apologize, but I encountered an error while processing your request. Please try again."
                 
     except Exception as e:
         logger.error(f"LOW-RESOURCE: Deployment generation failed: {str(e)}")
+        _record_generation('generate', 'error')
+        return "I'm currently experiencing technical difficulties. Please try again shortly."
+
+def _stream_events(job, prompt, chat_session=None, cache_key=None):
+    """Yield ('token', text) events while decoding, then ('done', response), ('cancelled', None) or ('error', message)"""
+    try:
+        with optimized_memory_operation():
+            model, generation_params = _prepare_generation(prompt, chat_session)
+            if model is None:
+                _record_generation('stream', 'error')
+                yield 'error', generation_params
+                return
+            
+            generation_params['stream'] = True
+            generation_params['stopping_criteria'] = job.stopping_criteria()
+            job.deadline = _generation_deadline(job)
+            pieces = []
+            finish_reason = None
+            first_token_seconds = None
+            start_time = time.time()
+            try:
+                for chunk in model.llm.create_completion(**generation_params):
+                    text = chunk['choices'][0]['text']
+                    finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+                    if text:
+                        if first_token_seconds is None:
+                            first_token_seconds = time.time() - start_time
+                        pieces.append(text)
+                        yield 'token', text
+            except Exception as e:
+                logger.error(f"Streaming generation error: {str(e)}")
+                _record_generation('stream', 'error')
+                yield 'error', "I apologize, but I encountered an error while processing your request. Please try again."
+                return
+            
+            elapsed = time.time() - start_time
+            model.speculation.record_generation(len(pieces), elapsed)  # one chunk per token
+            if job.cancelled.is_set():
+                _record_generation('stream', 'cancelled', model, len(pieces), elapsed, first_token_seconds)
+                _discard_cancelled_turn(model, chat_session)
+                yield 'cancelled', None
+                return
+            truncated = _truncation_reason(job, finish_reason)
+            _record_generation('stream', 'truncated' if truncated else 'completed',
+                               model, len(pieces), elapsed, first_token_seconds)
+            yield 'done', _finish_generation(model, chat_session, "".join(pieces), finish_reason,
+                                             cache_key, truncated, generation_params['prompt'], job.owner)
+            
+    except Exception as e:
+        logger.error(f"LOW-RESOURCE: Deployment streaming failed: {str(e)}")
+        _record_generation('stream', 'error')
+        yield 'error', "I'm currently experiencing technical difficulties. Please try again shortly."
+
+def _stream_response(job, prompt, chat_session=None, cache_key=None):
+    """Streaming generation; runs on the scheduler's decode thread and relays events to the caller"""
+    for event, data in _stream_events(job, prompt, chat_session, cache_key):
+        job.emit(event, data)
+
+def _batch_context():
+    """The model's multi-sequence context when queued chat jobs can be batched, else None"""
+    model = OptimizedLlamaModel()
+    if not model.is_initialized():
+        return None  # The first job loads the model on the single-sequence path
+    try:
+        model._check_and_adjust_parameters()
+        return model.batch_context()
+    except Exception as e:
+        logger.warning(f"BATCH: Falling back to one session at a time: {e}")
+        return None
+
+def _start_batched(job):
+    """A chat job's BatchedSequence; the job's prompt is recorded in its session history"""
+    prompt, chat_session, cache_key = job.args
+    model = OptimizedLlamaModel()
+    prompt_tokens = _prompt_tokens(model, prompt, chat_session)
+    max_tokens = max(min(model.max_response_tokens, model.n_ctx() - len(prompt_tokens)), 1)
+    sampling = _sampling_parameters(OptimizedMemoryManager.get_adaptive_memory_tier())
+    job.deadline = _generation_deadline(job)
+    return BatchedSequence(job, prompt_tokens, max_tokens, sampling, stream=job.mode == 'stream')
+
+def _finish_batched(sequence):
+    """Record a finished batched sequence the way _generate_response / _stream_events do"""
+    job = sequence.job
+    prompt, chat_session, cache_key = job.args
+    model = OptimizedLlamaModel()
+    model.last_prompt_tokens = len(sequence.prompt_tokens)
+    elapsed = time.time() - sequence.started_at
+    first_token_seconds = sequence.first_token_seconds if sequence.stream else None
+    if job.cancelled.is_set():
+        _record_generation(job.mode, 'cancelled', model, sequence.completion_tokens, elapsed, first_token_seconds)
+        _discard_cancelled_turn(model, chat_session)
+        if sequence.stream:
+            job.emit('cancelled', None)
+        return
+    
+    sequence.flush()
+    truncated = _truncation_reason(job, sequence.finish_reason)
+    _record_generation(job.mode, 'truncated' if truncated else 'completed',
+                       model, sequence.completion_tokens, elapsed, first_token_seconds)
+    response = _finish_generation(model, chat_session, sequence.text, sequence.finish_reason, cache_key,
+                                  truncated, sequence.prompt_tokens, job.owner, save_state=False)
+    if sequence.stream:
+        job.emit('done', response)
+    else:
+        job.result = response
+
+def generate_deployment_response(prompt, chat_session=None, user=None, use_cache=True, timed=True):
+    """High-performance response generation optimized for 1-core, 2GB system with Gemma 3 1B.
+
+    timed=False skips the generation deadline (cache warm-up, where only
+    complete answers are worth storing).
+    """
+    ensure_history_loaded(user, chat_session)
+    
+    # Built-in suggestion prompts are answered from the response cache without queuing
+    model = OptimizedLlamaModel()
+    cache_key = _response_cache_key(model, prompt, chat_session) if use_cache else None
+    cached = _cached_response(model, cache_key, prompt, chat_session)
+    if cached is not None:
+        _record_generation('generate', 'cached')
+        return cached
+    
+    # Raises InferenceQueueFull / InferenceQueueTimeout so callers can fail fast
+    scheduler = InferenceScheduler()
+    job = scheduler.submit(InferenceJob(_generate_response, (prompt, chat_session, cache_key), chat_session,
+                                        timed=timed, owner=_user_id(user), mode='generate'))
+    scheduler.wait_until_started(job)
+    job.finished.wait()
+    if job.cancelled.is_set():
+        raise GenerationCancelled("Generation cancelled.")
+    if job.result is None:
         return "I'm currently experiencing technical difficulties. Please try again shortly."
+    return job.result
+
+def stream_deployment_response(prompt, chat_session=None, user=None, use_cache=True, timed=True):
+    """Streaming variant of generate_deployment_response.
+
+    Yields ('queued', {'position': n}) once the job is admitted, ('token', text)
+    events as Gemma decodes them, then a single ('done', final_response) event
+    (a TruncatedResponse when the deadline or token budget cut it off),
+    or ('error', message) on failure, or ('cancelled', None). The session
+    history is only updated once the stream has completed. Admission failures
+    raise InferenceOverloaded before anything is yielded; closing the
+    generator early (client disconnect) cancels the generation. use_cache=False
+    always decodes (benchmarks), neither reading nor filling the response cache;
+    timed=False skips the generation deadline, as for generate_deployment_response.
+    """
+    ensure_history_loaded(user, chat_session)
+    
+    model = OptimizedLlamaModel()
+    cache_key = _response_cache_key(model, prompt, chat_session) if use_cache else None
+    cached = _cached_response(model, cache_key, prompt, chat_session)
+    if cached is not None:
+        _record_generation('stream', 'cached')
+        yield 'token', cached
+        yield 'done', cached
+        return
+    
+    scheduler = InferenceScheduler()
+    job = scheduler.submit(InferenceJob(_stream_response, (prompt, chat_session, cache_key), chat_session,
+                                        timed=timed, owner=_user_id(user), mode='stream'))
+    try:
+        yield 'queued', {'position': scheduler.stats()['queued']}  # 0 once it is already running
+        scheduler.wait_until_started(job)
+        while True:
+            item = job.events.get()
+            if item is None:
+                break
+            yield item
+        if job.started_at is None and job.cancelled.is_set():
+            yield 'cancelled', None  # Withdrawn before it ever ran
+    finally:
+        if not job.finished.is_set():
+            # The consumer went away mid-stream: stop decoding for nobody
+            scheduler.cancel_job(job)
+
+def cancel_deployment_generation(chat_session_id):
+    """Cancel the session's queued or running generation; returns the number of jobs cancelled"""
+    return InferenceScheduler().cancel(chat_session_id)
+
+# === CONTINUING TRUNCATED ANSWERS ===
+def _continue_response(job, chat_session, continuation_id):
+    """Resume a cut-off answer on the decode thread; None when there is nothing to continue.
+
+    The prompt is the truncated turn's own prompt tokens followed by its partial
+    answer. The KV snapshot saved after that turn already holds both, so llama.cpp
+    only evaluates the new tokens instead of replaying prompt and answer.
+    """
+    model = OptimizedLlamaModel()
+    record = model.continuations.get(chat_session, continuation_id, job.owner)
+    history = model.conversation_history.get(chat_session)
+    if record is None or not model.is_initialized() or not history or history[-1]['role'] != 'assistant':
+        return None
+    
+    try:
+        with optimized_memory_operation():
+            model._check_and_adjust_parameters()
+            prompt_tokens = list(record['prompt_tokens']) + model.llm.tokenize(
+                record['text'].encode("utf-8"), add_bos=False, special=False)
+            if model.n_ctx() - len(prompt_tokens) < MIN_RESPONSE_TOKENS:
+                logger.info(f"Continuation for session {chat_session} no longer fits n_ctx={model.n_ctx()}")
+                model.continuations.discard(chat_session)
+                return None
+            
+            model._restore_session_state(chat_session, prompt_tokens)
+            generation_params = _generation_parameters(model, prompt_tokens)
+            generation_params['stopping_criteria'] = job.stopping_criteria()
+            job.deadline = _generation_deadline(job)
+            start_time = time.time()
+            response = model.llm.create_completion(**generation_params)
+            elapsed = time.time() - start_time
+            completion_tokens = response['usage']['completion_tokens']
+            model.speculation.record_generation(completion_tokens, elapsed)
+            if job.cancelled.is_set():
+                _record_generation('continue', 'cancelled', model, completion_tokens, elapsed)
+                return None  # The partial answer and its continuation stay as they were
+            
+            choice = response['choices'][0]
+            truncated = _truncation_reason(job, choice.get('finish_reason'))
+            _record_generation('continue', 'truncated' if truncated else 'completed',
+                               model, completion_tokens, elapsed)
+            raw_text = record['text'] + choice['text']
+            ai_response = model._post_process_response(raw_text.strip())
+            
+            # The partial answer grows in place; no new turn is added
+            model.conversation_history.replace(chat_session, history[:-1] + [{"role": "assistant", "content": ai_response}])
+            model._save_session_state(chat_session)
+            _schedule_history_summary(model, chat_session)
+            model._optimized_garbage_collect()
+            
+            if truncated:
+                continuation = _record_continuation(model, chat_session, record['prompt_tokens'], raw_text, truncated,
+                                                    job.owner)
+                return TruncatedResponse(ai_response, truncated, continuation)
+            model.continuations.discard(chat_session)
+            return ai_response
+    
+    except Exception as e:
+        logger.error(f"Continuation failed for session {chat_session}: {str(e)}")
+        _record_generation('continue', 'error')
+        return "Sorry, I encountered an error while continuing the response. Please try again."
+
+def continue_deployment_response(chat_session, continuation_id, user=None):
+    """Finish the session's cut-off answer and return the whole answer so far.
+
+    Raises ContinuationUnavailable when there is nothing to continue (including
+    a continuation id that isn't the latest one, or belongs to another user),
+    and the usual InferenceOverloaded / GenerationCancelled otherwise. The result
+    is a TruncatedResponse again if the deadline cuts the continuation short too.
+    """
+    owner = _user_id(user)
+    if OptimizedLlamaModel().continuations.get(chat_session, continuation_id, owner) is None:
+        raise ContinuationUnavailable("There is no cut-off answer to continue in this session.")
+    
+    scheduler = InferenceScheduler()
+    job = scheduler.submit(InferenceJob(_continue_response, (chat_session, continuation_id), chat_session,
+                                        owner=owner))
+    scheduler.wait_until_started(job)
+    job.finished.wait()
+    if job.cancelled.is_set():
+        raise GenerationCancelled("Generation cancelled.")
+    if job.result is None:
+        raise ContinuationUnavailable("There is no cut-off answer to continue in this session.")
+    return job.result
+
+# === ROLLING HISTORY SUMMARIES ===
+def _history_to_summarize(model, chat_session):
+    """Leading messages to fold into the memory note, or [] while the session is within bounds"""
+    history = model.conversation_history.get(chat_session) or []
+    max_history = OptimizedMemoryManager.get_adaptive_parameters()['max_history']
+    keep = min(HISTORY_SUMMARY_KEEP_MESSAGES, max_history)
+    if len(history) <= keep:
+        return []
+    trigger = HISTORY_SUMMARY_TRIGGER_TOKENS or int(model.max_prompt_tokens * HISTORY_SUMMARY_TRIGGER_FRACTION)
+    if len(history) <= max_history and model.history_tokens(chat_session) <= trigger:
+        return []
+    older = history[:-keep]
+    # The kept turns must open on a user turn: it carries the system prompt and memory note
+    while older and older[-1]['role'] != 'assistant':
+        older.pop()
+    return older
+
+def _schedule_history_summary(model, chat_session):
+    """Queue a background summary once a session outgrows its token trigger or max_history"""
+    if not HISTORY_SUMMARY_ENABLED or not chat_session:
+        return
+    try:
+        if _history_to_summarize(model, chat_session):
+            InferenceScheduler().submit_background(
+                InferenceJob(_summarize_history, (chat_session,), chat_session, background=True))
+    except Exception as e:
+        logger.warning(f"Could not schedule a history summary for {chat_session}: {str(e)}")
+
+def _summary_prompt_tokens(model, messages, memory):
+    """The session's own turns (same token IDs as its chat prompt, so its KV state is reused) plus the instruction"""
+    prompt_tokens = model._history_token_ids(messages, memory)
+    prompt_tokens.extend(model._memo_ids(model._template_token_ids, 'summary_instruction',
+                                         lambda: model._format_turn("user", HISTORY_SUMMARY_INSTRUCTION) + "\n"))
+    prompt_tokens.extend(model._generation_prompt_ids())
+    return prompt_tokens
+
+def _summarize_history(job, chat_session):
+    """Background job: fold a session's older turns into its memory note. Returns True if compacted."""
+    model = OptimizedLlamaModel()
+    if not model.is_initialized():
+        return False
+    older = _history_to_summarize(model, chat_session)  # Re-checked: the session may have moved on
+    if not older:
+        return False
+
+    memory = model.conversation_history.get_memory(chat_session)
+    budget = model.n_ctx() - HISTORY_SUMMARY_MAX_TOKENS
+    transcript = older
+    prompt_tokens = _summary_prompt_tokens(model, transcript, memory)
+    # Too long for one pass: drop the oldest exchanges, then cap each message
+    while len(prompt_tokens) > budget and len(transcript) > 2:
+        transcript = transcript[2:]
+        prompt_tokens = _summary_prompt_tokens(model, transcript, memory)
+    if len(prompt_tokens) > budget:
+        per_message = max(budget // (len(transcript) + 2), 16)
+        transcript = [{'role': m['role'], 'content': model._truncate_to_tokens(m['content'].strip(), per_message)}
+                      for m in transcript]
+        prompt_tokens = _summary_prompt_tokens(model, transcript, memory)
+
+    with optimized_memory_operation():
+        model._restore_session_state(chat_session, prompt_tokens)
+        start_time = time.time()
+        try:
+            response = model.llm.create_completion(
+                prompt=prompt_tokens,
+                max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+                stop=STOP_SEQUENCES,
+                temperature=0.3,  # Faithful notes, not creative ones
+                top_p=0.9,
+                top_k=40,
+                repeat_penalty=1.1,
+                stopping_criteria=job.stopping_criteria(),
+            )
+        except Exception as e:
+            logger.warning(f"History summary failed for {chat_session}: {str(e)}")
+            metrics.HISTORY_SUMMARIES.inc(outcome='error')
+            return False
+        elapsed = time.time() - start_time
+
+    if job.cancelled.is_set() or job.preempted.is_set():
+        # A chat request needed the core; the next finished turn schedules it again
+        metrics.HISTORY_SUMMARIES.inc(outcome='preempted')
+        return False
+    summary = model._enhanced_post_process_response(response['choices'][0]['text'])
+    if not summary:
+        metrics.HISTORY_SUMMARIES.inc(outcome='error')
+        return False
+    if not model.conversation_history.compact(chat_session, older, summary):
+        metrics.HISTORY_SUMMARIES.inc(outcome='stale')
+        return False
+
+    metrics.HISTORY_SUMMARIES.inc(outcome='completed')
+    metrics.HISTORY_SUMMARY_SECONDS.observe(elapsed)
+    logger.info(f"Summarized {len(older)} messages of session {chat_session} into "
+                f"{response['usage']['completion_tokens']} tokens in {elapsed:.1f}s")
+    return True
 
 # === OPTIMIZED UTILITIES ===
 def clear_deployment_history(chat_session_id):
     """Clear history with optimized cleanup"""
     try:
         model = OptimizedLlamaModel()
+        model.kv_cache.discard(chat_session_id)
+        model.continuations.discard(chat_session_id)
         if chat_session_id in model.conversation_history:
             del model.conversation_history[chat_session_id]
             return True
@@ -627,14 +3173,26 @@ def get_deployment_status():
                 'context_window': model.context_window,
                 'max_response_tokens': model.max_response_tokens,
                 'max_prompt_tokens': model.max_prompt_tokens,
-                'n_threads': model.n_threads
+                'n_threads': model.n_threads,
+                'n_threads_batch': model.n_threads_batch,
+                'n_batch': model.n_batch,
+                'live_n_ctx': model.n_ctx(),
+                'model_variant': model.model_variant,
+                'model_filename': model.model_filename,
+                'thread_benchmark': model.thread_benchmark
             }
         
-        # CPU information
+        from .response_cache import get_response_cache
+        response_cache = get_response_cache()
+        on_disk = available_model_variants()
+        
+        # CPU information from the background sampler (no blocking cpu_percent probe)
+        snapshot = ResourceSampler.snapshot()
         cpu_info = {
-            'cpu_count': psutil.cpu_count(),
-            'cpu_percent': psutil.cpu_percent(interval=1),
-            'load_avg': os.getloadavg() if hasattr(os, 'getloadavg') else None
+            'cpu_count': snapshot.cpu_count,
+            'cpu_budget': model.cpu_budget,
+            'cpu_percent': snapshot.cpu_percent,
+            'load_avg': snapshot.load_avg
         }
         
         return {
@@ -644,7 +3202,9 @@ def get_deployment_status():
             'memory_tier': memory_status['tier'],
             'available_memory_gb': memory_status['available_gb'],
             'used_memory_gb': memory_status['used_gb'],
-            'total_memory_gb': psutil.virtual_memory().total / (1024**3),
+            'total_memory_gb': snapshot.total_gb,
+            'process_rss_mb': snapshot.process_rss_mb,
+            'resource_snapshot_age_seconds': time.time() - snapshot.timestamp,
             'swap_usage_gb': OptimizedMemoryManager.monitor_swap_usage(),
             'model_loaded': model_loaded,
             'emergency_mode': OptimizedMemoryManager.check_memory_emergency(),
@@ -652,12 +3212,125 @@ def get_deployment_status():
             'current_model_parameters': current_params,
             'memory_thresholds': ADAPTIVE_MEMORY_THRESHOLDS,
             'cpu_info': cpu_info,
-            'cache_size_gb': CACHE_SIZE_GB
+            'cache_size_gb': CACHE_SIZE_GB,
+            'kv_cache': model.kv_cache.stats(),
+            'context_rebuild': dict(model.context_rebuild_stats),
+            'model_variants': {
+                name: dict(profile, on_disk=name in on_disk, active=name == model.model_variant)
+                for name, profile in MODEL_VARIANTS.items()
+            },
+            'model_switch': dict(model.model_switch_stats),
+            'prefix_state': dict(model.prefix_state_stats),
+            'speculative_decoding': model.speculation.stats(),
+            'batched_decoding': dict(model.batch_stats,
+                                     sequences=model.sequence_context.n_seq if model.sequence_context else 0),
+            'model_memory': shared_memory_report([os.getpid()], model.model_path) if model_loaded else None,
+            'conversation_store': model.conversation_history.stats(),
+            'generation_deadline_seconds': _generation_budget_seconds(memory_status['tier']),
+            'continuations': model.continuations.stats(),
+            'gc': model.gc_policy.stats(),
+            'scheduler': InferenceScheduler().stats(),
+            'response_cache': response_cache.stats() if response_cache else None
         }
     except Exception as e:
         logger.error(f"Error getting deployment status: {str(e)}")
         return {'error': str(e)}
 
+def get_deployment_metrics():
+    """Prometheus exposition text: request metrics plus a cheap read of the live stats (no probes, no smaps)"""
+    from .response_cache import get_response_cache
+    
+    model = OptimizedLlamaModel()
+    snapshot = ResourceSampler.snapshot()
+    scheduler = InferenceScheduler().stats()
+    kv_cache = model.kv_cache.stats()
+    speculation = model.speculation.stats()
+    gc_stats = model.gc_policy.stats()
+    response_cache = get_response_cache()
+    model_loaded = model.is_initialized()
+    
+    def family(name, kind, help_text, samples):
+        if not isinstance(samples, list):
+            samples = [('', {}, samples)]
+        return metrics.format_family(name, kind, help_text, samples)
+    
+    families = [
+        family('ai_queue_depth', 'gauge', 'Generations waiting for the decode thread.', scheduler['queued']),
+        family('ai_queue_active', 'gauge', 'Whether a generation is running.', scheduler['active']),
+        family('ai_queue_batched', 'gauge', 'Generations decoding together in a multi-sequence batch.',
+               scheduler['batched']),
+        family('ai_queue_max_depth', 'gauge', 'Admission limit on waiting generations.', scheduler['max_depth']),
+        family('ai_queue_background_depth', 'gauge', 'Background jobs (history summaries) waiting for an idle decode thread.',
+               scheduler['background_queued']),
+        family('ai_queue_jobs_total', 'counter', 'Scheduler jobs by result.', [
+            ('', {'result': 'completed'}, scheduler['completed']),
+            ('', {'result': 'rejected'}, scheduler['rejected']),
+            ('', {'result': 'expired'}, scheduler['expired']),
+            ('', {'result': 'background'}, scheduler['background_completed']),
+        ]),
+        family('ai_queue_job_seconds_avg', 'gauge', 'Moving average of job run time (Retry-After basis).',
+               scheduler['avg_job_seconds']),
+        family('ai_response_cache_lookups_total', 'counter', 'First-turn response cache lookups.', [
+            ('', {'result': 'hit'}, response_cache.hits if response_cache else 0),
+            ('', {'result': 'miss'}, response_cache.misses if response_cache else 0),
+        ]),
+        family('ai_kv_cache_lookups_total', 'counter', 'Per-session KV state lookups.', [
+            ('', {'result': 'hit'}, kv_cache['hits']),
+            ('', {'result': 'miss'}, kv_cache['misses']),
+        ]),
+        family('ai_kv_cache_bytes', 'gauge', 'Bytes held by saved KV states.', kv_cache['size_mb'] * 1024**2),
+        family('ai_kv_cache_sessions', 'gauge', 'Sessions with a saved KV state.', kv_cache['sessions']),
+        family('ai_kv_cache_evictions_total', 'counter', 'KV states evicted for space.', kv_cache['evictions']),
+        family('ai_prefix_state_restores_total', 'counter', 'Generations started from the system prompt state.',
+               model.prefix_state_stats['restores']),
+        family('ai_speculative_tokens_total', 'counter', 'Draft tokens proposed and accepted.', [
+            ('', {'result': 'proposed'}, speculation['proposed_tokens']),
+            ('', {'result': 'accepted'}, speculation['accepted_tokens']),
+        ]),
+        family('ai_batched_decode_steps_total', 'counter', 'llama_decode calls shared by batched sessions.',
+               model.batch_stats['steps']),
+        family('ai_batched_decode_tokens_total', 'counter', 'Tokens evaluated in batched decode steps.',
+               model.batch_stats['tokens']),
+        family('ai_context_rebuilds_total', 'counter', 'Llama context rebuilds after a tier change.', [
+            ('', {'result': 'rebuilt'}, model.context_rebuild_stats['rebuilds']),
+            ('', {'result': 'deferred'}, model.context_rebuild_stats['deferred']),
+            ('', {'result': 'failed'}, model.context_rebuild_stats['failures']),
+        ]),
+        family('ai_memory_tier', 'gauge', 'Current adaptive memory tier (1 for the active one).',
+               [('', {'tier': tier}, tier == snapshot.tier) for tier in ADAPTIVE_MEMORY_THRESHOLDS]),
+        family('ai_memory_pressure', 'gauge', 'Current memory pressure level (1 for the active one).',
+               [('', {'level': level}, level == snapshot.pressure) for level in MEMORY_PRESSURE_LEVELS]),
+        family('ai_memory_available_bytes', 'gauge', 'Memory available within the simulated RAM cap.',
+               snapshot.available_gb * 1024**3),
+        family('ai_process_resident_memory_bytes', 'gauge', 'RSS of this process at the last resource sample.',
+               snapshot.process_rss_mb * 1024**2),
+        family('ai_cpu_percent', 'gauge', 'System CPU use between the last two resource samples.',
+               snapshot.cpu_percent),
+        family('ai_resource_sample_age_seconds', 'gauge', 'Age of the resource snapshot behind these values.',
+               time.time() - snapshot.timestamp),
+        family('ai_gc_policy_collections_total', 'counter', 'Collections scheduled by the request-path GC policy.', [
+            ('', {'kind': 'young'}, gc_stats['young_collections']),
+            ('', {'kind': 'full'}, gc_stats['full_collections']),
+        ]),
+        family('ai_gc_policy_seconds_total', 'counter', 'Time in GC policy collections.', gc_stats['collect_seconds']),
+        family('ai_conversation_sessions', 'gauge', 'Sessions in the in-memory history store.',
+               len(model.conversation_history)),
+        family('ai_conversation_memories', 'gauge', 'Sessions carrying a summary of their compacted turns.',
+               model.conversation_history.stats()['sessions_with_memory']),
+        family('ai_pending_continuations', 'gauge', 'Sessions whose last answer was cut off and can be continued.',
+               model.continuations.stats()['sessions']),
+        family('ai_model_loaded', 'gauge', 'Whether the model is loaded in this process.', model_loaded),
+        family('ai_model_variant', 'gauge', 'Loaded GGUF quantization (1 for the active one).',
+               [('', {'variant': name}, name == model.model_variant) for name in MODEL_VARIANTS]),
+        family('ai_model_context_tokens', 'gauge', 'Live llama context size.',
+               model.n_ctx() if model_loaded else model.context_window),
+        family('ai_model_threads', 'gauge', 'llama.cpp thread counts.', [
+            ('', {'kind': 'decode'}, model.n_threads),
+            ('', {'kind': 'batch'}, model.n_threads_batch),
+        ]),
+    ]
+    return metrics.render(families)
+
 # === STANDALONE TESTING ===
 if __name__ == "__main__":
     print("=== GEMMA 3 1B LOW-RESOURCE MODEL TEST ===")
@@ -683,18 +3356,127 @@ initialization_status = {
     "timestamp": None
 }
 
+def _worker_client():
+    """Client for the out-of-process inference worker, if one is configured"""
+    from .inference_worker import get_worker_client
+    return get_worker_client()
+
+def _user_id(user):
+    """Users cross the worker boundary as primary keys"""
+    return getattr(user, 'pk', user)
+
 def generate_chat_response(prompt, chat_session=None, user=None, model_mode="default"):
     """Compatibility wrapper for generate_deployment_response"""
-    return generate_deployment_response(prompt, chat_session, user)
+    client = _worker_client()
+    if client is None:
+        return generate_deployment_response(prompt, chat_session, user)
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('generate', prompt, chat_session, _user_id(user))
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return "I'm currently unavailable due to system constraints. Please try again shortly."
+
+def stream_chat_response(prompt, chat_session=None, user=None, model_mode="default"):
+    """Compatibility wrapper for stream_deployment_response"""
+    client = _worker_client()
+    if client is None:
+        yield from stream_deployment_response(prompt, chat_session, user)
+        return
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        yield from client.stream('stream', prompt, chat_session, _user_id(user))
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        yield 'error', "I'm currently unavailable due to system constraints. Please try again shortly."
+
+def continue_chat_response(chat_session, continuation_id, user=None):
+    """Compatibility wrapper for continue_deployment_response.
+
+    A worker outage returns an error text the views answer with a 500, so the
+    saved partial answer is never overwritten with it.
+    """
+    client = _worker_client()
+    if client is None:
+        return continue_deployment_response(chat_session, continuation_id, user)
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('continue', chat_session, continuation_id, _user_id(user))
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return "Sorry, I encountered an error while continuing the response. Please try again."
+
+def get_queue_status(chat_session_id=None):
+    """Queue position of a session's generation (see InferenceScheduler.position)"""
+    client = _worker_client()
+    if client is None:
+        return InferenceScheduler().position(chat_session_id)
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('queue_status', chat_session_id)
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return {'state': 'unavailable', 'position': None, 'queue_depth': None, 'estimated_wait_seconds': None}
+
+def get_metrics_text():
+    """Compatibility wrapper for get_deployment_metrics (the worker holds the counters when configured)"""
+    client = _worker_client()
+    if client is None:
+        return get_deployment_metrics()
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('metrics')
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return metrics.format_family('ai_inference_worker_up', 'gauge', 'Whether the inference worker answered.', [('', {}, 0)]) + '\n'
+
+def cancel_chat_generation(chat_session_id):
+    """Compatibility wrapper for cancel_deployment_generation"""
+    client = _worker_client()
+    if client is None:
+        return cancel_deployment_generation(chat_session_id)
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('cancel', chat_session_id)
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return 0
 
 def clear_chat_history(chat_session_id):
     """Compatibility wrapper for clear_deployment_history"""
-    return clear_deployment_history(chat_session_id)
+    client = _worker_client()
+    if client is None:
+        return clear_deployment_history(chat_session_id)
+    
+    from .inference_worker import InferenceWorkerUnavailable
+    try:
+        return client.call('clear_history', chat_session_id)
+    except InferenceWorkerUnavailable as e:
+        logger.error(f"Inference worker unavailable: {e}")
+        return False
 
 def initialize_model():
     """Initialize the optimized model with status tracking"""
     global initialization_status
     
+    client = _worker_client()
+    if client is not None:
+        # The worker owns the model; mirror its status for the views
+        from .inference_worker import InferenceWorkerUnavailable
+        try:
+            result = client.call('initialize')
+            initialization_status.update(client.call('initialization_status'))
+            return result
+        except InferenceWorkerUnavailable as e:
+            initialization_status["error"] = str(e)
+            return False
+    
     if initialization_status["initialized"]:
         logger.info("Model already initialized")
         return True
@@ -729,6 +3511,9 @@ def initialize_model():
 def is_model_initialized():
     """Check if the optimized model is initialized"""
     try:
+        client = _worker_client()
+        if client is not None:
+            return client.call('is_initialized')
         model = OptimizedLlamaModel()
         return model.is_initialized()
     except:
@@ -739,36 +3524,67 @@ def generate_new_session_id():
     import uuid
     return str(uuid.uuid4())
 
-def load_history_from_database(user, chat_session_id):
-    """Load chat history from database into optimized model memory"""
+SESSION_TOKEN_SALT = 'apps.ai_chat.session'
+
+def session_token(chat_session_id):
+    """Proof that the caller was handed this session id by new-session (guests have no user to check)"""
+    from django.utils.crypto import salted_hmac
+    return salted_hmac(SESSION_TOKEN_SALT, str(chat_session_id)).hexdigest()
+
+def owns_session(user, chat_session_id, token=None):
+    """Whether the caller may act on a session: it holds the session token, or has saved chats in it"""
+    from django.utils.crypto import constant_time_compare
+    if token and constant_time_compare(str(token), session_token(chat_session_id)):
+        return True
+    if user is not None and user.is_authenticated:
+        from .models import Chat
+        return Chat.objects.filter(user=user, chat_session=chat_session_id).exists()
+    return False
+
+def load_history_from_database(user, chat_session_id, max_turns=None):
+    """Load a session's most recent turns from the database into optimized model memory"""
     try:
         from .models import Chat
         
         model = OptimizedLlamaModel()
         
-        # Clear existing memory history for this session
-        if chat_session_id in model.conversation_history:
-            del model.conversation_history[chat_session_id]
+        if max_turns is None:
+            # Each row is a user/assistant pair; never fetch more than the prompt can use
+            max_turns = (OptimizedMemoryManager.get_adaptive_parameters()['max_history'] + 1) // 2
         
-        # Load chats from database
-        chats = Chat.objects.filter(
-            user=user,
-            chat_session=chat_session_id
-        ).order_by('created_at')
+        # Single query, newest first, only the two text columns
+        rows = list(
+            Chat.objects.filter(user=user, chat_session=chat_session_id)
+            .order_by('-created_at')
+            .values_list('message', 'response')[:max_turns]
+        )
         
-        if not chats.exists():
+        if not rows:
             return False
         
-        # Add each message to history
-        for chat in chats:
-            if chat.message:
-                model.add_to_history(chat_session_id, "user", chat.message)
-            if chat.response:
-                model.add_to_history(chat_session_id, "assistant", chat.response)
+        messages = []
+        for message, response in reversed(rows):
+            if message:
+                messages.append({"role": "user", "content": message})
+            if response:
+                messages.append({"role": "assistant", "content": response})
         
-        logger.debug(f"Loaded {chats.count()} messages from database for session {chat_session_id}")
-        return len(chats) > 0
+        # Replaces any partial in-memory history in one step (no per-message GC)
+        model.conversation_history.replace(chat_session_id, messages)
+        
+        logger.debug(f"Loaded {len(rows)} turns from database for session {chat_session_id}")
+        return True
         
     except Exception as e:
         logger.error(f"Error loading history from database: {str(e)}")
-        return False 
\ No newline at end of file
+        return False
+
+def ensure_history_loaded(user, chat_session_id):
+    """Rehydrate a session from the database on a cache miss (after a restart or eviction)"""
+    if not chat_session_id or user is None:
+        return False  # Guests have no stored history
+    
+    model = OptimizedLlamaModel()
+    if chat_session_id in model.conversation_history:
+        return True
+    return load_history_from_database(user, chat_session_id)
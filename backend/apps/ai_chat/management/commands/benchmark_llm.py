@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ai_chat.benchmark import BENCHMARK_PROMPTS, run_benchmark
+from apps.ai_chat.llm_handler_deployment import ADAPTIVE_MEMORY_THRESHOLDS
+
+
+class Command(BaseCommand):
+    help = "Benchmark the deployment handler per memory tier (TTFT, tokens/s, p50/p95 latency, peak RSS) as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tiers',
+            default=','.join(ADAPTIVE_MEMORY_THRESHOLDS),
+            help="Comma-separated memory tiers to pin, in order (default: all).",
+        )
+        parser.add_argument('--repeat', type=int, default=1, help="Passes over the prompt corpus per tier.")
+        parser.add_argument('--warmup', type=int, default=1, help="Untimed prompts run after each tier switch.")
+        parser.add_argument('--limit', type=int, help="Only use the first N corpus prompts.")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        tiers = [tier.strip() for tier in options['tiers'].split(',') if tier.strip()]
+        unknown = [tier for tier in tiers if tier not in ADAPTIVE_MEMORY_THRESHOLDS]
+        if unknown:
+            raise CommandError(f"Unknown tier(s): {', '.join(unknown)}")
+        prompts = BENCHMARK_PROMPTS[:options['limit']] if options['limit'] else BENCHMARK_PROMPTS
+
+        try:
+            report = run_benchmark(tiers, prompts, options['repeat'], options['warmup'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+            for tier, result in report['tiers'].items():
+                summary = result['summary']
+                self.stderr.write(
+                    f"{tier:>8}: TTFT p50 {summary['ttft_p50_seconds'] or 0:.2f}s, "
+                    f"latency p50/p95 {summary['latency_p50_seconds'] or 0:.1f}/{summary['latency_p95_seconds'] or 0:.1f}s, "
+                    f"decode {summary['decode_tokens_per_second'] or 0:.1f} tok/s, peak RSS {summary['peak_rss_mb']:.0f}MB"
+                )
+            self.stdout.write(self.style.SUCCESS(f"Benchmark report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ai_chat.llm_handler_deployment import shared_memory_report
+
+
+class Command(BaseCommand):
+    help = "Report RSS vs PSS of the mmapped GGUF in every process that maps it, to confirm workers share the weights."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pid', type=int, action='append', help="Only report these PIDs (repeatable).")
+        parser.add_argument('--model-path', help="GGUF to look for (defaults to the deployed model).")
+        parser.add_argument('--json', action='store_true', help="Print the raw report as JSON.")
+
+    def handle(self, *args, **options):
+        try:
+            report = shared_memory_report(options['pid'], options['model_path'])
+        except OSError as e:
+            raise CommandError(f"Cannot read /proc (Linux only): {e}")
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        if not report['processes']:
+            self.stdout.write(f"No process currently maps {report['model_path']}")
+            return
+
+        self.stdout.write(f"Model: {report['model_path']} ({report['model_file_mb'] or 0:.0f}MB)")
+        self.stdout.write(f"{'PID':>8} {'model RSS':>10} {'model PSS':>10} {'private':>8} {'proc PSS':>9}")
+        for p in report['processes']:
+            self.stdout.write(
+                f"{p['pid']:>8} {p['model_rss_mb']:>8.0f}MB {p['model_pss_mb']:>8.0f}MB "
+                f"{p['model_private_mb']:>6.0f}MB {p['process_pss_mb']:>7.0f}MB"
+            )
+        self.stdout.write(
+            f"Total model RSS {report['total_model_rss_mb']:.0f}MB, PSS {report['total_model_pss_mb']:.0f}MB "
+            f"(sharing ratio {report['model_sharing_ratio'] or 0:.1f}x); total process PSS {report['total_process_pss_mb']:.0f}MB"
+        )
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ai_chat.inference_worker import run_worker
+
+
+class Command(BaseCommand):
+    help = "Run the dedicated inference process that owns the LLM and serves chat jobs to the web workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--address',
+            help="Unix socket path to listen on (defaults to AI_INFERENCE_WORKER_ADDRESS).",
+        )
+
+    def handle(self, *args, **options):
+        address = options['address'] or settings.AI_INFERENCE_WORKER_ADDRESS
+        if not address:
+            raise CommandError("Set AI_INFERENCE_WORKER_ADDRESS or pass --address.")
+
+        self.stdout.write(f"Starting inference worker on {address}")
+        try:
+            run_worker(address)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
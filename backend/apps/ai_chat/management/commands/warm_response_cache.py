@@ -0,0 +1,127 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ai_chat.llm_handler_deployment import (
+    MODEL_VARIANTS,
+    OptimizedLlamaModel,
+    OptimizedMemoryManager,
+    _response_cache_key,
+    generate_deployment_response,
+    select_model_variant,
+)
+from apps.ai_chat.response_cache import get_response_cache
+
+TEMPLATE_PLACEHOLDER = '<INSERT CATEGORY>'
+
+
+def _load_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _category_insertions(data_dir):
+    """Every (icon, name) the frontend can plug into a template, mirroring getAllCategoryInsertions"""
+    insertions = {}
+
+    def walk(node):
+        name = (node.get('name') or '').strip()
+        if name:
+            insertions.setdefault(f"{node.get('icon', '')} {name}", None)
+        for child in node.get('subcategories') or []:
+            walk(child)
+
+    for category in _load_json(data_dir / 'mainCategories.json'):
+        walk(category)
+        sub_file = data_dir / category.get('fileName', '')
+        if category.get('fileName') and sub_file.exists():
+            walk(_load_json(sub_file))
+    return list(insertions)
+
+
+def suggestion_prompts(data_dir, kinds):
+    """Yield the exact prompt strings the frontend sends for the built-in suggestions"""
+    suggestions_dir = data_dir / 'suggestions_data'
+    talk_dir = suggestions_dir / 'things_to_talk_about_suggestions'
+
+    if 'general' in kinds:
+        for item in _load_json(talk_dir / 'general_talk_suggestions.json'):
+            yield item['prompt'].strip()
+
+    if 'do' in kinds:
+        for path in sorted((suggestions_dir / 'things_to_do_suggestions').glob('*.json')):
+            for item in _load_json(path):
+                yield item['prompt'].strip()
+
+    if 'template' in kinds:
+        templates = _load_json(talk_dir / 'template_talk_suggestions.json')
+        for insertion in _category_insertions(data_dir):
+            for template in templates:
+                yield template['prompt'].replace(TEMPLATE_PLACEHOLDER, insertion).strip()
+
+
+class Command(BaseCommand):
+    help = "Pre-generate first-turn answers for the built-in suggestion prompts into the response cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kinds',
+            default='general,do',
+            help="Comma-separated suggestion sets to warm: general, do, template (default: general,do).",
+        )
+        parser.add_argument(
+            '--data-dir',
+            default=str(Path(settings.BASE_DIR).parent / 'frontend' / 'src' / 'data'),
+            help="Path to the frontend's src/data directory.",
+        )
+        parser.add_argument('--limit', type=int, help="Stop after generating this many answers.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the prompts that are not cached yet (without loading the model).")
+
+    def handle(self, *args, **options):
+        cache = get_response_cache()
+        if cache is None:
+            raise CommandError("Response cache is disabled (set AI_RESPONSE_CACHE_DIR and install diskcache).")
+
+        data_dir = Path(options['data_dir'])
+        if not data_dir.is_dir():
+            raise CommandError(f"Suggestion data not found at {data_dir}")
+        kinds = {kind.strip() for kind in options['kinds'].split(',') if kind.strip()}
+
+        # Keys name the GGUF and sampling the router picks at load time, so load first;
+        # a dry run only needs the name of the file the router would load
+        model = OptimizedLlamaModel()
+        if options['dry_run'] and not model.is_initialized():
+            variant = select_model_variant(OptimizedMemoryManager.get_adaptive_memory_tier())
+            if variant is None:
+                raise CommandError("No model file found in ai_model/.")
+            model.model_filename = MODEL_VARIANTS[variant]['filename']
+        elif not model.initialize_model():
+            raise CommandError("Model failed to load; see the log for details.")
+
+        seen = set()
+        generated = skipped = 0
+        for prompt in suggestion_prompts(data_dir, kinds):
+            key = _response_cache_key(model, prompt)
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in cache:
+                skipped += 1
+                continue
+            if options['limit'] is not None and generated >= options['limit']:
+                break
+
+            generated += 1
+            if options['dry_run']:
+                continue
+            self.stdout.write(f"[{generated}] {prompt}")
+            # Warm-up has no user waiting, and a deadline-truncated answer is never cached
+            generate_deployment_response(prompt, timed=False)
+
+        verb = "would generate" if options['dry_run'] else "generated"
+        self.stdout.write(self.style.SUCCESS(
+            f"Response cache: {verb} {generated}, already cached {skipped} ({cache.stats()['entries']} entries)"
+        ))
@@ -0,0 +1,192 @@
+# metrics.py - Dependency-free Prometheus metrics for the inference path
+# Per-request counters and histograms are updated in-process by llm_handler_deployment;
+# point-in-time values (queue depth, tier, RSS, cache counters) are read from the
+# existing stats objects at scrape time. render() produces the text exposition format
+# (version 0.0.4) served at /api/ai/metrics. Nothing here blocks or probes the system.
+
+import gc
+import math
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def format_family(name, kind, help_text, samples):
+    """Render one metric family; samples are (suffix, labels, value) tuples"""
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for suffix, labels, value in samples:
+        lines.append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def render(self):
+        return format_family(self.name, self.kind, self.help_text, self.samples())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        return [('', self._labels(key), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if value is None or value != value:  # Skip None / NaN
+            return
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        samples = []
+        for key, (counts, total, count) in items:
+            labels = self._labels(key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append(('_bucket', {**labels, 'le': _format_value(float(bound))}, bucket_count))
+            samples.append(('_bucket', {**labels, 'le': '+Inf'}, count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+def render(extra_families=()):
+    """Everything in the registry, then the scrape-time families, as exposition text"""
+    blocks = [metric.render() for metric in _registry]
+    blocks.extend(extra_families)
+    blocks.append(_render_python_gc())
+    return '\n'.join(blocks) + '\n'
+
+
+# === REQUEST METRICS (updated by llm_handler_deployment) ===
+GENERATION_REQUESTS = Counter(
+    'ai_generation_requests_total',
+    'Chat generations by entry point and outcome (completed, truncated, cached, cancelled, error).',
+    ('mode', 'outcome'))
+PROMPT_TOKENS = Counter('ai_prompt_tokens_total', 'Prompt tokens sent to the model, history included.')
+COMPLETION_TOKENS = Counter('ai_completion_tokens_total', 'Tokens generated by the model.')
+GENERATION_SECONDS = Histogram(
+    'ai_generation_duration_seconds', 'Time on the decode thread per generation, prompt eval included.',
+    ('mode',))
+TIME_TO_FIRST_TOKEN = Histogram(
+    'ai_time_to_first_token_seconds', 'Streaming generations: decode-thread start to first token.')
+GENERATION_TOKENS_PER_SECOND = Histogram(
+    'ai_generation_tokens_per_second', 'Completion tokens over the whole generation time.',
+    ('mode',), buckets=TOKENS_PER_SECOND_BUCKETS)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    'ai_decode_tokens_per_second', 'Streaming generations: tokens after the first over the time after it.',
+    buckets=TOKENS_PER_SECOND_BUCKETS)
+PROMPT_EVAL_TOKENS_PER_SECOND = Histogram(
+    'ai_prompt_eval_tokens_per_second', 'Streaming generations: prompt tokens over the time to first token.',
+    buckets=TOKENS_PER_SECOND_BUCKETS)
+HISTORY_SUMMARIES = Counter(
+    'ai_history_summaries_total',
+    'Background history summaries by outcome (completed, preempted, stale, error).',
+    ('outcome',))
+HISTORY_SUMMARY_SECONDS = Histogram(
+    'ai_history_summary_duration_seconds', 'Decode-thread time of completed history summaries.')
+MODEL_SWITCHES = Counter(
+    'ai_model_switches_total', 'Router switches between GGUF quantizations.',
+    ('from_variant', 'to_variant'))
+TIER_TRANSITIONS = Counter(
+    'ai_memory_tier_transitions_total', 'Changes of the adaptive memory tier seen by the resource sampler.',
+    ('from_tier', 'to_tier'))
+
+
+# === INTERPRETER GC PAUSES ===
+# Accumulated without locks: gc callbacks run with the GIL held and must not block.
+_gc_seconds = [0.0, 0.0, 0.0]
+_gc_collections = [0, 0, 0]
+_gc_started = [None]
+
+
+def _gc_callback(phase, info):
+    if phase == 'start':
+        _gc_started[0] = time.perf_counter()
+    elif _gc_started[0] is not None:
+        generation = info.get('generation', 2)
+        _gc_seconds[generation] += time.perf_counter() - _gc_started[0]
+        _gc_collections[generation] += 1
+        _gc_started[0] = None
+
+
+if _gc_callback not in gc.callbacks:
+    gc.callbacks.append(_gc_callback)
+
+
+def _render_python_gc():
+    return '\n'.join([
+        format_family('ai_python_gc_seconds_total', 'counter', 'Time spent in Python garbage collection.',
+                      [('', {'generation': g}, _gc_seconds[g]) for g in range(3)]),
+        format_family('ai_python_gc_collections_total', 'counter', 'Python garbage collections run.',
+                      [('', {'generation': g}, _gc_collections[g]) for g in range(3)]),
+    ])
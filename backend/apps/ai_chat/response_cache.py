@@ -0,0 +1,97 @@
+# response_cache.py - Disk-backed exact-match cache for first-turn responses
+# The suggestion prompts from the frontend's suggestions_data are sent verbatim over
+# and over; their first-turn answers are cached here, keyed by the normalized prompt
+# plus the model and sampling settings that produced them. Shared by every process
+# on the box (diskcache is SQLite-backed) and bounded by AI_RESPONSE_CACHE_SIZE_MB.
+
+import hashlib
+import json
+import logging
+import threading
+
+from django.conf import settings
+
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    diskcache = None
+    DISKCACHE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and case so trivially different copies of a prompt share an entry"""
+    return " ".join(prompt.split()).casefold()
+
+
+class ResponseCache:
+    """Bounded, LRU-evicting response store with hit/miss counters."""
+
+    def __init__(self, directory, size_limit_bytes):
+        self._cache = diskcache.Cache(
+            directory,
+            size_limit=size_limit_bytes,
+            eviction_policy='least-recently-used',
+        )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt, model_name, system_prompt, sampling):
+        payload = json.dumps({
+            'prompt': normalize_prompt(prompt),
+            'model': model_name,
+            'system_prompt': system_prompt,
+            'sampling': sampling,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = self._cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def set(self, key, response):
+        self._cache.set(key, response)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._cache),
+            'size_mb': self._cache.volume() / (1024**2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_response_cache():
+    """Process-wide ResponseCache, or None when disabled or diskcache is missing"""
+    global _cache
+    if _cache is not None:
+        return _cache
+
+    directory = getattr(settings, 'AI_RESPONSE_CACHE_DIR', None)
+    if not directory or not DISKCACHE_AVAILABLE:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            try:
+                size_limit = int(getattr(settings, 'AI_RESPONSE_CACHE_SIZE_MB', 64)) * 1024 * 1024
+                _cache = ResponseCache(str(directory), size_limit)
+            except Exception as e:
+                logger.error(f"Response cache unavailable at {directory}: {e}")
+                return None
+    return _cache
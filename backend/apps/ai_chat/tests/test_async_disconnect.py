@@ -0,0 +1,71 @@
+import asyncio
+import json
+import threading
+from unittest import mock
+
+from django.core.asgi import get_asgi_application
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import GenerationCancelled
+from backend.asgi import cancel_on_disconnect
+
+SESSION = '0b7e1f9e-6c1a-4d8e-9a57-3f0c2d1b5a10'
+WAIT = 5
+
+
+def http_scope(path):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+    }
+
+
+class CancelOnDisconnectTests(SimpleTestCase):
+    def setUp(self):
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+        self.cancelled = []
+
+    def generate(self, message, session_id, user, model_mode):
+        """Blocks like a queued generation until it is cancelled"""
+        self.started.set()
+        self.stopped.wait(WAIT)
+        raise GenerationCancelled("Generation cancelled.")
+
+    def cancel(self, session_id):
+        self.cancelled.append(session_id)
+        self.stopped.set()
+        return 1
+
+    async def request(self, disconnect):
+        messages = asyncio.Queue()
+        body = json.dumps({'message': 'Hello', 'chat_session': SESSION}).encode()
+        await messages.put({'type': 'http.request', 'body': body, 'more_body': False})
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        app = cancel_on_disconnect(get_asgi_application())
+        with mock.patch('apps.ai_chat.async_views.generate_chat_response', self.generate), \
+                mock.patch('apps.ai_chat.async_views.cancel_chat_generation', self.cancel):
+            task = asyncio.ensure_future(app(http_scope('/api/ai/async/send-message/'), messages.get, send))
+            self.assertTrue(await asyncio.get_running_loop().run_in_executor(None, self.started.wait, WAIT))
+            if disconnect:
+                await messages.put({'type': 'http.disconnect'})
+            else:
+                self.stopped.set()
+            await asyncio.wait_for(task, WAIT)
+        return sent
+
+    async def test_disconnect_cancels_the_generation(self):
+        sent = await self.request(disconnect=True)
+        self.assertEqual(self.cancelled, [SESSION])
+        self.assertEqual(sent, [])  # Nobody left to answer
+
+    async def test_connected_client_gets_its_response(self):
+        sent = await self.request(disconnect=False)
+        self.assertEqual(self.cancelled, [])
+        self.assertEqual(sent[0]['status'], 409)  # The stand-in generation ends as cancelled
@@ -0,0 +1,254 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat import llm_handler_deployment as handler
+from apps.ai_chat.llm_handler_deployment import (
+    BatchedDecoder,
+    BatchedSequence,
+    InferenceJob,
+    InferenceScheduler,
+)
+
+WAIT = 5
+EOG = 2
+SAMPLING = {'temperature': 0.75, 'top_k': 40, 'top_p': 0.9, 'repeat_penalty': 1.1}
+PIECES = {401: 'Hi', 402: '<end', 403: '_of_turn>'}
+
+
+class FakeSequenceContext:
+    """LlamaSequenceContext stand-in: records every decode and answers each sequence from a script.
+
+    The script is picked by the first prompt token a sequence evaluates.
+    """
+
+    def __init__(self, scripts, n_seq=4, n_batch=16, n_ctx_per_seq=256):
+        self.scripts = scripts
+        self.n_seq = n_seq
+        self.n_batch = n_batch
+        self.n_ctx_per_seq = n_ctx_per_seq
+        self.n_tokens = 0
+        self.rows = []
+        self.steps = []
+        self.released = []
+        self._answers = {}
+
+    def clear(self):
+        self.n_tokens = 0
+        self.rows = []
+
+    def add(self, token, pos, seq_id, logits):
+        if pos == 0:
+            self._answers[seq_id] = iter(self.scripts[token])
+        self.rows.append((token, pos, seq_id, logits))
+        self.n_tokens += 1
+        return self.n_tokens - 1
+
+    def decode(self):
+        self.steps.append(list(self.rows))
+
+    def new_sampler(self, **sampling):
+        return dict(sampling)
+
+    def sample(self, sampler, row):
+        token, pos, seq_id, logits = self.rows[row]
+        assert logits, "sampled a row without logits"
+        return next(self._answers[seq_id])
+
+    def is_eog(self, token):
+        return token == EOG
+
+    def piece(self, token):
+        return PIECES.get(token, f"w{token} ").encode()
+
+    def release(self, seq_id, sampler=None):
+        self.released.append(seq_id)
+
+
+def sequence(prompt, max_tokens=64, stream=False, chat_session=None):
+    job = InferenceJob(None, (), chat_session, mode='stream' if stream else 'generate')
+    return BatchedSequence(job, prompt, max_tokens, SAMPLING, stream=stream)
+
+
+def run(decoder):
+    finished = []
+    while decoder.sequences:
+        finished += decoder.step()
+    return finished
+
+
+class BatchedDecoderTests(SimpleTestCase):
+    def test_sessions_share_each_decode(self):
+        context = FakeSequenceContext({10: [101, 102, 103, EOG], 20: [201, EOG], 30: [301, 302, EOG]})
+        decoder = BatchedDecoder(context)
+        sequences = [sequence([10, 11, 12]), sequence([20, 21]), sequence([30])]
+        for seq in sequences:
+            decoder.admit(seq)
+        run(decoder)
+
+        self.assertEqual([seq.text for seq in sequences], ['w101 w102 w103 ', 'w201 ', 'w301 w302 '])
+        self.assertEqual([seq.finish_reason for seq in sequences], ['stop'] * 3)
+        # Four llama_decode calls for all three answers; one at a time would take nine
+        self.assertEqual(len(context.steps), 4)
+        self.assertEqual({row[2] for row in context.steps[1]}, {0, 1, 2})
+        self.assertEqual(sorted(context.released), [0, 1, 2])
+
+    def test_each_sequence_has_its_own_positions(self):
+        context = FakeSequenceContext({10: [101, 102, EOG], 20: [201, 202, EOG]})
+        decoder = BatchedDecoder(context)
+        decoder.admit(sequence([10, 11, 12]))
+        decoder.admit(sequence([20]))
+        run(decoder)
+
+        positions = {}
+        for step in context.steps:
+            for token, pos, seq_id, logits in step:
+                positions.setdefault(seq_id, []).append(pos)
+        self.assertEqual(positions, {0: [0, 1, 2, 3, 4], 1: [0, 1, 2]})
+
+    def test_prompt_is_evaluated_in_chunks_alongside_decoding(self):
+        context = FakeSequenceContext({10: [101, 102, 103, 104, EOG], 20: [201, EOG]}, n_batch=4)
+        decoder = BatchedDecoder(context)
+        decoder.admit(sequence([10]))
+        decoder.step()
+        decoder.admit(sequence([20, 21, 22, 23, 24, 25]))
+        run(decoder)
+
+        self.assertTrue(all(len(step) <= 4 for step in context.steps))
+        newcomer = [row for step in context.steps for row in step if row[2] == 1]
+        self.assertEqual([row[0] for row in newcomer[:6]], [20, 21, 22, 23, 24, 25])
+        # Logits only for the last prompt token, then for every generated one
+        self.assertEqual([row[3] for row in newcomer], [False] * 5 + [True, True])
+        # The first session kept generating while the prompt was evaluated
+        self.assertTrue(all(any(row[2] == 0 for row in step) for step in context.steps[1:3]))
+
+    def test_cancelled_sequence_leaves_the_others_running(self):
+        context = FakeSequenceContext({10: [101, 102, 103, EOG], 20: [201, 202, 203, EOG]})
+        decoder = BatchedDecoder(context)
+        keep, drop = sequence([10]), sequence([20])
+        decoder.admit(keep)
+        decoder.admit(drop)
+        decoder.step()
+        drop.job.cancelled.set()
+        self.assertEqual(decoder.step(), [drop])
+        self.assertEqual(context.released, [drop.seq_id])
+        run(decoder)
+        self.assertEqual(keep.text, 'w101 w102 w103 ')
+        self.assertEqual(drop.text, 'w201 ')
+
+    def test_max_tokens_ends_with_length(self):
+        context = FakeSequenceContext({10: [101, 102, 103, EOG]})
+        decoder = BatchedDecoder(context)
+        seq = sequence([10], max_tokens=2)
+        decoder.admit(seq)
+        run(decoder)
+        self.assertEqual((seq.text, seq.finish_reason), ('w101 w102 ', 'length'))
+
+    def test_freed_sequence_id_is_reused(self):
+        context = FakeSequenceContext({10: [EOG], 20: [201, EOG], 30: [EOG]}, n_seq=2)
+        decoder = BatchedDecoder(context)
+        first, second = sequence([10]), sequence([20])
+        decoder.admit(first)
+        decoder.admit(second)
+        self.assertEqual(decoder.free_slots(), 0)
+        decoder.step()
+        third = sequence([30])
+        decoder.admit(third)
+        self.assertEqual(third.seq_id, first.seq_id)
+
+    def test_stream_holds_back_a_stop_sequence(self):
+        context = FakeSequenceContext({10: [401, 402, 403, 101]})
+        decoder = BatchedDecoder(context)
+        seq = sequence([10], stream=True)
+        decoder.admit(seq)
+        run(decoder)
+        seq.flush()
+        self.assertEqual((seq.text, seq.finish_reason), ('Hi', 'stop'))
+        events = []
+        while not seq.job.events.empty():
+            events.append(seq.job.events.get())
+        self.assertEqual(events, [('token', 'Hi')])
+
+
+def hold(job, release):
+    release.wait(WAIT)
+
+
+def solo(job, prompt, chat_session, cache_key):
+    return 'solo'
+
+
+def endless_answer():
+    while True:
+        time.sleep(0.001)
+        yield 301
+
+
+def start_fake(job):
+    prompt, chat_session, cache_key = job.args
+    return BatchedSequence(job, prompt, 10 ** 6, SAMPLING, stream=job.mode == 'stream')
+
+
+def finish_fake(sequence):
+    sequence.job.result = sequence.text
+
+
+class SchedulerBatchingTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = InferenceScheduler()
+        self.scheduler._reset()
+        self.release = threading.Event()
+        self.context = FakeSequenceContext({10: [101, 102, EOG], 20: [201, EOG], 30: [301, 302, 303, EOG]})
+        for target in (mock.patch.object(handler, '_batch_context', return_value=self.context),
+                       mock.patch.object(handler, '_start_batched', side_effect=start_fake),
+                       mock.patch.object(handler, '_finish_batched', side_effect=finish_fake)):
+            target.start()
+            self.addCleanup(target.stop)
+        self.addCleanup(self.drain)
+
+    def drain(self):
+        self.release.set()
+        deadline = time.time() + WAIT
+        while (self.scheduler.active_job or self.scheduler.batch_jobs or self.scheduler._queue) and time.time() < deadline:
+            time.sleep(0.005)
+
+    def submit(self, prompt, chat_session):
+        return self.scheduler.submit(InferenceJob(solo, (prompt, chat_session, None), chat_session, mode='generate'))
+
+    def test_queued_chat_jobs_decode_together(self):
+        holder = self.scheduler.submit(InferenceJob(hold, (self.release,), 'busy'))
+        self.assertTrue(holder.started.wait(WAIT))
+        jobs = [self.submit([10], 'a'), self.submit([20], 'b'), self.submit([30], 'c')]
+        self.release.set()
+        for job in jobs:
+            self.assertTrue(job.finished.wait(WAIT))
+
+        self.assertEqual([job.result for job in jobs], ['w101 w102 ', 'w201 ', 'w301 w302 w303 '])
+        self.assertEqual(len(self.context.steps), 4)
+        self.assertEqual(max(len({row[2] for row in step}) for step in self.context.steps), 3)
+        self.assertEqual(self.scheduler.stats()['completed'], 4)
+
+    def test_same_session_turns_are_not_batched_together(self):
+        holder = self.scheduler.submit(InferenceJob(hold, (self.release,), 'busy'))
+        self.assertTrue(holder.started.wait(WAIT))
+        jobs = [self.submit([10], 'a'), self.submit([20], 'a'), self.submit([30], 'b')]
+        self.release.set()
+        for job in jobs:
+            self.assertTrue(job.finished.wait(WAIT))
+        # The first turn runs alone; the second only joins a batch once it has finished
+        self.assertEqual([job.result for job in jobs], ['solo', 'w201 ', 'w301 w302 w303 '])
+
+    def test_cancel_reaches_a_batched_job(self):
+        self.context.scripts[30] = endless_answer()
+        holder = self.scheduler.submit(InferenceJob(hold, (self.release,), 'busy'))
+        self.assertTrue(holder.started.wait(WAIT))
+        endless = self.submit([30], 'endless')
+        other = self.submit([20], 'other')
+        self.release.set()
+        self.assertTrue(other.finished.wait(WAIT))
+        self.assertEqual(self.scheduler.position('endless')['state'], 'running')
+        self.assertEqual(self.scheduler.cancel('endless'), 1)
+        self.assertTrue(endless.finished.wait(WAIT))
+        self.assertTrue(endless.cancelled.is_set())
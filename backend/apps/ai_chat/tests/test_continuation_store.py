@@ -0,0 +1,73 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat.inference_worker import InferenceWorkerUnavailable
+from apps.ai_chat.llm_handler_deployment import ContinuationStore, continue_chat_response
+
+
+def record(continuation_id, owner=None, created_at=1000.0):
+    return {'id': continuation_id, 'owner': owner, 'created_at': created_at,
+            'reason': 'deadline', 'prompt_tokens': [1, 2, 3], 'text': 'partial'}
+
+
+@mock.patch('apps.ai_chat.llm_handler_deployment.time.time', return_value=1000.0)
+class ContinuationStoreTests(SimpleTestCase):
+    def test_requires_the_latest_id(self, _):
+        store = ContinuationStore()
+        store.put('s', record('first'))
+        store.put('s', record('second'))
+        self.assertIsNone(store.get('s', 'first'))
+        self.assertIsNone(store.get('s', None))
+        self.assertEqual(store.get('s', 'second')['id'], 'second')
+
+    def test_bound_to_its_owner(self, _):
+        store = ContinuationStore()
+        store.put('user', record('a', owner=7))
+        store.put('guest', record('b'))
+        self.assertIsNotNone(store.get('user', 'a', 7))
+        self.assertIsNone(store.get('user', 'a', 8))
+        self.assertIsNone(store.get('user', 'a'))  # A guest can't take over a user's answer
+        self.assertIsNone(store.get('guest', 'b', 7))
+        self.assertIsNotNone(store.get('guest', 'b'))
+
+    def test_mismatch_keeps_the_record(self, _):
+        store = ContinuationStore()
+        store.put('s', record('a', owner=7))
+        store.get('s', 'a', 8)
+        store.get('s', 'other', 7)
+        self.assertIsNotNone(store.get('s', 'a', 7))
+
+    def test_expires_after_ttl(self, clock):
+        store = ContinuationStore(ttl=60)
+        store.put('s', record('a'))
+        clock.return_value = 1061.0
+        self.assertIsNone(store.get('s', 'a'))
+        self.assertEqual(store.stats()['sessions'], 0)
+        self.assertEqual(store.expired, 1)
+
+    def test_oldest_session_dropped_beyond_max(self, _):
+        store = ContinuationStore(max_sessions=2)
+        for session in ('a', 'b', 'c'):
+            store.put(session, record(session))
+        self.assertIsNone(store.get('a', 'a'))
+        self.assertIsNotNone(store.get('c', 'c'))
+        self.assertEqual(store.stats()['sessions'], 2)
+
+    def test_discard(self, _):
+        store = ContinuationStore()
+        store.put('s', record('a'))
+        self.assertTrue(store.discard('s'))
+        self.assertFalse(store.discard('s'))
+        self.assertIsNone(store.get('s', 'a'))
+
+
+class ContinueChatResponseTests(SimpleTestCase):
+    def test_worker_outage_is_an_error_text(self):
+        client = mock.Mock()
+        client.call.side_effect = InferenceWorkerUnavailable("socket gone")
+        with mock.patch('apps.ai_chat.llm_handler_deployment._worker_client', return_value=client):
+            response = continue_chat_response('s', 'a', None)
+        # The views answer this prefix with a 500 and leave the saved answer alone
+        self.assertTrue(response.startswith("Sorry, I encountered an error"))
+        client.call.assert_called_once_with('continue', 's', 'a', None)
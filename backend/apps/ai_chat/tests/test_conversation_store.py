@@ -0,0 +1,100 @@
+import time
+from array import array
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import HISTORY_MESSAGE_OVERHEAD_BYTES, ConversationStore
+
+
+def message(content, role='user'):
+    return {'role': role, 'content': content}
+
+
+def size(*contents):
+    return sum(len(c.encode('utf-8')) + HISTORY_MESSAGE_OVERHEAD_BYTES for c in contents)
+
+
+class ConversationStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.evicted = []
+
+    def store(self, **kwargs):
+        kwargs.setdefault('max_sessions', 10)
+        kwargs.setdefault('idle_ttl', 3600)
+        kwargs.setdefault('max_bytes', 10**6)
+        return ConversationStore(on_evict=self.evicted.append, **kwargs)
+
+    def test_tracks_size_per_message(self):
+        store = self.store()
+        store.append('a', message('hello'))
+        store.append('a', message('hi there', 'assistant'))
+        self.assertEqual(store.size_bytes, size('hello', 'hi there'))
+        del store['a']
+        self.assertEqual(store.size_bytes, 0)
+        self.assertNotIn('a', store)
+
+    def test_cached_token_ids_count_toward_the_budget(self):
+        store = self.store(max_bytes=size('hi', 'yo') + 100)
+        first, second = message('hi'), message('yo')
+        store.append('a', first)
+        store.append('b', second)
+        # What the handler memoizes on a message once it has been prompted
+        first['token_ids'] = array('i', range(30))
+        first['first_token_ids'] = array('i', range(20))
+        self.assertEqual(store.stats()['size_kb'] * 1024, size('hi', 'yo') + 50 * 4)
+        store.sweep()
+        self.assertEqual(self.evicted, ['a'])
+        self.assertEqual(store.size_bytes, size('yo'))
+
+    def test_evicts_least_recently_used_beyond_max_sessions(self):
+        store = self.store(max_sessions=2)
+        for session in ('a', 'b'):
+            store.append(session, message(session))
+        store.get('a')  # 'a' is now the most recently used
+        store.append('c', message('c'))
+        store.sweep()
+        self.assertEqual(self.evicted, ['b'])
+        self.assertEqual(store.stats()['evictions']['lru'], 1)
+
+    def test_evicts_idle_sessions(self):
+        store = self.store(idle_ttl=60)
+        store.append('old', message('x'))
+        store.append('new', message('y'))
+        with mock.patch('apps.ai_chat.llm_handler_deployment.time.time', return_value=time.time() + 30):
+            store.append('new', message('z'))
+        with mock.patch('apps.ai_chat.llm_handler_deployment.time.time', return_value=time.time() + 75):
+            store.sweep()
+        self.assertEqual(self.evicted, ['old'])
+        self.assertIn('new', store)
+
+    def test_byte_budget_shrinks_under_pressure_but_keeps_newest(self):
+        budget = size('x' * 100) * 2
+        store = self.store(max_bytes=budget)
+        for session in ('a', 'b'):
+            store.append(session, message('x' * 100))
+        store.sweep('low')
+        self.assertEqual(self.evicted, [])
+        store.sweep('high')  # A quarter of the budget: only the newest session survives
+        self.assertEqual(self.evicted, ['a'])
+        self.assertEqual(len(store), 1)
+
+    def test_replace_keeps_memory_note(self):
+        store = self.store()
+        older = [message('one'), message('two', 'assistant')]
+        for m in older + [message('three')]:
+            store.append('a', m)
+        self.assertTrue(store.compact('a', older, 'summary'))
+        self.assertEqual(store.get_memory('a')['messages'], 2)
+        store.replace('a', [message('three')])
+        self.assertEqual(store.get_memory('a')['content'], 'summary')
+        self.assertEqual(store.size_bytes, size('three', 'summary'))
+
+    def test_compact_refuses_a_history_that_changed(self):
+        store = self.store()
+        older = [message('one'), message('two', 'assistant')]
+        for m in older:
+            store.append('a', m)
+        store.replace('a', [message('one'), message('two', 'assistant')])  # Same text, new objects
+        self.assertFalse(store.compact('a', older, 'summary'))
+        self.assertIsNone(store.get_memory('a'))
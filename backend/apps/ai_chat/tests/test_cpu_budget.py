@@ -0,0 +1,61 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import _cgroup_cpu_limit, detect_cpu_budget
+
+CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CFS_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CFS_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def fake_cgroup(files):
+    """open() replacement serving `files` (path -> content); any other path is missing"""
+    def fake_open(path, *args, **kwargs):
+        if path not in files:
+            raise FileNotFoundError(path)
+        return mock.mock_open(read_data=files[path])()
+    return mock.patch('builtins.open', fake_open)
+
+
+class CgroupCpuLimitTests(SimpleTestCase):
+    def test_v2_quota(self):
+        with fake_cgroup({CPU_MAX: '150000 100000\n'}):
+            self.assertEqual(_cgroup_cpu_limit(), 1.5)
+
+    def test_v2_unlimited(self):
+        with fake_cgroup({CPU_MAX: 'max 100000\n', CFS_QUOTA: '200000\n', CFS_PERIOD: '100000\n'}):
+            self.assertIsNone(_cgroup_cpu_limit())
+
+    def test_v1_quota_when_v2_is_absent(self):
+        with fake_cgroup({CFS_QUOTA: '50000\n', CFS_PERIOD: '100000\n'}):
+            self.assertEqual(_cgroup_cpu_limit(), 0.5)
+
+    def test_v1_unlimited(self):
+        with fake_cgroup({CFS_QUOTA: '-1\n', CFS_PERIOD: '100000\n'}):
+            self.assertIsNone(_cgroup_cpu_limit())
+
+    def test_malformed_v2_falls_back_to_v1(self):
+        with fake_cgroup({CPU_MAX: 'garbage\n', CFS_QUOTA: '300000\n', CFS_PERIOD: '100000\n'}):
+            self.assertEqual(_cgroup_cpu_limit(), 3.0)
+
+    def test_no_cgroup_files(self):
+        with fake_cgroup({}):
+            self.assertIsNone(_cgroup_cpu_limit())
+
+
+class DetectCpuBudgetTests(SimpleTestCase):
+    def budget(self, affinity, quota):
+        with mock.patch('os.sched_getaffinity', return_value=set(range(affinity)), create=True), \
+                mock.patch('apps.ai_chat.llm_handler_deployment._cgroup_cpu_limit', return_value=quota):
+            return detect_cpu_budget()['budget']
+
+    def test_quota_caps_affinity(self):
+        self.assertEqual(self.budget(8, 2.0), 2)
+
+    def test_fractional_quota_rounds_down_to_at_least_one(self):
+        self.assertEqual(self.budget(8, 1.5), 1)
+        self.assertEqual(self.budget(8, 0.5), 1)
+
+    def test_unlimited_uses_affinity(self):
+        self.assertEqual(self.budget(4, None), 4)
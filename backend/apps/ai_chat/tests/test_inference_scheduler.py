@@ -0,0 +1,119 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import (
+    InferenceJob,
+    InferenceQueueFull,
+    InferenceQueueTimeout,
+    InferenceScheduler,
+)
+
+WAIT = 5  # Upper bound for anything the decode thread should do promptly
+
+
+def hold(job, release):
+    """Occupy the decode thread until `release` is set"""
+    release.wait(WAIT)
+    return 'held'
+
+
+def decode(job):
+    """Stand-in for create_completion: 'decodes' until the stopping criteria fire"""
+    deadline = time.time() + WAIT
+    while not job._should_stop() and time.time() < deadline:
+        time.sleep(0.005)
+    return 'stopped'
+
+
+def record(job, ran):
+    ran.append(job)
+    return 'ran'
+
+
+class InferenceSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = InferenceScheduler()
+        self.scheduler._reset()  # Fresh queue and counters; a new decode thread starts on submit
+        self.release = threading.Event()
+        self.addCleanup(self.drain)
+
+    def drain(self):
+        self.release.set()
+        deadline = time.time() + WAIT
+        while (self.scheduler.active_job or self.scheduler._queue) and time.time() < deadline:
+            time.sleep(0.005)
+
+    def occupy(self, chat_session='busy'):
+        job = self.scheduler.submit(InferenceJob(hold, (self.release,), chat_session))
+        self.assertTrue(job.started.wait(WAIT))
+        return job
+
+    def test_runs_jobs_in_order(self):
+        ran = []
+        jobs = [self.scheduler.submit(InferenceJob(record, (ran,), str(i))) for i in range(3)]
+        for job in jobs:
+            self.assertTrue(job.finished.wait(WAIT))
+        self.assertEqual(ran, jobs)
+        self.assertEqual(jobs[0].result, 'ran')
+
+    @mock.patch('apps.ai_chat.llm_handler_deployment.QUEUE_MAX_DEPTH', 2)
+    def test_rejects_beyond_max_depth(self):
+        self.occupy()
+        for session in ('a', 'b'):
+            self.scheduler.submit(InferenceJob(record, ([],), session))
+        with self.assertRaises(InferenceQueueFull) as raised:
+            self.scheduler.submit(InferenceJob(record, ([],), 'c'))
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(self.scheduler.rejected_jobs, 1)
+        self.assertEqual(self.scheduler.position('b')['position'], 2)
+
+    @mock.patch('apps.ai_chat.llm_handler_deployment.QUEUE_MAX_WAIT_SECONDS', 0.05)
+    def test_withdraws_job_not_started_in_time(self):
+        self.occupy()
+        ran = []
+        job = self.scheduler.submit(InferenceJob(record, (ran,), 'late'))
+        with self.assertRaises(InferenceQueueTimeout):
+            self.scheduler.wait_until_started(job)
+        self.assertTrue(job.finished.is_set())
+        self.assertEqual(self.scheduler.position('late')['state'], 'idle')
+        self.assertEqual(self.scheduler.expired_jobs, 1)
+        self.release.set()
+        self.drain()
+        self.assertEqual(ran, [])
+
+    def test_cancel_withdraws_queued_job(self):
+        self.occupy()
+        ran = []
+        job = self.scheduler.submit(InferenceJob(record, (ran,), 'queued'))
+        self.assertEqual(self.scheduler.cancel('queued'), 1)
+        self.assertTrue(job.finished.is_set())
+        self.assertIsNone(job.events.get(timeout=WAIT))  # Streaming consumers are woken up
+        self.release.set()
+        self.drain()
+        self.assertEqual(ran, [])
+
+    def test_cancel_stops_running_job_at_next_token(self):
+        job = self.scheduler.submit(InferenceJob(decode, (), 'running'))
+        self.assertTrue(job.started.wait(WAIT))
+        self.assertEqual(self.scheduler.position('running')['state'], 'running')
+        self.assertEqual(self.scheduler.cancel('running'), 1)
+        self.assertTrue(job.finished.wait(WAIT))
+        self.assertEqual(job.result, 'stopped')
+        self.assertTrue(job.cancelled.is_set())
+
+    def test_cancel_leaves_other_sessions_alone(self):
+        self.occupy()
+        job = self.scheduler.submit(InferenceJob(record, ([],), 'other'))
+        self.assertEqual(self.scheduler.cancel('nobody'), 0)
+        self.assertFalse(job.cancelled.is_set())
+
+    def test_chat_job_preempts_background_job(self):
+        background = self.scheduler.submit_background(InferenceJob(decode, (), 'a'))
+        self.assertTrue(background.started.wait(WAIT))
+        job = self.scheduler.submit(InferenceJob(record, ([],), 'b'))
+        self.assertTrue(job.finished.wait(WAIT))
+        self.assertTrue(background.preempted.is_set())
+        self.assertEqual(background.result, 'stopped')
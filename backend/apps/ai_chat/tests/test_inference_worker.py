@@ -0,0 +1,25 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+
+from apps.ai_chat.inference_worker import _worker_authkey
+
+
+class WorkerAuthkeyTests(SimpleTestCase):
+    @override_settings(AI_INFERENCE_WORKER_AUTHKEY='')
+    def test_missing_key_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            _worker_authkey()
+
+    @override_settings(AI_INFERENCE_WORKER_AUTHKEY='your-default-secret-key-for-dev')
+    def test_placeholder_key_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            _worker_authkey()
+
+    @override_settings(SECRET_KEY='a-real-django-secret', AI_INFERENCE_WORKER_AUTHKEY='a-real-django-secret')
+    def test_secret_key_is_not_reused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            _worker_authkey()
+
+    @override_settings(AI_INFERENCE_WORKER_AUTHKEY='0f8e6c2d4b1a')
+    def test_dedicated_key_is_used(self):
+        self.assertEqual(_worker_authkey(), b'0f8e6c2d4b1a')
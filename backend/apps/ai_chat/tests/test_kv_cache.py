@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import SessionKVCache, _state_size_bytes
+
+N_VOCAB = 1000
+
+
+def fake_state(n_tokens, kv_bytes=1000, score_rows=8):
+    """Stand-in for llama_cpp.LlamaState: KV blob size plus the numpy copies save_state() makes"""
+    return SimpleNamespace(
+        llama_state_size=kv_bytes,
+        scores=np.zeros((score_rows, N_VOCAB), dtype=np.single),
+        input_ids=np.arange(n_tokens, dtype=np.intc),
+        n_tokens=n_tokens,
+    )
+
+
+class SessionKVCacheTests(SimpleTestCase):
+    def test_budget_counts_logits_and_input_ids(self):
+        cache = SessionKVCache(capacity_bytes=10**6)
+        state = fake_state(10)
+        cache.store('a', state)
+        # Only the last logits row is kept, and it counts against the budget
+        self.assertEqual(state.scores.shape, (1, N_VOCAB))
+        self.assertEqual(cache.size_bytes, 1000 + N_VOCAB * 4 + 10 * 4)
+        self.assertEqual(cache.size_bytes, _state_size_bytes(state))
+
+    def test_evicts_least_recently_used_to_stay_under_budget(self):
+        one = _state_size_bytes(fake_state(10, score_rows=1))
+        cache = SessionKVCache(capacity_bytes=2 * one)
+        cache.store('a', fake_state(10))
+        cache.store('b', fake_state(10))
+        cache.lookup('a', [0, 1])  # 'a' becomes most recently used
+        cache.store('c', fake_state(10))
+
+        self.assertEqual(cache.lookup('b', [0])[0], None)
+        self.assertIsNotNone(cache.lookup('a', [0])[0])
+        self.assertIsNotNone(cache.lookup('c', [0])[0])
+        self.assertLessEqual(cache.size_bytes, cache.capacity_bytes)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_rejects_state_larger_than_budget(self):
+        cache = SessionKVCache(capacity_bytes=500)
+        self.assertFalse(cache.store('a', fake_state(10)))
+        self.assertEqual(cache.size_bytes, 0)
+
+    def test_replacing_and_resizing_keep_size_consistent(self):
+        cache = SessionKVCache(capacity_bytes=10**6)
+        cache.store('a', fake_state(10))
+        cache.store('a', fake_state(20))
+        self.assertEqual(cache.size_bytes, _state_size_bytes(fake_state(20, score_rows=1)))
+        cache.store('b', fake_state(10))
+        cache.resize(cache.size_bytes - 1)
+        self.assertEqual(cache.stats()['sessions'], 1)
+        cache.discard('b')
+        self.assertEqual(cache.size_bytes, 0)
+
+    def test_lookup_reports_shared_prefix(self):
+        cache = SessionKVCache(capacity_bytes=10**6)
+        cache.store('a', fake_state(5))
+        state, prefix = cache.lookup('a', [0, 1, 2, 9, 9])
+        self.assertEqual(prefix, 3)
+        self.assertEqual(cache.lookup('missing', [0]), (None, 0))
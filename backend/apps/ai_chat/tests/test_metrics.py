@@ -0,0 +1,68 @@
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from apps.ai_chat import metrics
+from apps.ai_chat.views import metrics_view
+
+
+class ExpositionTests(SimpleTestCase):
+    def metric(self, cls, *args, **kwargs):
+        metric = cls(*args, **kwargs)
+        self.addCleanup(metrics._registry.remove, metric)
+        return metric
+
+    def test_unlabelled_counter_renders_zero(self):
+        counter = self.metric(metrics.Counter, 'test_total', 'A test counter.')
+        self.assertEqual(counter.render(), '# HELP test_total A test counter.\n# TYPE test_total counter\ntest_total 0')
+
+    def test_counter_labels_are_sorted_and_escaped(self):
+        counter = self.metric(metrics.Counter, 'test_total', 'Help.', ('mode',))
+        counter.inc(mode='stream')
+        counter.inc(2, mode='say "hi"\n')
+        lines = counter.render().splitlines()[2:]
+        self.assertEqual(lines, ['test_total{mode="say \\"hi\\"\\n"} 2', 'test_total{mode="stream"} 1'])
+
+    def test_counter_rejects_wrong_labels(self):
+        counter = self.metric(metrics.Counter, 'test_total', 'Help.', ('mode',))
+        with self.assertRaises(ValueError):
+            counter.inc(outcome='done')
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.metric(metrics.Histogram, 'test_seconds', 'Help.', buckets=(1, 5))
+        for value in (0.5, 3, 10, None):
+            histogram.observe(value)
+        lines = histogram.render().splitlines()[2:]
+        self.assertEqual(lines, [
+            'test_seconds_bucket{le="1.0"} 1',
+            'test_seconds_bucket{le="5.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 13.5',
+            'test_seconds_count 3',
+        ])
+
+    def test_render_includes_registry_extras_and_gc(self):
+        text = metrics.render([metrics.format_family('test_depth', 'gauge', 'Extra.', [('', {}, None)])])
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE ai_generation_requests_total counter', text)
+        self.assertIn('test_depth NaN', text)
+        self.assertIn('ai_python_gc_collections_total{generation="2"}', text)
+
+
+@mock.patch('apps.ai_chat.views.get_metrics_text', return_value='ai_up 1\n')
+class MetricsViewTests(SimpleTestCase):
+    def scrape(self, **headers):
+        return metrics_view(RequestFactory().get('/api/ai/metrics', **headers))
+
+    @override_settings(AI_METRICS_TOKEN='')
+    def test_hidden_without_token(self, _):
+        self.assertEqual(self.scrape().status_code, 404)
+
+    @override_settings(AI_METRICS_TOKEN='scrape-secret')
+    def test_requires_bearer_token(self, _):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.scrape(HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertEqual(response.content, b'ai_up 1\n')
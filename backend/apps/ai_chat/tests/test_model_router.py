@@ -0,0 +1,54 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat import llm_handler_deployment as handler
+from apps.ai_chat.llm_handler_deployment import MODEL_VARIANTS, select_model_variant
+
+
+class SelectModelVariantTests(SimpleTestCase):
+    def setUp(self):
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+        self.model_dir = os.path.join(base_dir.name, 'ai_model')
+        os.makedirs(self.model_dir)
+        for target in (mock.patch.object(handler, 'BASE_DIR', base_dir.name),
+                       mock.patch.object(handler, 'MODEL_VARIANT_PIN', None)):
+            target.start()
+            self.addCleanup(target.stop)
+
+    def place(self, *names):
+        """Sparse GGUF stand-ins with the registry's weight sizes"""
+        for name in names:
+            with open(os.path.join(self.model_dir, MODEL_VARIANTS[name]['filename']), 'wb') as f:
+                f.truncate(MODEL_VARIANTS[name]['weights_mb'] * 1024 * 1024)
+
+    def test_none_on_disk(self):
+        self.assertIsNone(select_model_variant('high'))
+
+    def test_best_variant_the_tier_allows(self):
+        self.place('Q8_0', 'Q4_K_M', 'Q4_0')
+        self.assertEqual(
+            {tier: select_model_variant(tier) for tier in handler.MEMORY_TIER_ORDER},
+            {'minimal': 'Q4_0', 'low': 'Q4_K_M', 'medium': 'Q8_0', 'high': 'Q8_0'})
+
+    def test_smallest_on_disk_when_tier_allows_none(self):
+        self.place('Q8_0', 'Q4_K_M')
+        self.assertEqual(select_model_variant('minimal'), 'Q4_K_M')
+
+    def test_pin_overrides_tier(self):
+        self.place('Q8_0', 'Q4_0')
+        with mock.patch.object(handler, 'MODEL_VARIANT_PIN', 'Q8_0'):
+            self.assertEqual(select_model_variant('minimal'), 'Q8_0')
+
+    def test_upgrade_needs_headroom_for_the_extra_weights(self):
+        self.place('Q8_0', 'Q4_K_M', 'Q4_0')
+        # 800MB minus Q8_0's extra 350MB lands on 'low', which only allows Q4_K_M
+        self.assertEqual(select_model_variant('high', 'Q4_0', available_mb=800), 'Q4_K_M')
+        self.assertEqual(select_model_variant('high', 'Q4_0', available_mb=1200), 'Q8_0')
+
+    def test_downgrade_ignores_headroom(self):
+        self.place('Q8_0', 'Q4_K_M', 'Q4_0')
+        self.assertEqual(select_model_variant('minimal', 'Q8_0', available_mb=100), 'Q4_0')
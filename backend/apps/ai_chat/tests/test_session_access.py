@@ -0,0 +1,56 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, SimpleTestCase
+
+from apps.ai_chat.async_views import async_cancel_generation_view
+from apps.ai_chat.llm_handler_deployment import owns_session, session_token
+from apps.ai_chat.views import cancel_generation_view, new_chat_session_view
+
+SESSION = '0b7e1f9e-6c1a-4d8e-9a57-3f0c2d1b5a10'
+
+
+class SessionTokenTests(SimpleTestCase):
+    def test_token_is_bound_to_its_session(self):
+        token = session_token(SESSION)
+        self.assertTrue(owns_session(None, SESSION, token))
+        self.assertFalse(owns_session(None, 'another-session', token))
+
+    def test_guest_without_token_owns_nothing(self):
+        self.assertFalse(owns_session(None, SESSION))
+        self.assertFalse(owns_session(None, SESSION, 'forged'))
+
+    def test_new_session_hands_out_its_token(self):
+        response = new_chat_session_view(RequestFactory().post('/api/ai/new-session/'))
+        session_id = response.data['chat_session_id']
+        self.assertEqual(response.data['session_token'], session_token(session_id))
+
+
+class CancelGenerationAccessTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def cancel(self, **headers):
+        request = self.factory.post(f'/api/ai/cancel/{SESSION}/', **headers)
+        return cancel_generation_view(request, SESSION)
+
+    def async_cancel(self, body=None, **headers):
+        request = self.factory.post(f'/api/ai/async/cancel/{SESSION}/', data=json.dumps(body or {}),
+                                    content_type='application/json', **headers)
+        return async_to_sync(async_cancel_generation_view)(request, SESSION)
+
+    def test_guest_without_token_is_refused(self):
+        self.assertEqual(self.cancel().status_code, 404)
+        self.assertEqual(self.async_cancel().status_code, 404)
+
+    def test_other_sessions_token_is_refused(self):
+        token = session_token('another-session')
+        self.assertEqual(self.cancel(HTTP_X_CHAT_SESSION_TOKEN=token).status_code, 404)
+        self.assertEqual(self.async_cancel({'session_token': token}).status_code, 404)
+
+    def test_session_token_allows_cancel(self):
+        token = session_token(SESSION)
+        response = self.cancel(HTTP_X_CHAT_SESSION_TOKEN=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'cancelled': False, 'jobs': 0})
+        self.assertEqual(self.async_cancel({'session_token': token}).status_code, 200)
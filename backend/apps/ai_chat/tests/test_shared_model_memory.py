@@ -0,0 +1,110 @@
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from apps.ai_chat.llm_handler_deployment import _read_smaps, prefetch_model_weights, shared_memory_report
+
+FILE_MB = 8
+
+# A second process mapping the same file, like a gunicorn worker loading its own context
+MAPPER = """
+import mmap, sys
+with open(sys.argv[1], 'rb') as f:
+    weights = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    sum(weights[i] for i in range(0, len(weights), mmap.PAGESIZE))
+    print('mapped', flush=True)
+    sys.stdin.read()
+"""
+
+SMAPS = """\
+7f0000000000-7f0000800000 r--s 00000000 08:01 1234 /srv/ai_model/model.gguf
+Rss:                8192 kB
+Pss:                4096 kB
+Shared_Clean:       8192 kB
+Private_Clean:         0 kB
+7f0000800000-7f0000900000 rw-p 00000000 00:00 0
+Rss:                1024 kB
+Pss:                1024 kB
+Private_Dirty:      1024 kB
+"""
+
+
+class ReadSmapsTests(SimpleTestCase):
+    def setUp(self):
+        handle = tempfile.NamedTemporaryFile('w', suffix='smaps', delete=False)
+        self.addCleanup(os.unlink, handle.name)
+        with handle:
+            handle.write(SMAPS)
+        self.path = handle.name
+
+    def test_only_the_model_mapping(self):
+        totals = _read_smaps(self.path, mapping_suffix='/srv/ai_model/model.gguf')
+        self.assertEqual((totals['Rss'], totals['Pss'], totals['Shared_Clean']), (8192, 4096, 8192))
+        self.assertEqual(totals['Private_Dirty'], 0)
+
+    def test_all_mappings(self):
+        totals = _read_smaps(self.path)
+        self.assertEqual((totals['Rss'], totals['Private_Dirty']), (9216, 1024))
+
+
+class PrefetchTests(SimpleTestCase):
+    def test_reads_the_whole_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.truncate(3 * 1024 * 1024 + 5)
+            self.assertEqual(prefetch_model_weights(f.name), 3 * 1024 * 1024 + 5)
+
+    def test_missing_file(self):
+        self.assertEqual(prefetch_model_weights('/nonexistent/model.gguf'), 0)
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/smaps'), "needs Linux /proc smaps")
+class SharedMappingTests(SimpleTestCase):
+    def test_processes_mapping_one_file_share_its_pages(self):
+        with tempfile.NamedTemporaryFile(suffix='.gguf') as f:
+            f.write(os.urandom(FILE_MB * 1024 * 1024))
+            f.flush()
+            workers = [subprocess.Popen([sys.executable, '-c', MAPPER, f.name],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                       for _ in range(2)]
+            try:
+                for worker in workers:
+                    self.assertEqual(worker.stdout.readline().strip(), 'mapped')
+                report = shared_memory_report([worker.pid for worker in workers], f.name)
+            finally:
+                for worker in workers:
+                    worker.communicate('')
+
+        self.assertEqual(len(report['processes']), 2)
+        for process in report['processes']:
+            self.assertGreater(process['model_rss_mb'], FILE_MB * 0.9)
+            self.assertLess(process['model_pss_mb'], FILE_MB * 0.6)  # Half the pages are charged to the other
+        # The file is resident once for both: summed PSS ~ the file, not twice it
+        self.assertLess(report['total_model_pss_mb'], FILE_MB * 1.1)
+        self.assertGreater(report['model_sharing_ratio'], 1.8)
+
+
+class GunicornWorkerModeTests(SimpleTestCase):
+    conf = str(Path(settings.BASE_DIR) / 'gunicorn.conf.py')
+
+    def load(self, **env):
+        with mock.patch.dict(os.environ, env), mock.patch('gc.disable'):
+            return runpy.run_path(self.conf)
+
+    def test_several_workers_need_a_mode(self):
+        with mock.patch.dict(os.environ, {'AI_INFERENCE_WORKER_ADDRESS': '', 'AI_MODEL_PER_WORKER': ''}):
+            with self.assertRaises(RuntimeError):
+                self.load(WEB_CONCURRENCY='2')
+
+    def test_per_worker_mapping_or_inference_worker(self):
+        self.assertEqual(self.load(WEB_CONCURRENCY='2', AI_MODEL_PER_WORKER='1',
+                                   AI_INFERENCE_WORKER_ADDRESS='')['workers'], 2)
+        self.assertEqual(self.load(WEB_CONCURRENCY='2', AI_MODEL_PER_WORKER='',
+                                   AI_INFERENCE_WORKER_ADDRESS='/tmp/inference.sock')['workers'], 2)
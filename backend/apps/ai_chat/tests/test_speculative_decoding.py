@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ai_chat import llm_handler_deployment as handler
+from apps.ai_chat.llm_handler_deployment import ADAPTIVE_MEMORY_THRESHOLDS, OptimizedLlamaModel
+
+
+class ConfigureSpeculativeTests(SimpleTestCase):
+    def setUp(self):
+        self.model = OptimizedLlamaModel()
+        for name in ('llm', '_speculative_config', 'draft_llm'):
+            target = mock.patch.object(self.model, name, None)
+            target.start()
+            self.addCleanup(target.stop)
+        target = mock.patch.object(handler, 'SPECULATIVE_AVAILABLE', True)
+        target.start()
+        self.addCleanup(target.stop)
+
+    def test_off_on_every_tier(self):
+        self.assertEqual({params['speculative_tokens'] for params in ADAPTIVE_MEMORY_THRESHOLDS.values()}, {0})
+        self.model.llm = SimpleNamespace(draft_model='stale', _logits_all=True)
+        self.model._configure_speculative('high')
+        self.assertIsNone(self.model.llm.draft_model)
+
+    @mock.patch.dict(ADAPTIVE_MEMORY_THRESHOLDS['high'], speculative_tokens=4)
+    def test_no_drafter_without_per_token_logits(self):
+        self.model.llm = SimpleNamespace(draft_model='stale', _logits_all=False)
+        self.model._configure_speculative('high')
+        self.assertIsNone(self.model.llm.draft_model)
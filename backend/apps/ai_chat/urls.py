@@ -1,16 +1,28 @@
 # urls.py for ai_chat app
 
-from django.urls import path
+from django.urls import path, re_path
 from .views import (
     SendMessageView, 
+    StreamMessageView,
     ChatHistoryView, 
     ChatSessionDetailView, 
     new_chat_session_view, 
     delete_chat_session_view, 
+    queue_status_view,
+    cancel_generation_view,
+    continue_generation_view,
+    metrics_view,
     rename_chat_session_view, 
     InitializeModelView
     # Add imports for ChatListCreate, ChatDetail if used from reference code
 )
+from .async_views import (
+    async_send_message_view,
+    async_stream_message_view,
+    async_queue_status_view,
+    async_cancel_generation_view,
+    async_continue_generation_view,
+)
 
 # Define app_name if you use namespacing (optional but good practice)
 # app_name = 'ai_chat'
@@ -18,6 +30,18 @@ from .views import (
 urlpatterns = [
     # Core chat endpoints
     path('send-message/', SendMessageView.as_view(), name='send_message'),
+    path('send-message/stream/', StreamMessageView.as_view(), name='send_message_stream'),
+    path('queue/<str:session_id>/', queue_status_view, name='queue_status'),
+    path('cancel/<str:session_id>/', cancel_generation_view, name='cancel_generation'),
+    path('continue/<str:session_id>/', continue_generation_view, name='continue_generation'),
+    re_path(r'^metrics/?$', metrics_view, name='metrics'),  # Scrapers often skip the trailing slash
+
+    # Async variants for ASGI deployments (same request/response shapes)
+    path('async/send-message/', async_send_message_view, name='async_send_message'),
+    path('async/send-message/stream/', async_stream_message_view, name='async_send_message_stream'),
+    path('async/queue/<str:session_id>/', async_queue_status_view, name='async_queue_status'),
+    path('async/cancel/<str:session_id>/', async_cancel_generation_view, name='async_cancel_generation'),
+    path('async/continue/<str:session_id>/', async_continue_generation_view, name='async_continue_generation'),
     path('history/', ChatHistoryView.as_view(), name='chat_history'),
     path('session/<str:session_id>/', ChatSessionDetailView.as_view(), name='chat_session_detail'),
     
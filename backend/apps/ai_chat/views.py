@@ -1,71 +1,186 @@
 # views.py
 
+import hmac
+import json
 import logging
+import math
 import traceback
 import uuid
+from datetime import datetime
 
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q, Max, Count
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 from django.shortcuts import get_object_or_404
 from rest_framework import status, generics
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from .models import Chat
 from .serializers import ChatSerializer, ChatSessionSerializer
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
 # Import LlamaCPP-specific functions and status - USING DEPLOYMENT HANDLER
 from .llm_handler_deployment import (
     generate_chat_response, 
+    stream_chat_response,
+    continue_chat_response,
     clear_chat_history, 
-    load_history_from_database, 
     initialize_model as initialize_llm, # Rename for clarity
     is_model_initialized, 
     initialization_status, 
-    generate_new_session_id
+    generate_new_session_id,
+    session_token,
+    owns_session,
+    get_queue_status,
+    get_metrics_text,
+    cancel_chat_generation,
+    GenerationCancelled,
+    ContinuationUnavailable,
+    InferenceOverloaded,
+    InferenceQueueFull,
+    truncation_fields,
 )
 
 logger = logging.getLogger(__name__)
 
 # --- Core Chat Interaction Views --- #
 
-class SendMessageView(APIView):
-    """Handles sending a user message and getting an AI response."""
-    permission_classes = []  # Allow both authenticated and guest users
+def _parse_message_request(request):
+    """Extract and validate the fields shared by the send-message endpoints.
 
-    def post(self, request):
-        # Check if user is authenticated, allow guests
-        user = request.user if request.user.is_authenticated else None
+    Returns (user, message_text, session_id, model_mode, error_response).
+    """
+    # Check if user is authenticated, allow guests
+    user = request.user if request.user.is_authenticated else None
+    
+    message_text = request.data.get('message', '')
+    session_id = request.data.get('chat_session', None) # Expect session ID from frontend
+    model_mode = request.data.get('model_mode', 'default') # Keep model_mode if used
+
+    if not message_text:
+        return user, message_text, session_id, model_mode, Response({'error': 'Message is required.'}, status=status.HTTP_400_BAD_REQUEST)
         
-        message_text = request.data.get('message', '')
-        session_id = request.data.get('chat_session', None) # Expect session ID from frontend
-        model_mode = request.data.get('model_mode', 'default') # Keep model_mode if used
+    if not session_id:
+        return user, message_text, session_id, model_mode, Response({'error': 'Chat session ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not message_text:
-            return Response({'error': 'Message is required.'}, status=status.HTTP_400_BAD_REQUEST)
-            
-        if not session_id:
-            return Response({'error': 'Chat session ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    # Validate model_mode (if you use it for different model settings)
+    # if model_mode not in ['default', 'creative', 'technical']:
+    #     model_mode = 'default'
+    
+    # --- Optional: Message Limit Check (Example) --- #
+    # max_messages_per_session = getattr(settings, 'MAX_MESSAGES_PER_SESSION', 50) 
+    # current_message_count = Chat.objects.filter(user=user, chat_session=session_id).count()
+    # if current_message_count >= max_messages_per_session:
+    #     return Response({
+    #         'error': f'Chat limit of {max_messages_per_session} messages reached. Please start a new chat.',
+    #         'limit_reached': True
+    #     }, status=status.HTTP_400_BAD_REQUEST)
+    # --- End Message Limit Check --- #
+
+    return user, message_text, session_id, model_mode, None
+
+def _save_chat_exchange(user, session_id, message_text, ai_response_text, model_mode):
+    """Persist a message/response pair and return the instance to serialize."""
+    # Only save to database if user is authenticated (skip for guest users)
+    if user and user.is_authenticated:
+        # Determine title (only for the very first message pair in a session)
+        title = None
+        is_first_message = not Chat.objects.filter(user=user, chat_session=session_id).exists()
+        if is_first_message:
+            title = message_text[:50] + ('...' if len(message_text) > 50 else '')
 
-        # Validate model_mode (if you use it for different model settings)
-        # if model_mode not in ['default', 'creative', 'technical']:
-        #     model_mode = 'default'
+        # Save the user message and AI response to the database
+        chat_instance = Chat.objects.create(
+            user=user,
+            chat_session=session_id,
+            message=message_text,
+            response=ai_response_text,
+            title=title if is_first_message else None, # Only set title on first message
+            model_mode=model_mode, # Save if used
+            # is_automatic=(model_mode == 'default') # Save if used
+            # remaining_messages = max_messages_per_session - current_message_count - 1 # If using limit
+        )
         
-        # --- Optional: Message Limit Check (Example) --- #
-        # max_messages_per_session = getattr(settings, 'MAX_MESSAGES_PER_SESSION', 50) 
-        # current_message_count = Chat.objects.filter(user=user, chat_session=session_id).count()
-        # if current_message_count >= max_messages_per_session:
-        #     return Response({
-        #         'error': f'Chat limit of {max_messages_per_session} messages reached. Please start a new chat.',
-        #         'limit_reached': True
-        #     }, status=status.HTTP_400_BAD_REQUEST)
-        # --- End Message Limit Check --- #
+        # If it was the first message, update previous null titles for this session
+        # This ensures the session gets the title even if created slightly earlier
+        if is_first_message and title:
+             Chat.objects.filter(user=user, chat_session=session_id, title__isnull=True).update(title=title)
+        return chat_instance
+
+    # For guest users, create a mock chat instance for consistent response format
+    return type('MockChat', (), {
+        'id': None,
+        'message': message_text,
+        'response': ai_response_text,
+        'created_at': datetime.now(),
+        'chat_session': session_id,
+        'user': None,
+        'title': None,
+        'model_mode': model_mode
+    })()
+
+def _append_chat_continuation(user, session_id, ai_response_text):
+    """Store a continued answer on the session's latest chat row and return the instance to serialize."""
+    if user and user.is_authenticated:
+        chat_instance = Chat.objects.filter(user=user, chat_session=session_id).order_by('-created_at').first()
+        if chat_instance is not None:
+            # The handler returns the whole answer so far: the cut-off part plus its continuation
+            chat_instance.response = ai_response_text
+            chat_instance.save(update_fields=['response'])
+            return chat_instance
+
+    # Guests (or a session with no saved row) get the same shape without a row
+    return type('MockChat', (), {
+        'id': None,
+        'message': None,
+        'response': ai_response_text,
+        'created_at': datetime.now(),
+        'chat_session': session_id,
+        'user': None,
+        'title': None,
+    })()
+
+def _continuation_id(data):
+    """The continuation handle's id from a request body (the whole handle is accepted too)"""
+    continuation = data.get('continuation') if hasattr(data, 'get') else None
+    if isinstance(continuation, dict):
+        continuation = continuation.get('id')
+    return continuation or None
+
+def _session_token(request):
+    """The session token a client got from new-session, from the header or the body"""
+    token = request.META.get('HTTP_X_CHAT_SESSION_TOKEN')
+    if not token and hasattr(request.data, 'get'):
+        token = request.data.get('session_token')
+    return token or None
+
+def _overloaded_response(exc):
+    """Fast 429 (queue full) / 503 (waited too long) with a Retry-After hint."""
+    retry_after = max(int(math.ceil(exc.retry_after)), 1)
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS if isinstance(exc, InferenceQueueFull) else status.HTTP_503_SERVICE_UNAVAILABLE
+    return Response({'error': exc.message, 'retry_after': retry_after}, status=status_code,
+                    headers={'Retry-After': str(retry_after)})
+
+def _sse_event(event, data):
+    """Format a single Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+class SendMessageView(APIView):
+    """Handles sending a user message and getting an AI response."""
+    permission_classes = []  # Allow both authenticated and guest users
+
+    def post(self, request):
+        user, message_text, session_id, model_mode, error_response = _parse_message_request(request)
+        if error_response is not None:
+            return error_response
 
         try:
-            # Ensure history is loaded before generating response
-            # load_history_from_database(user, session_id)
-            
-            # Generate AI response using the handler
+            # Generate AI response using the handler (it rehydrates history from the database on a cache miss)
             ai_response_text = generate_chat_response(message_text, session_id, user, model_mode)
             
             # Check if the response indicates an error from the handler
@@ -75,54 +190,154 @@ class SendMessageView(APIView):
                  # Return the error message from the handler to the frontend
                  return Response({'error': ai_response_text}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Only save to database if user is authenticated (skip for guest users)
-            if user and user.is_authenticated:
-                # Determine title (only for the very first message pair in a session)
-                title = None
-                is_first_message = not Chat.objects.filter(user=user, chat_session=session_id).exists()
-                if is_first_message:
-                    title = message_text[:50] + ('...' if len(message_text) > 50 else '')
-
-                # Save the user message and AI response to the database
-                chat_instance = Chat.objects.create(
-                    user=user,
-                    chat_session=session_id,
-                    message=message_text,
-                    response=ai_response_text,
-                    title=title if is_first_message else None, # Only set title on first message
-                    model_mode=model_mode, # Save if used
-                    # is_automatic=(model_mode == 'default') # Save if used
-                    # remaining_messages = max_messages_per_session - current_message_count - 1 # If using limit
-                )
-                
-                # If it was the first message, update previous null titles for this session
-                # This ensures the session gets the title even if created slightly earlier
-                if is_first_message and title:
-                     Chat.objects.filter(user=user, chat_session=session_id, title__isnull=True).update(title=title)
-            else:
-                # For guest users, create a mock chat instance for consistent response format
-                from datetime import datetime
-                chat_instance = type('MockChat', (), {
-                    'id': None,
-                    'message': message_text,
-                    'response': ai_response_text,
-                    'created_at': datetime.now(),
-                    'chat_session': session_id,
-                    'user': None,
-                    'title': None,
-                    'model_mode': model_mode
-                })()
+            chat_instance = _save_chat_exchange(user, session_id, message_text, ai_response_text, model_mode)
 
             # Serialize the created chat instance for the response
             serializer = ChatSerializer(chat_instance)
             
             # Return the successful response including the AI message details
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            # (plus truncated/continuation when the generation deadline cut it short)
+            return Response({**serializer.data, **truncation_fields(ai_response_text)}, status=status.HTTP_201_CREATED)
 
+        except InferenceOverloaded as e:
+            logger.warning(f"Rejected chat message for session {session_id}: {e} (retry after {e.retry_after:.0f}s)")
+            return _overloaded_response(e)
+        except GenerationCancelled:
+            logger.info(f"Chat message for session {session_id} was cancelled before it finished")
+            return Response({'error': 'Generation cancelled.', 'cancelled': True}, status=status.HTTP_409_CONFLICT)
         except Exception as e:
             logger.error(f"Error processing chat message for session {session_id}: {e}", exc_info=True)
             return Response({'error': 'An unexpected error occurred processing your message.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class ServerSentEventRenderer(BaseRenderer):
+    """Lets clients negotiate `Accept: text/event-stream`; non-streamed responses become one SSE frame."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        event = 'error' if isinstance(data, dict) and 'error' in data else 'message'
+        return _sse_event(event, data).encode(self.charset)
+
+class StreamMessageView(APIView):
+    """Streaming variant of SendMessageView that pushes tokens as Server-Sent Events.
+
+    Emits `token` events while the model decodes, then a single `done` event
+    carrying the serialized chat once it has been saved (or an `error` or
+    `cancelled` event). A cut-off answer's `done` adds `truncated` and `continuation`. A client that disconnects cancels the generation.
+    """
+    permission_classes = []  # Allow both authenticated and guest users
+    renderer_classes = [JSONRenderer, ServerSentEventRenderer]
+
+    def post(self, request):
+        user, message_text, session_id, model_mode, error_response = _parse_message_request(request)
+        if error_response is not None:
+            return error_response
+
+        # Admission happens on the first event, so a full queue is still a plain 429/503
+        events = stream_chat_response(message_text, session_id, user, model_mode)
+        try:
+            first_event = next(events)
+        except InferenceOverloaded as e:
+            logger.warning(f"Rejected streamed chat message for session {session_id}: {e}")
+            return _overloaded_response(e)
+        except StopIteration:
+            first_event = None
+
+        def all_events():
+            if first_event is not None:
+                yield first_event
+            yield from events
+
+        def event_stream():
+            try:
+                for event, data in all_events():
+                    if event == 'queued':
+                        yield _sse_event('queued', data)
+                    elif event == 'token':
+                        yield _sse_event('token', {'text': data})
+                    elif event == 'error':
+                        logger.error(f"LLM streaming error for session {session_id}: {data}")
+                        yield _sse_event('error', {'error': data})
+                        return
+                    elif event == 'cancelled':
+                        yield _sse_event('cancelled', {'cancelled': True})
+                        return
+                    else:
+                        # Persist only once the full response is known
+                        chat_instance = _save_chat_exchange(user, session_id, message_text, data, model_mode)
+                        yield _sse_event('done', {**ChatSerializer(chat_instance).data, **truncation_fields(data)})
+            except InferenceOverloaded as e:
+                yield _sse_event('error', {'error': e.message, 'retry_after': max(int(math.ceil(e.retry_after)), 1)})
+            except Exception as e:
+                logger.error(f"Error streaming chat message for session {session_id}: {e}", exc_info=True)
+                yield _sse_event('error', {'error': 'An unexpected error occurred processing your message.'})
+            finally:
+                # Django closes this generator when the client disconnects; pass that on to the model
+                events.close()
+
+        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Stop reverse proxies from buffering the stream
+        return response
+
+@api_view(['GET'])
+@permission_classes([])  # Guests poll their own session's position too
+def queue_status_view(request, session_id):
+    """Reports where a session's pending generation stands in the inference queue."""
+    return Response(get_queue_status(session_id), status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([])  # Guests can stop their own generations (with their session token)
+def cancel_generation_view(request, session_id):
+    """Stops a session's queued or running generation, freeing the model for others."""
+    user = request.user if request.user.is_authenticated else None
+    if not owns_session(user, session_id, _session_token(request)):
+        return Response({'error': 'Chat session not found.'}, status=status.HTTP_404_NOT_FOUND)
+    cancelled = cancel_chat_generation(session_id)
+    return Response({'cancelled': cancelled > 0, 'jobs': cancelled}, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([])  # Guests can finish their own cut-off answers
+def continue_generation_view(request, session_id):
+    """Resumes a session's truncated answer from its saved context and appends the rest to the chat."""
+    user = request.user if request.user.is_authenticated else None
+    continuation_id = _continuation_id(request.data)
+    if not continuation_id:
+        return Response({'error': 'Continuation ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        ai_response_text = continue_chat_response(session_id, continuation_id, user)
+        if ai_response_text.startswith("Error:") or ai_response_text.startswith("Sorry, I encountered an error"):
+            logger.error(f"LLM continuation error for session {session_id}: {ai_response_text}")
+            return Response({'error': ai_response_text}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        chat_instance = _append_chat_continuation(user, session_id, ai_response_text)
+        return Response({**ChatSerializer(chat_instance).data, **truncation_fields(ai_response_text)}, status=status.HTTP_200_OK)
+
+    except ContinuationUnavailable as e:
+        return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+    except InferenceOverloaded as e:
+        logger.warning(f"Rejected continuation for session {session_id}: {e} (retry after {e.retry_after:.0f}s)")
+        return _overloaded_response(e)
+    except GenerationCancelled:
+        logger.info(f"Continuation for session {session_id} was cancelled before it finished")
+        return Response({'error': 'Generation cancelled.', 'cancelled': True}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        logger.error(f"Error continuing chat message for session {session_id}: {e}", exc_info=True)
+        return Response({'error': 'An unexpected error occurred processing your message.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@require_GET
+def metrics_view(request):
+    """Prometheus scrape endpoint; plain Django so the exposition text is returned as-is."""
+    token = settings.AI_METRICS_TOKEN
+    if not token:
+        # Queue, memory and session-cache internals are not public: off until a token is configured
+        return HttpResponse('Not Found\n', status=404, content_type='text/plain')
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f"Bearer {token}"):
+        return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+    return HttpResponse(get_metrics_text(), content_type=METRICS_CONTENT_TYPE)
+
 # --- Session Management Views --- #
 
 @api_view(['POST'])
@@ -133,8 +348,10 @@ def new_chat_session_view(request):
         new_session_id = generate_new_session_id()
         logger.info(f"Generated new chat session ID: {new_session_id}")
         # We don't save anything to DB here, just return the ID
-        # The first message sent with this ID will create the DB entry
-        return Response({'chat_session_id': new_session_id}, status=status.HTTP_200_OK)
+        # The first message sent with this ID will create the DB entry.
+        # The token lets guests (and signed-in users before the first save) cancel their generations.
+        return Response({'chat_session_id': new_session_id, 'session_token': session_token(new_session_id)},
+                        status=status.HTTP_200_OK)
     except Exception as e:
         logger.error(f"Error generating new session ID: {e}", exc_info=True)
         return Response({'error': 'Failed to create new session ID.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -290,6 +507,9 @@ def delete_chat_session_view(request, session_id):
         if deleted_count == 0:
             return Response({'error': 'Chat session not found.'}, status=status.HTTP_404_NOT_FOUND)
         
+        # Drop the in-memory history and KV state for the session as well
+        clear_chat_history(session_id)
+        
         logger.info(f"Deleted chat session {session_id} with {deleted_count} messages")
         return Response({'message': f'Chat session deleted successfully. {deleted_count} messages removed.'}, status=status.HTTP_200_OK)
         
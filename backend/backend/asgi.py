@@ -7,10 +7,55 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+
+def cancel_on_disconnect(app):
+    """Cancel the request's task when the client disconnects (Django only does this itself from 5.0).
+
+    Django 4.2 stops reading from the connection once it has the body, so a
+    coroutine view never learns that its client went away. This watches the
+    channel for http.disconnect from then on and cancels the request task:
+    the view sees asyncio.CancelledError (the chat views cancel their
+    generation on it) and a streaming response's generator is closed.
+    """
+    async def wrapped(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        body_read = asyncio.Event()
+        disconnected = False
+
+        async def receive_body():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()  # Django won't call receive() again; the watcher takes over
+            return message
+
+        async def watch(task):
+            nonlocal disconnected
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected = True
+            task.cancel()
+
+        task = asyncio.ensure_future(app(scope, receive_body, send))
+        watcher = asyncio.ensure_future(watch(task))
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise  # Cancelled by the server, not by us
+        finally:
+            watcher.cancel()
+
+    return wrapped
+
+
+application = cancel_on_disconnect(get_asgi_application())
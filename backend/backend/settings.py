@@ -46,7 +46,7 @@ AUTH_USER_MODEL = 'users.User'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'apps.utils.middleware.WhiteNoiseMiddleware',  # Async-capable so ASGI views stay off the sync thread
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -219,6 +219,69 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 1000
 DATA_UPLOAD_MAX_NUMBER_FILES = 100
 
+# Out-of-process inference worker (see apps/ai_chat/inference_worker.py).
+# When set (a unix socket path), web workers forward chat jobs to
+# `python manage.py run_inference_worker` instead of loading the model themselves.
+AI_INFERENCE_WORKER_ADDRESS = os.environ.get('AI_INFERENCE_WORKER_ADDRESS')
+# Shared secret authenticating web workers to the inference worker. Required with
+# AI_INFERENCE_WORKER_ADDRESS; must differ from SECRET_KEY (the channel carries pickles).
+AI_INFERENCE_WORKER_AUTHKEY = os.environ.get('AI_INFERENCE_WORKER_AUTHKEY', '')
+
+# Multi-worker mode without an inference worker (see gunicorn.conf.py; one of the
+# two is required when WEB_CONCURRENCY > 1): the gunicorn master only prefetches
+# the GGUF and every worker loads its own context over the shared mmap instead of
+# inheriting the master's. Sessions stay per worker, so route them stickily.
+AI_MODEL_PER_WORKER = os.environ.get('AI_MODEL_PER_WORKER', '').lower() in ('1', 'true', 'yes')
+
+# Optional tiny GGUF sharing Gemma 3's tokenizer (e.g. gemma-3-270m-it) for speculative
+# decoding. Only used by a tier with speculative_draft_model set; speculation is off on
+# every tier by default (its per-token logits don't fit in 2GB).
+AI_DRAFT_MODEL_PATH = os.environ.get('AI_DRAFT_MODEL_PATH')
+
+# llama.cpp thread counts. By default both follow the container's CPU budget
+# (affinity mask capped by the cgroup quota) and a startup microbenchmark picks
+# the fastest decode and prompt-eval counts; set these to pin them instead.
+AI_LLM_N_THREADS = int(os.environ['AI_LLM_N_THREADS']) if os.environ.get('AI_LLM_N_THREADS') else None
+AI_LLM_N_THREADS_BATCH = int(os.environ['AI_LLM_N_THREADS_BATCH']) if os.environ.get('AI_LLM_N_THREADS_BATCH') else None
+AI_LLM_THREAD_BENCHMARK = os.environ.get('AI_LLM_THREAD_BENCHMARK', 'true').lower() in ('1', 'true', 'yes')
+
+# Model router: by default the best Gemma 3 1B quantization in ai_model/ that the
+# memory tier allows is loaded (Q8_0, then Q4_K_M, then Q4_0), switching as memory
+# comes and goes. Set to a variant name (e.g. Q4_K_M) to always use that one.
+AI_MODEL_VARIANT = os.environ.get('AI_MODEL_VARIANT') or None
+
+# Admission control for the inference queue: jobs allowed to wait behind the
+# running one, and how long a job may wait to start before the request fails
+# with 503. Over-depth requests get 429; both carry a Retry-After header.
+AI_QUEUE_MAX_DEPTH = int(os.environ.get('AI_QUEUE_MAX_DEPTH', '4'))
+AI_QUEUE_MAX_WAIT_SECONDS = float(os.environ.get('AI_QUEUE_MAX_WAIT_SECONDS', '120'))
+
+# Wall-clock budget per chat generation, counted from when the request is queued.
+# Decoding stops at the deadline and the partial answer is returned with
+# truncated=true and a continuation handle. The minimal memory tier uses 60s; 0 disables.
+AI_GENERATION_DEADLINE_SECONDS = float(os.environ.get('AI_GENERATION_DEADLINE_SECONDS', '90'))
+
+# Concurrent chat sessions decoded together in one multi-sequence llama batch
+# (each with its own KV sequence). The memory tier caps it further: medium
+# allows 2, high 4, lower tiers decode one session at a time. 1 disables batching.
+AI_BATCH_MAX_SEQUENCES = int(os.environ.get('AI_BATCH_MAX_SEQUENCES', '4'))
+
+# Rolling conversation summaries: older turns of a long chat are folded into one
+# memory note by a background job instead of being dropped. The trigger defaults
+# to 60% of the memory tier's prompt budget; set a token count to pin it.
+AI_HISTORY_SUMMARIES = os.environ.get('AI_HISTORY_SUMMARIES', 'true').lower() in ('1', 'true', 'yes')
+AI_HISTORY_SUMMARY_TRIGGER_TOKENS = int(os.environ['AI_HISTORY_SUMMARY_TRIGGER_TOKENS']) if os.environ.get('AI_HISTORY_SUMMARY_TRIGGER_TOKENS') else None
+
+# Prometheus scrape endpoint (/api/ai/metrics). Scrapers must send
+# `Authorization: Bearer <token>`; empty disables the endpoint (404).
+AI_METRICS_TOKEN = os.environ.get('AI_METRICS_TOKEN', '')
+
+# Disk-backed cache for first-turn answers to the built-in suggestion prompts
+# (see apps/ai_chat/response_cache.py). Set AI_RESPONSE_CACHE_DIR to an empty
+# string to disable it; `python manage.py warm_response_cache` pre-fills it.
+AI_RESPONSE_CACHE_DIR = os.environ.get('AI_RESPONSE_CACHE_DIR', str(BASE_DIR / 'ai_model' / 'response_cache'))
+AI_RESPONSE_CACHE_SIZE_MB = int(os.environ.get('AI_RESPONSE_CACHE_SIZE_MB', '64'))
+
 # Session timeout settings
 SESSION_COOKIE_AGE = 86400  # 24 hours
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
@@ -4,7 +4,10 @@
 # Find the Start Command setting.
 #
 # It should already be set to what's in your Procfile: 
-# gunicorn --preload --workers 1 --timeout 1200 --max-requests 1000 --max-requests-jitter 50 backend.wsgi:application --bind 0.0.0.0:$PORT
+# gunicorn -c gunicorn.conf.py
+# 
+# gunicorn.conf.py holds the app (WSGI or ASGI) and the flags described below
+# (bind, preload, workers, timeouts).
 # 
 # Click Save Changes and trigger a new deployment.
 # 
@@ -19,8 +22,10 @@
 # --preload is used to preload the application into memory, 
 # which can improve performance for subsequent requests.
 # 
-# --workers 1 specifies that only one worker process should be used.
-# This is a simple configuration that works well for most small-scale applications.
+# workers defaults to 1. Set WEB_CONCURRENCY to run more, together with either
+# AI_INFERENCE_WORKER_ADDRESS (one inference process) or AI_MODEL_PER_WORKER=1:
+# the workers then share the mmapped model weights and each only adds its own
+# small llama context (verify with `python manage.py model_memory_report`).
 # 
 # --timeout 1200 sets the maximum request processing time to 20 minutes.
 # This is a safety net to prevent any one request from blocking the entire server.
@@ -49,6 +54,8 @@ mkdir -p ai_model
 # Download the AI model file from Hugging Face into the correct `ai_model` directory.
 echo "Downloading Gemma 3 1B model... this may take a few minutes."
 curl -L -o ai_model/gemma-3-1b-it-Q8_0.gguf "https://huggingface.co/ggml-org/gemma-3-1b-it-GGUF/resolve/main/gemma-3-1b-it-Q8_0.gguf?download=true"
+# 4-bit quantization the model router falls back to on the low and minimal memory tiers.
+curl -L -o ai_model/gemma-3-1b-it-Q4_K_M.gguf "https://huggingface.co/ggml-org/gemma-3-1b-it-GGUF/resolve/main/gemma-3-1b-it-Q4_K_M.gguf?download=true"
 echo "Model download complete."
 
 # Remove unnecessary directories to reduce slug size.
@@ -0,0 +1,71 @@
+# gunicorn.conf.py - loaded automatically when gunicorn starts from the backend/ directory
+#
+# Single worker (default): the model is loaded in the master with preload_app and the
+# worker inherits it.
+#
+# Multi-worker (WEB_CONCURRENCY > 1) needs one of:
+# - AI_INFERENCE_WORKER_ADDRESS: every worker forwards chat calls to the single
+#   `python manage.py run_inference_worker` process, which owns the model and all sessions.
+# - AI_MODEL_PER_WORKER=1: the master only reads the GGUF into the page cache; each worker
+#   then creates its own small llama context over a use_mmap=True mapping of the same file,
+#   so the weights stay resident once and only the per-worker KV cache and compute buffers
+#   are multiplied (check with `python manage.py model_memory_report`). Each worker keeps
+#   its own sessions: signed-in users' history is reloaded from the database on any worker,
+#   but guest history, KV states, cancel and continuations only work on the worker that
+#   served the session, so put a sticky-session proxy in front.
+#
+# ASGI (GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker): serves backend.asgi instead,
+# so the /api/ai/async/ chat views await generations on the event loop and one process
+# keeps answering the rest of the API while they run.
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+wsgi_app = 'backend.asgi:application' if 'uvicorn' in worker_class.lower() else 'backend.wsgi:application'
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+# gthread only: threads let over-limit requests reach the inference queue's admission control
+# (fast 429/503) instead of waiting in the socket backlog behind a long generation
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+preload_app = True
+timeout = 1200
+max_requests = 1000
+max_requests_jitter = 50
+
+if workers > 1 and not (os.environ.get('AI_INFERENCE_WORKER_ADDRESS')
+                        or os.environ.get('AI_MODEL_PER_WORKER', '').lower() in ('1', 'true', 'yes')):
+    raise RuntimeError(
+        f"WEB_CONCURRENCY={workers} needs AI_INFERENCE_WORKER_ADDRESS (one process owns the model "
+        "and every session) or AI_MODEL_PER_WORKER=1 (each worker maps the shared weights and keeps "
+        "its own sessions, behind a sticky-session proxy). Otherwise use one worker."
+    )
+
+if preload_app:
+    # No collections in the master from here on: a collection between the preload and the
+    # fork would free holes in (and touch the gc headers of) pages the workers share.
+    # Workers re-enable it in post_fork; the master stays collector-free.
+    gc.disable()
+
+
+def when_ready(server):
+    """Runs in the master after the preload, right before the first fork."""
+    if not server.cfg.preload_app:
+        return
+    from apps.ai_chat import llm_handler_deployment
+    llm_handler_deployment.freeze_heap_for_fork()
+
+
+def post_fork(server, worker):
+    """First thing in each worker: collect again, leaving the frozen preload heap alone."""
+    gc.enable()
+
+
+def post_worker_init(worker):
+    """Per-worker model load in multi-worker mode (the master never holds a context)."""
+    from django.conf import settings
+    if not settings.AI_MODEL_PER_WORKER or settings.AI_INFERENCE_WORKER_ADDRESS:
+        return
+    from apps.ai_chat import llm_handler_deployment
+    worker.log.info(f"Worker {worker.pid}: loading model context over the shared mmap")
+    llm_handler_deployment.initialize_model()